@@ -4,8 +4,10 @@ import os
 import pickle
 import shutil
 import struct
+import sys
 import tempfile
 import weakref
+import zlib
 
 from dataflows import Flow
 from dataflows.helpers.resource_matcher import ResourceMatcher
@@ -28,6 +30,75 @@ FILE_BUFFER_SIZE = 1 << 20
 # than one chunk. Tune with the DUPLICATE_RESERVE_CHUNK env var.
 RESERVE_CHUNK_SIZE = int(os.environ.get("DUPLICATE_RESERVE_CHUNK", 64 * 1024 * 1024))
 
+# Approximate number of bytes of rows a duplicate holds in memory. Smaller
+# resources are replayed straight from memory; past this the buffered rows are
+# moved to a scratch file on local disk. Tune with the DUPLICATE_MEMORY_BUDGET
+# env var or the duplicate's `memory_budget`.
+DUPLICATE_MEMORY_BUDGET = int(
+    os.environ.get("DUPLICATE_MEMORY_BUDGET", 256 * 1024 * 1024)
+)
+
+# Rows are measured one in this many to estimate the size of the buffer
+SIZE_SAMPLE_INTERVAL = 100
+
+# Codec of the blocks written to the scratch file. zlib ships with Python;
+# lz4 (faster, a bit larger) and zstd (smaller) need their packages installed.
+# Override per step with the `compression` parameter, or with the
+# DUPLICATE_COMPRESSION env var.
+DEFAULT_COMPRESSION = os.environ.get("DUPLICATE_COMPRESSION", "zlib")
+
+# zlib level of the blocks: they're read back once or a few times, so the
+# fastest level is worth the slightly larger file.
+ZLIB_COMPRESSION_LEVEL = 1
+
+
+def _codec(compression):
+    # Returns the (compress, decompress) functions of a compression name
+    if compression in (None, "none"):
+        return bytes, bytes
+    if compression == "zlib":
+        return (
+            lambda data: zlib.compress(data, ZLIB_COMPRESSION_LEVEL),
+            zlib.decompress,
+        )
+    if compression == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Exception("duplicate `compression` lz4 needs the lz4 package")
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("duplicate `compression` zstd needs the zstandard package")
+        return (
+            zstandard.ZstdCompressor().compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    raise Exception(
+        f"Unknown duplicate `compression` {compression!r}: "
+        "use one of none, zlib, lz4 or zstd"
+    )
+
+
+def _encode_block(fields, count, columns):
+    # Rows of a block share their field names (see RowFileBuffer.write), which
+    # are stored once, followed by the values column by column.
+    return pickle.dumps((fields, count, columns), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _decode_block(data):
+    fields, count, columns = pickle.loads(data)
+    if not fields:
+        return [{} for _ in range(count)]
+    return [dict(zip(fields, values)) for values in zip(*columns)]
+
+
+def estimate_size(row):
+    # Rough in-memory size of a row
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
 
 def _unlink_quietly(path):
     try:
@@ -37,15 +108,24 @@ def _unlink_quietly(path):
 
 
 class RowFileBuffer:
-    """Buffers every row of the source resource on local disk so it can be
-    replayed as the duplicate copy.
+    """Buffers every row of the source resource so it can be replayed as the
+    duplicate copy.
 
     duplicate has to hand the same stream of rows to two resources - the
     original (which flows straight downstream) and the copy - but a resource is
     a one-shot generator, so the rows have to be parked somewhere in between.
-    This streams them to a length-prefixed pickle file on local scratch and
-    reads them back in insertion order, which keeps memory flat (~O(1)) instead
-    of holding the whole resource in RAM.
+    Rows are first held in memory, as shallow copies, and each replay hands
+    out shallow copies of its own, so small resources never touch the disk.
+    Once they pass `memory_budget` bytes they're moved to a file on local
+    scratch: the rest of the rows stream to it and replays read it back in
+    insertion order, which keeps memory flat (one block of rows) instead of
+    holding the whole resource in RAM.
+
+    Rows are written in blocks of `batch_size`: each block is pickled column by
+    column with the field names stored once, compressed, and written with a
+    4-byte length header. Replays decode a whole block at a time, which
+    pickles far fewer objects (and repeated key strings) than row by row and
+    keeps the file several times smaller.
 
     (This replaced an in-memory KVFile buffer whose LRU cache had to hold every
     row - multiple GB for a large resource - and fell off a cliff into per-row
@@ -63,7 +143,26 @@ class RowFileBuffer:
     best-effort statvfs free-space check (non-reserving, but still fails fast).
     """
 
-    def __init__(self):
+    def __init__(self, batch_size=1000, compression=None, memory_budget=None):
+        if compression is None:
+            compression = DEFAULT_COMPRESSION
+        if memory_budget is None:
+            memory_budget = DUPLICATE_MEMORY_BUDGET
+        self._compress, self._decompress = _codec(compression)
+        self._batch_size = max(int(batch_size or 1), 1)
+        self._memory_budget = memory_budget
+        self._rows = []
+        self._rows_size = 0
+        self._row_size = 0
+        self._block_fields = None
+        self._block_columns = []
+        self._block_count = 0
+        self.path = None
+        self._writer = None
+        self._finalizer = None
+        self._closed = False
+
+    def _open_file(self):
         fd, self.path = tempfile.mkstemp(prefix="bcodmo_duplicate_", suffix=".pickle")
         os.close(fd)
         self._dir = os.path.dirname(self.path) or "."
@@ -72,13 +171,12 @@ class RowFileBuffer:
         self._written = 0
         self._reserved = 0
         self._can_fallocate = True
-        self._closed = False
         # Backstop: if the buffer is abandoned (pipeline error, early GC) without
         # a clean close(), still remove the temp file. Bound to `path` only - not
         # `self` - so it doesn't keep the buffer alive.
         self._finalizer = weakref.finalize(self, _unlink_quietly, self.path)
         # Reserve the first chunk now so an already-full disk fails fast, before
-        # we stream any rows.
+        # we write any rows to the file.
         self._reserve(RESERVE_CHUNK_SIZE)
 
     def _free_bytes(self):
@@ -115,8 +213,54 @@ class RowFileBuffer:
             self._out_of_space(total - self._reserved)
         self._reserved = total
 
+    @property
+    def in_memory(self):
+        return self._rows is not None
+
     def write(self, row):
-        b = pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._rows is None:
+            self._write_row(row)
+            return
+        if len(self._rows) % SIZE_SAMPLE_INTERVAL == 0:
+            self._row_size = estimate_size(row)
+        # A copy, as the row itself is already on its way downstream and may
+        # be changed there
+        self._rows.append(dict(row))
+        self._rows_size += self._row_size
+        if self._rows_size > self._memory_budget:
+            self._spill()
+
+    def _spill(self):
+        # Moves the rows held in memory to the scratch file, which takes every
+        # row from here on
+        rows = self._rows
+        self._rows = None
+        self._open_file()
+        for row in rows:
+            self._write_row(row)
+
+    def _write_row(self, row):
+        fields = tuple(row)
+        if self._block_count and fields != self._block_fields:
+            # A block holds rows with the same fields, in the same order, only
+            self._write_block()
+        if not self._block_count:
+            self._block_fields = fields
+            self._block_columns = [[] for _ in fields]
+        # The values are taken now rather than holding on to the row, which is
+        # already on its way downstream and may be changed there.
+        for column, value in zip(self._block_columns, row.values()):
+            column.append(value)
+        self._block_count += 1
+        if self._block_count >= self._batch_size:
+            self._write_block()
+
+    def _write_block(self):
+        b = self._compress(
+            _encode_block(self._block_fields, self._block_count, self._block_columns)
+        )
+        self._block_columns = []
+        self._block_count = 0
         n = len(b) + 4  # 4-byte length header + payload
         if self._written + n > self._reserved:
             # Grow the reservation to the next chunk boundary above what we need,
@@ -129,6 +273,8 @@ class RowFileBuffer:
 
     def done_writing(self):
         if self._writer is not None:
+            if self._block_count:
+                self._write_block()
             self._writer.flush()
             # Release the surplus we reserved beyond the actual bytes written, and
             # give the file a correct size so read() sees EOF in the right place
@@ -141,13 +287,17 @@ class RowFileBuffer:
             self._writer = None
 
     def read(self):
+        if self._rows is not None:
+            for row in self._rows:
+                yield dict(row)
+            return
         with open(self.path, "rb", buffering=FILE_BUFFER_SIZE) as f:
             while True:
                 header = f.read(4)
                 if not header:
                     break
                 (length,) = struct.unpack("<I", header)
-                yield pickle.loads(f.read(length))
+                yield from _decode_block(self._decompress(f.read(length)))
 
     def close(self):
         if self._closed:
@@ -159,12 +309,15 @@ class RowFileBuffer:
             except OSError:
                 pass
             self._writer = None
-        _unlink_quietly(self.path)
-        self._finalizer.detach()
+        self._rows = None
+        self._block_columns = []
+        if self.path is not None:
+            _unlink_quietly(self.path)
+            self._finalizer.detach()
 
 
 def saver(resource, buf, cache_id=None):
-    # Buffering every source row to disk is a per-row step that runs as the
+    # Buffering every source row is a per-row step that runs as the
     # resource streams downstream; publish the number of rows buffered so far so
     # the frontend can see it building up (and that it's alive vs stalled).
     progress = KVFileBuildProgress(cache_id, resource.res.name, "duplicate")
@@ -205,6 +358,8 @@ def duplicate(
     multi=False,
     target_names=None,
     cache_id=None,
+    compression=None,
+    memory_budget=None,
 ):
     def func(package):
         source_ = source
@@ -248,7 +403,11 @@ def duplicate(
         deferred_bufs = []
         for resource in package:
             if resource.res.name == source_ and targets:
-                buf = RowFileBuffer()
+                buf = RowFileBuffer(
+                    batch_size=batch_size,
+                    compression=compression,
+                    memory_budget=memory_budget,
+                )
                 yield saver(resource, buf, cache_id=cache_id)
                 if duplicate_to_end:
                     deferred_bufs.append(buf)
@@ -296,5 +455,7 @@ def flow(parameters):
             parameters.get("multi", False),
             parameters.get("target_names"),
             cache_id=parameters.get("cache_id"),
+            compression=parameters.get("compression"),
+            memory_budget=parameters.get("memory_budget"),
         ),
     )
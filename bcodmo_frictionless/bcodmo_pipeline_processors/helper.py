@@ -1,6 +1,8 @@
 import redis
 import os
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
 def get_missing_values(res):
@@ -35,6 +37,13 @@ def get_redis_progress_parts_key(resource, cache_id):
     return f"{cache_id}-{resource}-parts"
 
 
+def get_redis_progress_stats_key(resource, cache_id):
+    # A hash of figures a processor reports about its build and how it was
+    # used (e.g. the profile of a join). Unlike the other progress keys it is
+    # kept after the build finishes, until it expires.
+    return f"{cache_id}-{resource}-stats"
+
+
 def get_redis_progress_join_key(resource, cache_id):
     # The size (rows/keys) of the in-memory KVFile buffer built so far for this
     # resource. Reported while a join/sort/duplicate is in its (blocking) buffer-
@@ -52,6 +61,10 @@ REDIS_PROGRESS_DELETED_FLAG = -6
 # a join's key index, or a sort/duplicate's row buffer. The size built so far is
 # stored under get_redis_progress_join_key. (Flag name kept for compatibility.)
 REDIS_PROGRESS_JOINING_FLAG = -7
+# A join is reusing an index cached by an earlier run instead of building it,
+# checking that its source is unchanged. The rows checked so far are stored
+# under get_redis_progress_join_key.
+REDIS_PROGRESS_JOIN_CACHED_FLAG = -8
 
 # 1 week expiration
 REDIS_EXPIRES = 60 * 60 * 24 * 7
@@ -76,7 +89,9 @@ class KVFileBuildProgress:
 
     Call update(count) once per processed row/key (writes are throttled), then
     finish() when the build completes to remove the entry so its "building" badge
-    doesn't linger. run's end-of-run cleanup is a backstop.
+    doesn't linger. run's end-of-run cleanup is a backstop. report(stats) can be
+    called at any point, before or after finish(), to publish counters about
+    the build under get_redis_progress_stats_key.
     """
 
     def __init__(self, cache_id, resource_name, kind):
@@ -105,6 +120,25 @@ class KVFileBuildProgress:
             self.redis_conn.set(self._count_key, count, ex=REDIS_EXPIRES)
             self._timer = time.time()
 
+    def set_cached(self, cached):
+        """Flags the build as reusing a cached result (or, with cached=False,
+        as back to building it from scratch).
+        """
+        if self.redis_conn is not None:
+            self.redis_conn.set(
+                self._progress_key,
+                REDIS_PROGRESS_JOIN_CACHED_FLAG
+                if cached
+                else REDIS_PROGRESS_JOINING_FLAG,
+                ex=REDIS_EXPIRES,
+            )
+
+    def report(self, stats):
+        if self.redis_conn is not None and stats:
+            stats_key = get_redis_progress_stats_key(self.progress_name, self.cache_id)
+            self.redis_conn.hset(stats_key, mapping=stats)
+            self.redis_conn.expire(stats_key, REDIS_EXPIRES)
+
     def finish(self):
         if self.redis_conn is not None:
             self.redis_conn.delete(self._progress_key)
@@ -112,3 +146,28 @@ class KVFileBuildProgress:
             self.redis_conn.srem(
                 get_redis_progress_resource_key(self.cache_id), self.progress_name
             )
+
+
+def iter_parallel(func, tasks, workers):
+    """Yields func(task) for every task, in order, computed in a pool of
+    `workers` processes. Only a few tasks per worker are in flight at a time,
+    so results are never buffered far ahead of the consumer.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers)
+    tasks = iter(tasks)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(executor.submit(func, task))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for task in tasks:
+                pending.append(executor.submit(func, task))
+                break
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
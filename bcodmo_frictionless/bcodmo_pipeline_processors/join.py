@@ -1,17 +1,37 @@
 import re
+import sys
+import math
+import time
+import datetime
+import string
 import copy
+import json
 import os
+import heapq
+import pickle
+import hashlib
+import fcntl
+import shutil
 import logging
+import tempfile
 import warnings
+import weakref
 import collections
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from urllib.parse import urlparse
 
+import boto3
 from kvfile import KVFile
+from tabulator import config
 
 from dataflows import Flow, PackageWrapper, update_resource
 from dataflows.helpers.resource_matcher import ResourceMatcher
 
 from bcodmo_frictionless.bcodmo_pipeline_processors.helper import (
     KVFileBuildProgress,
+    iter_parallel,
 )
 
 
@@ -27,12 +47,112 @@ log = logging.getLogger(__name__)
 # the KVFILE_CACHE_SIZE env var.
 KVFILE_CACHE_SIZE = int(os.environ.get("KVFILE_CACHE_SIZE", 1_000_000))
 
+# Entries of an on-disk join index kept live (unpickled) in memory, most
+# recently used first. The KVFile's own cache holds pickled bytes, so without
+# this every row set on a key would unpickle and pickle its whole entry again,
+# and an accumulating aggregate (array, set, ...) would cost O(n^2) over the
+# rows of its key. Live entries are only written back to the KVFile when they
+# are evicted or the index is read as a whole. Tune with the
+# JOIN_INDEX_LIVE_ENTRIES env var.
+JOIN_INDEX_LIVE_ENTRIES = int(os.environ.get("JOIN_INDEX_LIVE_ENTRIES", 10_000))
+
+# Approximate number of bytes a join index may hold in a plain in-memory dict
+# before it is moved to a KVFile. Most joins index a small metadata resource
+# (a few thousand keys) and never get near this, so they never pay for the
+# KVFile's LRU bookkeeping, SQLite or pickling. Tune with the
+# JOIN_INDEX_MEMORY_BUDGET env var or the join's `index_memory_budget`.
+JOIN_INDEX_MEMORY_BUDGET = int(
+    os.environ.get("JOIN_INDEX_MEMORY_BUDGET", 1024 * 1024 * 1024)
+)
+
+# Join strategies. `hash` indexes the whole source (see JoinIndex) and streams
+# the target against it. `partitioned` hash-partitions both the source and the
+# target to scratch disk and joins each pair of partitions on its own, so only
+# one partition's source has to fit in memory at a time. `merge` streams a
+# source and a target that are both ordered by key side by side, holding one
+# key of the source at a time.
+JOIN_STRATEGIES = ["hash", "partitioned", "merge"]
+
+# Which source value an as-of join matches to a target row's value: the
+# closest at or before it, at or after it, or either
+ASOF_DIRECTIONS = ["backward", "forward", "nearest"]
+
+# The field types an as-of join can match values of, by the kind of value they
+# hold: the source and target as-of fields must hold the same kind
+ASOF_FIELD_TYPES = {
+    "integer": "number",
+    "number": "number",
+    "year": "number",
+    "date": "date",
+    "time": "time",
+    "datetime": "datetime",
+}
+
+# Field name of a key template item ("{depth:05}" -> "depth")
+KEY_NAME_RE = re.compile(r'[^!:\}]+')
+
+# Default number of partitions of a partitioned join
+DEFAULT_JOIN_PARTITIONS = 16
+
+# Records buffered per partition before they are pickled to its file
+PARTITION_BATCH_SIZE = 1000
+
+# Size (bytes) of the read/write buffers of partition files
+PARTITION_FILE_BUFFER_SIZE = 1 << 20
+
+# False positive rate of the Bloom filter built over the keys of an index that
+# spilled to disk, which lets target rows whose key isn't in the index skip the
+# SQLite lookup. Set a join's `bloom_false_positive_rate` to 0 to go without.
+DEFAULT_BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+# Where joins with `index_cache: true` keep the indexes they build, to reuse
+# them in later runs while their source is unchanged. Tune with the
+# JOIN_INDEX_CACHE_DIR env var, or give `index_cache` a directory.
+JOIN_INDEX_CACHE_DIR = os.environ.get(
+    "JOIN_INDEX_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "bcodmo_join_index_cache"),
+)
+
+# Bumped whenever the layout of cached indexes changes
+JOIN_INDEX_CACHE_VERSION = 3
+
+# Cached indexes not used for this long (seconds), and the least recently used
+# ones once the cache holds more than this many bytes, are deleted by the next
+# join that saves an index there. Tune with the JOIN_INDEX_CACHE_MAX_AGE and
+# JOIN_INDEX_CACHE_MAX_BYTES env vars.
+JOIN_INDEX_CACHE_MAX_AGE = int(
+    os.environ.get("JOIN_INDEX_CACHE_MAX_AGE", 7 * 24 * 60 * 60)
+)
+JOIN_INDEX_CACHE_MAX_BYTES = int(
+    os.environ.get("JOIN_INDEX_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+)
+
+# Prefix of the scratch directories of an index cache, which aren't cached
+# indexes themselves
+JOIN_INDEX_CACHE_SCRATCH_PREFIX = "bcodmo_join_index_"
+
+# Source records fingerprinted together by an index cache
+INDEX_CACHE_BATCH_SIZE = 1000
+
+# Percentiles of the source rows per key reported in a join's profile
+PROFILE_FANOUT_PERCENTILES = [50, 90, 99]
+
 
 PROP_STREAMING = "dpp:streaming"
+PROP_STREAMED_FROM = "dpp:streamedFrom"
 
 
 # DB Helper
 class KeyCalc(object):
+    """Computes the join key of a row.
+
+    The key is a tuple of the formatted values of the fields in the key spec,
+    compiled once from the spec: plain `{field}` items are read straight off
+    the row, and the `#` row number, conversions and format specs are only
+    handled when the spec uses them. Two keys are equal when their formatted
+    values are, just like the strings the spec formats to; string() gives
+    that string back, which is also what keys are ordered and stored by.
+    """
 
     def __init__(self, key_spec):
         if isinstance(key_spec, list):
@@ -42,9 +162,1155 @@ class KeyCalc(object):
             key_list = re.findall(r'\{(.*?)\}', key_spec)
         self.key_spec = key_spec
         self.key_list = key_list
+        self.__compile()
 
     def __call__(self, row, row_number):
-        return self.key_spec.format(**{**row, '#': row_number})
+        return self.__calculator(row, row_number)
+
+    def string(self, key):
+        return key_string(self.literals, key)
+
+    def as_string(self):
+        """Makes keys 1-tuples of the whole formatted string, for when the
+        other side of the join has a spec with different literal text.
+        """
+        self.__compile(as_string=True)
+
+    def order(self, row, row_number):
+        """Returns what rows are ordered by in a merge join: the values of the
+        key fields themselves rather than their formatted key, so that 9 comes
+        before 10. Missing values come first.
+        """
+        order = []
+        for name in self.key_names:
+            value = row_number if name == '#' else row.get(name)
+            order.append((0,) if value is None else (1, value))
+        return tuple(order)
+
+    @property
+    def key_names(self):
+        return [KEY_NAME_RE.findall(key)[0] for key in self.key_list]
+
+    # Private
+
+    def __compile(self, as_string=False):
+        items = list(string.Formatter().parse(self.key_spec))
+        fields = [
+            (name, spec, conversion)
+            for _, name, spec, conversion in items
+            if name is not None
+        ]
+        compilable = all(
+            name and not name.isdigit() and not re.search(r'[.\[]', name)
+            and '{' not in spec
+            for name, spec, _ in fields
+        )
+        if as_string or not fields or not compilable:
+            # Positional items, attribute/index lookups and nested specs are
+            # left to str.format over the whole row
+            key_spec = self.key_spec
+            self.literals = ['', '']
+            self.__calculator = lambda row, row_number: (
+                key_spec.format(**{**row, '#': row_number}),
+            )
+            return
+
+        self.literals = [literal for literal, _, _, _ in items]
+        if items[-1][1] is not None:
+            self.literals.append('')
+        names = [name for name, _, _ in fields]
+        if all(name != '#' and not spec and not conversion
+               for name, spec, conversion in fields):
+            if len(names) == 1:
+                name = names[0]
+                self.__calculator = lambda row, row_number: (format(row[name]),)
+            else:
+                getter = itemgetter(*names)
+                self.__calculator = lambda row, row_number: tuple(
+                    map(format, getter(row))
+                )
+            return
+
+        getters = [key_getter(*field) for field in fields]
+        if len(getters) == 1:
+            getter = getters[0]
+            self.__calculator = lambda row, row_number: (getter(row, row_number),)
+        else:
+            self.__calculator = lambda row, row_number: tuple(
+                [getter(row, row_number) for getter in getters]
+            )
+
+
+KEY_CONVERSIONS = {'s': str, 'r': repr, 'a': ascii}
+
+
+def key_getter(name, spec, conversion):
+    # Formats one item of a key spec the way str.format does
+    convert = KEY_CONVERSIONS[conversion] if conversion else None
+    if name == '#' and convert is None:
+        return lambda row, row_number: format(row_number, spec)
+
+    def getter(row, row_number):
+        value = row_number if name == '#' else row[name]
+        if convert is not None:
+            value = convert(value)
+        return format(value, spec)
+    return getter
+
+
+def key_string(literals, key):
+    """Returns the string a key spec formats to, out of its literal text and
+    the formatted values of a key.
+    """
+    parts = [literals[0]]
+    for value, literal in zip(key, literals[1:]):
+        parts.append(value)
+        parts.append(literal)
+    return ''.join(parts)
+
+
+def estimate_size(value):
+    # Shallow estimate of the memory held by an index entry: the object itself
+    # plus, for containers, the objects it holds
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        for item in value:
+            size += sys.getsizeof(item)
+            if isinstance(item, (tuple, list, set, frozenset, dict)):
+                size += sum(sys.getsizeof(i) for i in item)
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(i) for i in value.values())
+    return size
+
+
+class KeyBitmap(object):
+    """A set of dense integer key ids, one bit per id."""
+
+    def __init__(self, size=0):
+        self.bits = bytearray((size + 7) >> 3)
+
+    def add(self, key_id):
+        index = key_id >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytes(index + 1 - len(self.bits)))
+        self.bits[index] |= 1 << (key_id & 7)
+
+    def __contains__(self, key_id):
+        index = key_id >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (key_id & 7)))
+
+
+class BloomFilter(object):
+    """A Bloom filter of `capacity` strings with the given false positive
+    rate. Uses the process's own string hash, so it can't be persisted.
+    """
+
+    def __init__(self, capacity, false_positive_rate):
+        capacity = max(capacity, 1)
+        self.size = max(
+            8,
+            int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)),
+        )
+        self.num_hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) >> 3)
+
+    def __positions(self, string):
+        # Double hashing over the two halves of the 64-bit string hash
+        value = hash(string)
+        first = value & 0xFFFFFFFF
+        second = ((value >> 32) & 0xFFFFFFFF) | 1
+        size = self.size
+        return [(first + i * second) % size for i in range(self.num_hashes)]
+
+    def add(self, string):
+        bits = self.bits
+        for position in self.__positions(string):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, string):
+        bits = self.bits
+        for position in self.__positions(string):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class JoinIndex(object):
+    """Maps join keys to the aggregated source values of each key.
+
+    Entries are tuples (one slot per joined field, in field order) held in a
+    plain dict while the index fits in `memory_budget` bytes. Once it grows
+    past that, every entry is moved to a KVFile, stored under the key's
+    `key_string`, and the index keeps working from disk. `mode` tells which of
+    the two was used.
+
+    On disk each key is also given a dense integer id, stored with its entry,
+    and the keys each target used are tracked as bits of a KeyBitmap rather
+    than as a second KVFile. In memory they are kept in a set of keys. The
+    most recently used on-disk entries are kept live in an LRU of
+    `live_entries` entries that writes them back to the KVFile on eviction,
+    so updating an entry in place doesn't pickle it on every row. Once
+    an on-disk index is built, build_filter() puts its keys in a BloomFilter
+    so that looking up a key that isn't there rarely reaches SQLite.
+
+    The number of source rows set on each key is counted too (in a dict in
+    memory, an array by key id on disk), and profile() sums it all up along
+    with `stats`, the counts of how on-disk lookups went.
+
+    Entries are listed in `key_string` order either way, the order KVFile
+    lists them in.
+    """
+
+    def __init__(self, memory_budget=JOIN_INDEX_MEMORY_BUDGET, key_string=str,
+                 live_entries=JOIN_INDEX_LIVE_ENTRIES):
+        self.memory_budget = memory_budget
+        self.key_string = key_string
+        self.live_entries = max(live_entries, 1)
+        self.size = 0
+        self.num_keys = 0
+        self.__entries = {}
+        # The keys each target has used, by target: keys in memory, key ids
+        # on disk
+        self.__used = collections.defaultdict(set)
+        self.__db = None
+        self.__db_used = collections.defaultdict(KeyBitmap)
+        # Live on-disk entries, by key string: [key id, entry, changed]
+        self.__live = collections.OrderedDict()
+        self.__filter = None
+        # The number of rows set on each key: by key in memory, by id on disk
+        self.__rows = {}
+        self.stats = collections.Counter()
+
+    @property
+    def mode(self):
+        return "memory" if self.__db is None else "disk"
+
+    def get(self, key):
+        """Returns the entry of a key, or None if the key isn't indexed."""
+        if self.__db is None:
+            return self.__entries.get(key)
+        string = self.key_string(key)
+        stats = self.stats
+        if self.__filter is not None:
+            if string not in self.__filter:
+                stats['bloom_filter_misses'] += 1
+                return None
+            stats['bloom_filter_hits'] += 1
+        if string in self.__live or string in self.__db.cache:
+            stats['kvfile_cache_hits'] += 1
+        else:
+            stats['kvfile_cache_misses'] += 1
+        live = self.__load(string)
+        if live is None:
+            if self.__filter is not None:
+                stats['bloom_filter_false_positives'] += 1
+            return None
+        return live[1]
+
+    def build_filter(self, false_positive_rate):
+        """Puts the keys of an on-disk index in a Bloom filter. Call it once
+        the index is built: keys set afterwards aren't added.
+        """
+        if self.__db is None or not false_positive_rate:
+            return
+        self.__flush()
+        bloom_filter = BloomFilter(self.num_keys, false_positive_rate)
+        for string in self.__db.keys():
+            bloom_filter.add(string)
+        self.__filter = bloom_filter
+
+    def set(self, key, value, added_size=None):
+        """Stores the entry of a key. `added_size` is how much an existing
+        entry grew; when it isn't given the key is counted as a new one.
+        """
+        new = added_size is None
+        if new:
+            self.num_keys += 1
+            added_size = estimate_size(key) + estimate_size(value)
+        self.size += added_size
+        if self.__db is None:
+            self.__entries[key] = value
+            rows = self.__rows
+            rows[key] = rows.get(key, 0) + 1
+            if self.size > self.memory_budget:
+                self.__spill()
+            return
+        string = self.key_string(key)
+        if new:
+            self.__rows.append(1)
+            self.__add_live(string, [self.num_keys - 1, value, True])
+            return
+        live = self.__load(string)
+        live[1] = value
+        live[2] = True
+        self.__rows[live[0]] += 1
+
+    def fanout(self):
+        """Returns how many keys have each number of source rows."""
+        rows = self.__rows.values() if self.__db is None else self.__rows
+        return collections.Counter(rows)
+
+    def profile(self):
+        """Returns figures about the index and how it was used."""
+        profile = {
+            'distinct_keys': self.num_keys,
+            'index_mode': self.mode,
+            'index_bytes_in_memory': self.size if self.__db is None else 0,
+            'index_bytes_spilled': 0 if self.__db is None else self.size,
+        }
+        fanout = self.fanout()
+        if fanout:
+            profile['fanout_max'] = max(fanout)
+            for percentile in PROFILE_FANOUT_PERCENTILES:
+                profile['fanout_p%d' % percentile] = counts_percentile(
+                    fanout, percentile
+                )
+        lookups = self.stats['kvfile_cache_hits'] + self.stats['kvfile_cache_misses']
+        if lookups:
+            profile['kvfile_cache_hit_ratio'] = round(
+                self.stats['kvfile_cache_hits'] / lookups, 4
+            )
+        profile.update(self.stats)
+        return profile
+
+    def mark_used(self, key, target=None):
+        if self.__db is None:
+            self.__used[target].add(key)
+        else:
+            self.__db_used[target].add(self.__load(self.key_string(key))[0])
+
+    def values(self):
+        if self.__db is None:
+            entries = self.__entries
+            for key in sorted(entries, key=self.key_string):
+                yield entries[key]
+        else:
+            self.__flush()
+            for _, (_, value) in self.__db.items():
+                yield value
+
+    def unused_values(self, target=None):
+        """Yields the entries of the keys `target` hasn't used."""
+        if self.__db is None:
+            entries = self.__entries
+            used = self.__used[target]
+            for key in sorted(entries, key=self.key_string):
+                if key not in used:
+                    yield entries[key]
+        else:
+            self.__flush()
+            used = self.__db_used[target]
+            for _, (key_id, value) in self.__db.items():
+                if key_id not in used:
+                    yield value
+
+    def save(self, directory):
+        """Writes the index to `directory`, to restore() it in a later run."""
+        if self.__db is None:
+            with open(os.path.join(directory, "index.pickle"), "wb") as f:
+                pickle.dump(
+                    (self.num_keys, self.size, self.__entries, self.__rows),
+                    f,
+                    pickle.HIGHEST_PROTOCOL,
+                )
+            return
+        self.__flush()
+        db = KVFile(location=os.path.join(directory, "index"))
+        db.insert(self.__db.items())
+        db.close()
+        with open(os.path.join(directory, "index-size.pickle"), "wb") as f:
+            pickle.dump(
+                (self.num_keys, self.size, self.__rows), f, pickle.HIGHEST_PROTOCOL
+            )
+
+    def restore(self, directory):
+        """Replaces the index with one save()d to `directory`. An on-disk
+        index is read where it is rather than copied.
+        """
+        self.close()
+        path = os.path.join(directory, "index.pickle")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.num_keys, self.size, self.__entries, self.__rows = pickle.load(f)
+            self.__db = None
+            return
+        with open(os.path.join(directory, "index-size.pickle"), "rb") as f:
+            self.num_keys, self.size, self.__rows = pickle.load(f)
+        self.__db = KVFile(
+            location=os.path.join(directory, "index"), size=KVFILE_CACHE_SIZE
+        )
+
+    def close(self):
+        if self.__db is not None:
+            self.__db.close()
+        self.__entries = {}
+        self.__used = collections.defaultdict(set)
+        self.__db_used = collections.defaultdict(KeyBitmap)
+        self.__live = collections.OrderedDict()
+        self.__filter = None
+        self.__rows = {}
+
+    # Private
+
+    def __load(self, string):
+        # Returns the live [key id, entry, changed] of an on-disk key, or None
+        live = self.__live.get(string)
+        if live is not None:
+            self.__live.move_to_end(string)
+            return live
+        stored = self.__db.get(string, default=None)
+        if stored is None:
+            return None
+        live = [stored[0], stored[1], False]
+        self.__add_live(string, live)
+        return live
+
+    def __add_live(self, string, live):
+        self.__live[string] = live
+        if len(self.__live) > self.live_entries:
+            string, (key_id, value, changed) = self.__live.popitem(last=False)
+            if changed:
+                self.__db.set(string, (key_id, value))
+
+    def __flush(self):
+        # Writes the changed live entries back to the KVFile
+        for string, live in self.__live.items():
+            if live[2]:
+                self.__db.set(string, (live[0], live[1]))
+                live[2] = False
+
+    def __spill(self):
+        log.info(
+            "Join index grew past its %d byte memory budget at %d keys, "
+            "moving it to disk",
+            self.memory_budget,
+            self.num_keys,
+        )
+        key_string = self.key_string
+        ids = {}
+        self.__db = KVFile(size=KVFILE_CACHE_SIZE)
+        self.__db.insert(
+            (key_string(key), (ids.setdefault(key, len(ids)), value))
+            for key, value in self.__entries.items()
+        )
+        for target, used in self.__used.items():
+            bitmap = self.__db_used[target]
+            for key in used:
+                bitmap.add(ids[key])
+        rows = self.__rows
+        self.__rows = array('L', (rows[key] for key in ids))
+        self.__entries = {}
+        self.__used = collections.defaultdict(set)
+
+
+def counts_percentile(counts, percentile):
+    """Returns the percentile (nearest rank) of values given as a Counter of
+    how many times each value occurs.
+    """
+    rank = math.ceil(percentile / 100 * sum(counts.values()))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+
+
+def asof_distance(a, b):
+    """Returns how far apart two values of an as-of field are, as a number:
+    seconds for dates, times and datetimes.
+    """
+    if isinstance(a, float) or isinstance(b, float):
+        # A number field can hold floats or Decimals, which don't subtract
+        a, b = float(a), float(b)
+    elif isinstance(a, datetime.time):
+        a, b = (
+            datetime.timedelta(
+                hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond
+            )
+            for t in (a, b)
+        )
+    distance = abs(a - b)
+    if isinstance(distance, datetime.timedelta):
+        return distance.total_seconds()
+    return distance
+
+
+def asof_field_kind(resource, field_name):
+    """Returns the kind of values the as-of field of a resource holds, or
+    raises if it isn't a field an as-of join can match on.
+    """
+    fields = resource.get('schema', {}).get('fields', [])
+    field = next((f for f in fields if f['name'] == field_name), None)
+    if field is None:
+        raise Exception(
+            'The as-of field %s was not found in resource %s'
+            % (field_name, resource['name'])
+        )
+    kind = ASOF_FIELD_TYPES.get(field.get('type'))
+    if kind is None:
+        raise Exception(
+            'The as-of field %s of resource %s is of type %s, but as-of joins '
+            'need one of %s: use set_types to type it first'
+            % (field_name, resource['name'], field.get('type'),
+               ', '.join(ASOF_FIELD_TYPES))
+        )
+    return kind
+
+
+class AsOfIndex(object):
+    """The source entries of an as-of join. Entries are grouped by their exact
+    ("by") key, one per value of the as-of field, and each group is sorted by
+    that value once the source is read, so the entry matching a target row is
+    found by binary search. Values must be of one comparable type, and None
+    values are left out by the caller.
+
+    Entries are held in memory. As in JoinIndex, the entries each target used
+    are tracked so full-outer joins can emit the others.
+    """
+
+    def __init__(self, direction, tolerance=None, key_string=str):
+        assert direction in ASOF_DIRECTIONS, \
+            'Unknown as-of direction {}, expected one of {}'.format(direction, ASOF_DIRECTIONS)
+        self.direction = direction
+        self.tolerance = tolerance
+        self.key_string = key_string
+        self.num_keys = 0
+        self.__groups = {}
+        self.__used = collections.defaultdict(set)
+
+    def get(self, key, value):
+        return self.__groups.get(key, {}).get(value)
+
+    def set(self, key, value, entry):
+        group = self.__groups.setdefault(key, {})
+        if value not in group:
+            self.num_keys += 1
+        group[value] = entry
+
+    def finish(self):
+        """Sorts each group by value. Call it once every entry is set."""
+        for key, group in self.__groups.items():
+            values = sorted(group)
+            self.__groups[key] = (values, [group[value] for value in values])
+
+    def find(self, key, value):
+        """Returns the position in its group of the entry matching a key and
+        as-of value, or None.
+        """
+        group = self.__groups.get(key)
+        if group is None or value is None:
+            return None
+        values = group[0]
+        candidates = []
+        if self.direction != 'forward':
+            position = bisect_right(values, value) - 1
+            if position >= 0:
+                candidates.append(position)
+        if self.direction != 'backward':
+            position = bisect_left(values, value)
+            if position < len(values):
+                candidates.append(position)
+        match = None
+        for position in candidates:
+            distance = asof_distance(values[position], value)
+            if self.tolerance is not None and distance > self.tolerance:
+                continue
+            # Ties of a nearest join go to the earlier value
+            if match is None or distance < match[0]:
+                match = (distance, position)
+        return match[1] if match is not None else None
+
+    def entry(self, key, position):
+        return self.__groups[key][1][position]
+
+    def mark_used(self, key, position, target=None):
+        self.__used[target].add((key, position))
+
+    def unused_values(self, target=None):
+        used = self.__used[target]
+        for key in sorted(self.__groups, key=self.key_string):
+            for position, entry in enumerate(self.__groups[key][1]):
+                if (key, position) not in used:
+                    yield entry
+
+    def close(self):
+        self.__groups = {}
+        self.__used = collections.defaultdict(set)
+
+
+class PartitionWriter(object):
+    """Appends records to `count` partition files under `directory`, pickled a
+    batch at a time. Read a partition back with iter_partition.
+    """
+
+    def __init__(self, directory, name, count):
+        self.paths = [
+            os.path.join(directory, "%s-%d.pickle" % (name, i)) for i in range(count)
+        ]
+        self.__files = [
+            open(path, "wb", buffering=PARTITION_FILE_BUFFER_SIZE)
+            for path in self.paths
+        ]
+        self.__batches = [[] for _ in range(count)]
+
+    def write(self, partition, record):
+        batch = self.__batches[partition]
+        batch.append(record)
+        if len(batch) >= PARTITION_BATCH_SIZE:
+            pickle.dump(batch, self.__files[partition], pickle.HIGHEST_PROTOCOL)
+            batch.clear()
+
+    def close(self):
+        for f, batch in zip(self.__files, self.__batches):
+            if batch:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                batch.clear()
+            f.close()
+
+
+def write_partition(path, records):
+    with open(path, "wb", buffering=PARTITION_FILE_BUFFER_SIZE) as f:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= PARTITION_BATCH_SIZE:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+
+def iter_batches(path):
+    with open(path, "rb", buffering=PARTITION_FILE_BUFFER_SIZE) as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def iter_partition(path):
+    for batch in iter_batches(path):
+        yield from batch
+
+
+class JoinIndexCache(object):
+    """A join index kept in `directory` by an earlier run, reused for as long
+    as the source it was built from is unchanged.
+
+    Indexes are stored by a fingerprint of the join's `spec` (source, key and
+    fields) and `source_id`, which tells the source's data apart without
+    reading it (see source_identity). Such an index is either `cached` or not,
+    and the source rows only pass through when it is. Without a `source_id`
+    the source is told apart by its records instead: feed them to add() a
+    batch at a time, and while every batch matches the digests stored with
+    the cached index nothing needs indexing; when one doesn't (or the source
+    turns out shorter or longer) the batches of this run up to it are handed
+    back to index along with the new one. Those are kept in memory (up to
+    `memory_budget` bytes, then in a scratch file) only while they're being
+    checked. Either way finish() tells whether the cached index can be
+    restore()d from `path`; otherwise save() publishes the index just built.
+
+    A run holds a shared lock on the index it reads until close(), and an
+    index is only replaced or deleted (unused for JOIN_INDEX_CACHE_MAX_AGE or
+    past JOIN_INDEX_CACHE_MAX_BYTES in total) by a run that can lock it
+    exclusively, so an index read in place by another run is never removed
+    under it.
+    """
+
+    def __init__(self, directory, spec, source_id=None,
+                 memory_budget=JOIN_INDEX_MEMORY_BUDGET):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.source_id = source_id
+        self.fingerprint = hashlib.sha256(
+            repr((JOIN_INDEX_CACHE_VERSION, spec, source_id)).encode("utf-8")
+        ).hexdigest()
+        self.memory_budget = memory_budget
+        self.path = None
+        self.digests = None
+        self.__lock = None
+        self.__open()
+        self.verifying = self.cached
+        self.__new_digests = []
+        # This run's batches, pickled, while they're being checked
+        self.__checked = []
+        self.__checked_size = 0
+        self.__spool = None
+        self.__scratch = None
+        self._finalizer = None
+
+    @property
+    def cached(self):
+        return self.path is not None
+
+    def add(self, batch):
+        """Returns the batches that now need indexing. Only for a source
+        without a `source_id`.
+        """
+        data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+        position = len(self.__new_digests)
+        self.__new_digests.append(digest)
+        if self.verifying:
+            if position < len(self.digests) and self.digests[position] == digest:
+                self.__keep(data)
+                return []
+            self.verifying = False
+            return self.__mismatch([batch])
+        return [batch]
+
+    def finish(self):
+        """Returns whether the cached index can be reused, and the batches
+        that need indexing otherwise.
+        """
+        if self.verifying and (
+            self.source_id is not None
+            or len(self.__new_digests) == len(self.digests)
+        ):
+            self.__drop_checked()
+            os.utime(self.path)  # marks the index as recently used
+            return True, []
+        if self.verifying:
+            self.verifying = False
+            return False, self.__mismatch([])
+        return False, []
+
+    def save(self, index):
+        self.__drop_checked()
+        self.__release()
+        scratch = self.__open_scratch()
+        index.save(scratch)
+        if self.source_id is None:
+            with open(os.path.join(scratch, "digests.pickle"), "wb") as f:
+                pickle.dump(self.__new_digests, f, pickle.HIGHEST_PROTOCOL)
+        open(os.path.join(scratch, "lock"), "w").close()
+        path = os.path.join(self.directory, self.fingerprint)
+        # Replaces the index of a changed source, unless a run still reads it
+        # (or another run published first): this one is dropped then
+        if not os.path.exists(path) or remove_entry(path):
+            try:
+                os.rename(scratch, path)
+                self._finalizer.detach()
+            except OSError:
+                pass
+        self._finalizer()
+        self.__scratch = self._finalizer = None
+        self.evict()
+
+    def evict(self):
+        """Deletes the indexes no run is reading that are too old, or the
+        least recently used past the cache's size limit.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(JOIN_INDEX_CACHE_SCRATCH_PREFIX):
+                # Left behind by a run that was killed
+                if now - os.path.getmtime(path) > JOIN_INDEX_CACHE_MAX_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            entries.append(path)
+        total = 0
+        for path in sorted(entries, key=os.path.getmtime, reverse=True):
+            size = directory_size(path)
+            if now - os.path.getmtime(path) > JOIN_INDEX_CACHE_MAX_AGE or (
+                total + size > JOIN_INDEX_CACHE_MAX_BYTES
+            ):
+                if remove_entry(path):
+                    continue
+            total += size
+
+    def close(self):
+        self.__drop_checked()
+        self.__release()
+        if self._finalizer is not None:
+            self._finalizer()
+            self.__scratch = self._finalizer = None
+
+    # Private
+
+    def __open(self):
+        # Takes a shared lock on the cached index of the fingerprint, and
+        # reads its digests when the source is told apart by them
+        path = os.path.join(self.directory, self.fingerprint)
+        try:
+            lock = open(os.path.join(path, "lock"), "rb")
+        except OSError:
+            return
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            if os.fstat(lock.fileno()).st_ino != os.stat(
+                os.path.join(path, "lock")
+            ).st_ino:
+                raise OSError("replaced before the lock was taken")
+            if self.source_id is None:
+                with open(os.path.join(path, "digests.pickle"), "rb") as f:
+                    self.digests = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            lock.close()
+            self.digests = None
+            return
+        self.path = path
+        self.__lock = lock
+
+    def __keep(self, data):
+        if self.__spool is None and (
+            self.__checked_size + len(data) <= self.memory_budget
+        ):
+            self.__checked.append(data)
+            self.__checked_size += len(data)
+            return
+        if self.__spool is None:
+            self.__spool = open(
+                os.path.join(self.__open_scratch(), "checked.pickle"),
+                "w+b",
+                buffering=PARTITION_FILE_BUFFER_SIZE,
+            )
+        self.__spool.write(data)
+
+    def __iter_checked(self):
+        for data in self.__checked:
+            yield pickle.loads(data)
+        if self.__spool is not None:
+            self.__spool.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self.__spool)
+                except EOFError:
+                    return
+
+    def __drop_checked(self):
+        self.__checked = []
+        self.__checked_size = 0
+        if self.__spool is not None:
+            self.__spool.close()
+            os.unlink(self.__spool.name)
+            self.__spool = None
+
+    def __open_scratch(self):
+        if self.__scratch is None:
+            self.__scratch = tempfile.mkdtemp(
+                prefix=JOIN_INDEX_CACHE_SCRATCH_PREFIX, dir=self.directory
+            )
+            # Backstop: remove a half-written cache entry if the join is
+            # abandoned
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, self.__scratch, True
+            )
+        return self.__scratch
+
+    def __release(self):
+        if self.__lock is not None:
+            self.__lock.close()
+            self.__lock = None
+
+    def __mismatch(self, batches):
+        # The batches checked so far matched the cache but the cached index
+        # can't be used: index them now, as the source rows are gone by now
+        self.__release()
+        yield from self.__iter_checked()
+        self.__drop_checked()
+        yield from batches
+
+
+def source_identity(descriptor):
+    """Returns what tells the data of a resource apart without reading it:
+    the file it was loaded from (`dpp:streamedFrom`) with its size and
+    modification time, or its S3 ETag, along with the resource's descriptor.
+    Returns None when the resource doesn't come straight from such a file.
+    """
+    url = descriptor.get(PROP_STREAMED_FROM)
+    if not isinstance(url, str):
+        return None
+    parts = urlparse(url, allow_fragments=False)
+    try:
+        if parts.scheme == "s3":
+            s3_client = boto3.client(
+                "s3",
+                endpoint_url=os.environ.get("S3_ENDPOINT_URL")
+                or config.S3_DEFAULT_ENDPOINT_URL,
+            )
+            head = s3_client.head_object(Bucket=parts.netloc, Key=parts.path[1:])
+            stamp = (head["ETag"], head["ContentLength"])
+        elif parts.scheme in ("", "file"):
+            stat = os.stat(url[len("file://"):] if parts.scheme else url)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+        else:
+            return None
+    except Exception:
+        return None
+    return url, stamp, json.dumps(descriptor, sort_keys=True, default=str)
+
+
+def remove_entry(path):
+    """Deletes a cached join index unless a run is reading it. Returns
+    whether it was deleted.
+    """
+    try:
+        lock = open(os.path.join(path, "lock"), "rb")
+    except OSError:
+        return False
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        # Moved away first, so a run that opens it from now on can tell it's
+        # gone once it has the lock
+        trash = tempfile.mkdtemp(
+            prefix=JOIN_INDEX_CACHE_SCRATCH_PREFIX, dir=os.path.dirname(path)
+        )
+        try:
+            os.rename(path, os.path.join(trash, "index"))
+        except OSError:
+            shutil.rmtree(trash, ignore_errors=True)
+            return False
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def update_entry(current, inputs, funcs, key_values=None):
+    """Returns the index entry of a key after aggregating one more source row
+    (its `inputs`, one per joined field) into `current`.
+    """
+    values = list(current[:len(funcs)]) if current is not None else [None] * len(funcs)
+    for i, (func, new) in enumerate(zip(funcs, inputs)):
+        if new is not None:
+            values[i] = func(values[i], new)
+    if key_values is not None:
+        values.append(key_values)
+    return tuple(values)
+
+
+def finalise_entry(value, field_names, aggregates, key_list=None):
+    """Returns the joined values of an index entry. With a `key_list` (full
+    outer joins) the source values of the key are set on those fields.
+    """
+    extra = dict(
+        (name, AGGREGATORS[agg].finaliser(v))
+        for name, agg, v in zip(field_names, aggregates, value)
+    )
+    if key_list is not None:
+        key = value[len(field_names)]
+        if key:
+            for k, v in zip(key_list, key):
+                extra[k] = v
+    return extra
+
+
+def join_partition(task):
+    """Joins one partition of a partitioned join, in a worker process.
+
+    Builds the index of the partition's source records, then writes each of
+    its target records, joined, to the output file as (sequence number, row).
+    Keys left unmatched in full outer mode (or every key when deduplicating)
+    are written to the leftovers file as (key string, row), in that order.
+    """
+    (source_path, target_path, output_path, leftovers_path,
+     field_names, aggregates, mode, key_list, key_literals) = task
+    funcs = [AGGREGATORS[agg].func for agg in aggregates]
+    index = {}
+    for key, inputs, key_values in iter_partition(source_path):
+        index[key] = update_entry(index.get(key), inputs, funcs, key_values)
+
+    used = set()
+
+    def joined_rows():
+        for sequence, key, row in iter_partition(target_path):
+            value = index.get(key)
+            if value is not None:
+                extra = finalise_entry(value, field_names, aggregates, key_list)
+                if mode == 'full-outer':
+                    used.add(key)
+            else:
+                if mode == 'inner':
+                    continue
+                extra = dict((k, row.get(k)) for k in field_names)
+            row.update(extra)
+            yield sequence, row
+
+    if target_path is not None:
+        write_partition(output_path, joined_rows())
+    leftovers = []
+    if target_path is None or mode == 'full-outer':
+        leftovers = sorted(
+            (key_string(key_literals, key), key)
+            for key in index
+            if key not in used
+        )
+    write_partition(leftovers_path, (
+        (string, finalise_entry(index[key], field_names, aggregates, key_list))
+        for string, key in leftovers
+    ))
+    return output_path, leftovers_path
+
+
+class PartitionedJoin(object):
+    """Runs a join by hash-partitioning the source and target records to
+    scratch disk and joining each partition pair in a pool of `workers`
+    processes.
+
+    Target rows come back in their original order (each carries its sequence
+    number through its partition), and leftover keys in sorted key order, as
+    with the hash strategy.
+    """
+
+    def __init__(self, partitions, workers):
+        self.partitions = partitions
+        self.workers = workers
+        self.path = tempfile.mkdtemp(prefix="bcodmo_join_")
+        # Backstop: remove the scratch files even if the join is abandoned
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+        self.source = PartitionWriter(self.path, "source", partitions)
+        self.target = None
+
+    def partition(self, key):
+        return hash(key) % self.partitions
+
+    def add_source(self, key, inputs, key_values=None):
+        self.source.write(self.partition(key), (key, inputs, key_values))
+
+    def add_target(self, sequence, key, row):
+        if self.target is None:
+            self.target = PartitionWriter(self.path, "target", self.partitions)
+        self.target.write(self.partition(key), (sequence, key, row))
+
+    def run(self, field_names, aggregates, mode, key_list, key_literals,
+            deduplication):
+        """Yields the joined target rows, then the leftover rows."""
+        self.source.close()
+        if self.target is not None:
+            self.target.close()
+        tasks = [
+            (
+                self.source.paths[i],
+                None if deduplication else self.__target_path(i),
+                os.path.join(self.path, "output-%d.pickle" % i),
+                os.path.join(self.path, "leftovers-%d.pickle" % i),
+                field_names,
+                aggregates,
+                mode,
+                key_list,
+                key_literals,
+            )
+            for i in range(self.partitions)
+        ]
+        if self.workers > 1:
+            results = list(iter_parallel(join_partition, tasks, self.workers))
+        else:
+            results = [join_partition(task) for task in tasks]
+
+        if not deduplication:
+            rows = heapq.merge(
+                *[iter_partition(output_path) for output_path, _ in results],
+                key=itemgetter(0),
+            )
+            for _, row in rows:
+                yield row
+        leftovers = heapq.merge(
+            *[iter_partition(leftovers_path) for _, leftovers_path in results],
+            key=itemgetter(0),
+        )
+        for _, row in leftovers:
+            yield row
+
+    def close(self):
+        self._finalizer()
+
+    # Private
+
+    def __target_path(self, partition):
+        if self.target is None:
+            # No target rows at all: an empty partition file
+            path = os.path.join(self.path, "target-%d.pickle" % partition)
+            write_partition(path, [])
+            return path
+        return self.target.paths[partition]
+
+
+class MergeGroups(object):
+    """Folds source rows ordered by key into one index entry per key, for a
+    merge join. add() returns the group of the previous key once a row with a
+    new key comes in, and finish() the last one. A group is a list of
+    [order, key, entry, used].
+    """
+
+    def __init__(self, key_calc, inputs, funcs, key_values=None):
+        self.key_calc = key_calc
+        self.inputs = inputs
+        self.funcs = funcs
+        self.key_values = key_values
+        self.__group = None
+
+    def add(self, row, row_number):
+        key = self.key_calc(row, row_number)
+        group = self.__group
+        finished = None
+        if group is None or group[1] != key:
+            order = self.key_calc.order(row, row_number)
+            if group is not None:
+                check_merge_order(
+                    group[0],
+                    order,
+                    self.key_calc.string(group[1]),
+                    self.key_calc.string(key),
+                    'source',
+                )
+            finished = group
+            group = self.__group = [order, key, None, False]
+        key_values = self.key_values(row) if self.key_values is not None else None
+        group[2] = update_entry(group[2], self.inputs(row), self.funcs, key_values)
+        return finished
+
+    def finish(self):
+        group, self.__group = self.__group, None
+        return group
+
+
+def check_merge_order(previous, order, previous_key, key, side):
+    try:
+        in_order = not order < previous
+    except TypeError:
+        in_order = False
+    if not in_order:
+        raise Exception(
+            'The merge join strategy needs the {} resource ordered by key, but '
+            'key "{}" comes after key "{}". Sort the resource by its join key '
+            'first, or use the hash strategy.'.format(side, key, previous_key)
+        )
+
+
+def merge_key_before(source_order, target_order, source_key, target_key):
+    """Tells whether a source key comes before a target key in a merge join,
+    failing clearly when their values can't be compared (10 against "10").
+    The keys are (key calc, key) pairs, only formatted for the error.
+    """
+    try:
+        return source_order < target_order
+    except TypeError:
+        source_key = source_key[0].string(source_key[1])
+        target_key = target_key[0].string(target_key[1])
+        raise Exception(
+            'The merge join strategy needs source and target keys of the same '
+            'type to compare them, but source key "{}" and target key "{}" '
+            "can't be compared. Give the key fields the same type in both "
+            'resources (with set_types), or use the hash strategy.'.format(
+                source_key, target_key
+            )
+        )
 
 
 # Aggregator helpers
@@ -52,11 +1318,31 @@ def identity(x):
     return x
 
 
+# Accumulating aggregates update their state in place, so each source row costs
+# O(1) however many rows its key already has (building a new list or set per
+# row made a key with n rows cost O(n^2)). On disk, a JoinIndex keeps the
+# entries it's updating live in memory and only pickles them once they're
+# evicted from its LRU of live entries (see JOIN_INDEX_LIVE_ENTRIES).
+def append_value(curr, new):
+    if curr is None:
+        return [new]
+    curr.append(new)
+    return curr
+
+
+def add_value(curr, new):
+    if curr is None:
+        return {new}
+    curr.add(new)
+    return curr
+
+
 def median(values):
     if values is None:
         return None
     ll = len(values)
     mid = int(ll/2)
+    # Sorted once, when the entry is finalised, rather than as values come in
     values = sorted(values)
     if ll % 2 == 0:
         return (values[mid - 1] + values[mid])/2
@@ -77,6 +1363,9 @@ def update_counter(curr, new):
     return curr
 
 
+# Aggregates whose state grows with every source row of a key
+ACCUMULATING_AGGREGATES = {'median', 'set', 'array', 'counters'}
+
 # Aggregators
 Aggregator = collections.namedtuple('Aggregator',
                                     ['func', 'finaliser', 'dataType', 'copyProperties'])
@@ -93,8 +1382,7 @@ AGGREGATORS = {
                       lambda value: value[1] / value[0],
                       None,
                       False),
-    'median': Aggregator(lambda curr, new:
-                         curr + [new] if curr is not None else [new],
+    'median': Aggregator(append_value,
                          median,
                          None,
                          True),
@@ -126,14 +1414,14 @@ AGGREGATORS = {
                       identity,
                       None,
                       True),
-    'set': Aggregator(lambda curr, new:
-                      curr.union({new}) if curr is not None else {new},
+    'set': Aggregator(add_value,
                       lambda value: list(value) if value is not None else [],
                       'array',
                       False),
-    'array': Aggregator(lambda curr, new:
-                        curr + [new] if curr is not None else [new],
-                        lambda value: value if value is not None else [],
+    'array': Aggregator(append_value,
+                        # A copy: the list is accumulated in place and shared
+                        # by every target row with the key
+                        lambda value: list(value) if value is not None else [],
                         'array',
                         False),
     'counters': Aggregator(lambda curr, new:
@@ -212,17 +1500,50 @@ def load_lazy_json(resources):
 
 
 def join_aux(source_name, source_key, source_delete,  # noqa: C901
-             target_name, target_key, fields, full, mode, cache_id=None):
+             target_name, target_key, fields, full, mode, cache_id=None,
+             index_memory_budget=None, strategy='hash', partitions=None,
+             partition_workers=None, index_cache=None,
+             bloom_false_positive_rate=DEFAULT_BLOOM_FALSE_POSITIVE_RATE,
+             asof=None):
 
-    deduplication = target_key is None
+    # Several targets can be given as lists of names and keys, all joined
+    # against the same index
+    if isinstance(target_name, list):
+        target_names, target_key_specs = target_name, target_key
+    else:
+        target_names, target_key_specs = [target_name], [target_key]
+    assert len(target_names) == len(target_key_specs) > 0, \
+        'Expected a key for each target resource, got {} and {}'.format(target_names, target_key_specs)
+    deduplication = target_key_specs[0] is None
     fields = fix_fields(fields)
     source_key = KeyCalc(source_key)
-    target_key = KeyCalc(target_key) if target_key is not None else target_key
-    # We will store db keys as boolean flags:
-    # - False -> inserted/not used
-    # - True -> inserted/used
-    db_keys_usage = KVFile(size=KVFILE_CACHE_SIZE)
-    db = KVFile(size=KVFILE_CACHE_SIZE)
+    target_keys = collections.OrderedDict(
+        (name, KeyCalc(spec) if spec is not None else None)
+        for name, spec in zip(target_names, target_key_specs)
+    )
+    if len(target_keys) > 1:
+        assert not deduplication and None not in target_key_specs, \
+            'Every target of a join with several targets needs a key'
+        assert strategy == 'hash', \
+            'Only the hash strategy can join several targets'
+    if any(key.literals != source_key.literals
+           for key in target_keys.values() if key is not None):
+        # Keys with different text around their fields only match as strings
+        source_key.as_string()
+        for key in target_keys.values():
+            key.as_string()
+    # The partitioned and merge strategies join a single target
+    target_name = target_names[0]
+    target_key = target_keys[target_name]
+    # Each key's aggregated values, as a tuple in `fields` order (followed by
+    # the key's source values in full-outer mode). Keys matched by a target
+    # row are marked used, so full-outer mode can emit the others.
+    index = JoinIndex(
+        index_memory_budget
+        if index_memory_budget is not None
+        else JOIN_INDEX_MEMORY_BUDGET,
+        source_key.string,
+    )
 
     # Mode of join operation
     if full is not None:
@@ -232,64 +1553,273 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
             UserWarning)
         mode = 'half-outer' if full else 'inner'
     assert mode in ['inner', 'half-outer', 'full-outer']
+    assert strategy in JOIN_STRATEGIES, \
+        'Unknown join strategy {}, expected one of {}'.format(strategy, JOIN_STRATEGIES)
+    partitioned = None
+    if strategy == 'partitioned':
+        partitioned = PartitionedJoin(
+            partitions or DEFAULT_JOIN_PARTITIONS,
+            partition_workers or os.cpu_count() or 1,
+        )
+    # The index cache of the join, which keeps the cached index it reuses from
+    # being deleted until the join is done
+    cached_index = None
+    # An as-of join matches the entry of the closest as-of field value among
+    # the source rows with the same key
+    asof_index = None
+    if asof is not None:
+        assert strategy == 'hash' and not deduplication, \
+            'As-of joins need a target key and the hash strategy'
+        asof_index = AsOfIndex(
+            asof.get('direction', 'backward'),
+            asof.get('tolerance'),
+            source_key.string,
+        )
+    merge_groups = collections.deque()
+    merge_source = None
+    # The progress of the index build, which also gets the join's profile
+    build_progress = None
+    # Figures about the join, logged and published as each target is done:
+    # about the source index, and about each target by name
+    profile = collections.Counter(strategy=strategy, mode=mode)
+    target_profiles = collections.defaultdict(collections.Counter)
+    # The target fields to set the key's source values on, in full-outer mode
+    key_lists = dict(
+        (name, key.key_list if mode == 'full-outer' and not deduplication else None)
+        for name, key in target_keys.items()
+    )
+    if asof is not None and mode == 'full-outer':
+        # and the as-of value too
+        for name, key in target_keys.items():
+            key_lists[name] = key.key_list + [asof['target_field']]
+    key_list = key_lists[target_name]
+
+    # The error of as-of values that can't be compared, as when the data
+    # doesn't match the types of the as-of fields
+    def asof_type_error():
+        return Exception(
+            'The as-of fields {} and {} hold values that can\'t be compared with '
+            'each other. Give both fields one of the types {} (with set_types) '
+            'so they hold values of one type.'.format(
+                asof['source_field'], asof['target_field'], ', '.join(ASOF_FIELD_TYPES)
+            )
+        )
+
+    # The values of a source row to aggregate, one per field in `fields` order
+    def source_inputs(row):
+        return tuple(
+            row.get(spec['name']) if spec['aggregate'] != 'count' else ''
+            for spec in fields.values()
+        )
+
+    # The source values of a row's key, kept for full-outer mode
+    def source_key_values(row):
+        return [row.get(field) for field in source_key.key_list]
+
+    # Groups the rows of an ordered source into one entry per key
+    def merge_grouper():
+        return MergeGroups(
+            source_key,
+            source_inputs,
+            [AGGREGATORS[spec['aggregate']].func for spec in fields.values()],
+            source_key_values if mode == 'full-outer' else None,
+        )
+
+    # Passes the source rows on while grouping them, when the source is kept
+    def merge_indexer(resource):
+        grouper = merge_grouper()
+        for row_number, row in enumerate(resource, start=1):
+            profile['source_rows'] = row_number
+            group = grouper.add(row, row_number)
+            if group is not None:
+                merge_groups.append(group)
+            yield row
+        group = grouper.finish()
+        if group is not None:
+            merge_groups.append(group)
+
+    # Yields the groups of the source, reading it as they are needed when it
+    # is deleted (and so not consumed by anything else)
+    def iter_merge_groups():
+        if merge_source is None:
+            while merge_groups:
+                yield merge_groups.popleft()
+            return
+        grouper = merge_grouper()
+        for row_number, row in enumerate(merge_source, start=1):
+            profile['source_rows'] = row_number
+            group = grouper.add(row, row_number)
+            if group is not None:
+                yield group
+        group = grouper.finish()
+        if group is not None:
+            yield group
 
     # Indexes the source data
     def indexer(resource):
         # Building the index for a join is a blocking step: the entire source
-        # resource is drained into the KVFile before any target rows can flow
+        # resource is drained into the index before any target rows can flow
         # downstream. While that happens no other processor reports progress, so
         # we publish the number of distinct keys built so far to redis. The front
         # end reads this to show the join "building up" (and that it's alive).
-        num_keys = 0
-        progress = KVFileBuildProgress(cache_id, source_name, "join")
-        for row_number, row in enumerate(resource, start=1):
-            key = source_key(row, row_number)
+        nonlocal build_progress, cached_index
+        progress = build_progress = KVFileBuildProgress(cache_id, source_name, "join")
+        start = time.time()
+        if partitioned is not None:
+            # Keys are only told apart per partition, later on, so report the
+            # number of source rows partitioned so far instead
+            for row_number, row in enumerate(resource, start=1):
+                profile['source_rows'] = row_number
+                key_values = None
+                if mode == 'full-outer':
+                    key_values = [row.get(field) for field in source_key.key_list]
+                partitioned.add_source(
+                    source_key(row, row_number), source_inputs(row), key_values
+                )
+                progress.update(row_number)
+                yield row
+            profile['build_seconds'] += time.time() - start
+            progress.finish()
+            return
+
+        funcs = [AGGREGATORS[spec['aggregate']].func for spec in fields.values()]
+        if asof_index is not None:
+            for row_number, row in enumerate(resource, start=1):
+                profile['source_rows'] = row_number
+                value = row.get(asof['source_field'])
+                # Rows without an as-of value can't match anything
+                if value is not None:
+                    key = source_key(row, row_number)
+                    key_values = None
+                    if mode == 'full-outer':
+                        key_values = source_key_values(row) + [value]
+                    asof_index.set(key, value, update_entry(
+                        asof_index.get(key, value), source_inputs(row), funcs, key_values
+                    ))
+                progress.update(asof_index.num_keys)
+                yield row
             try:
-                current = db.get(key)
-            except KeyError:
-                current = {}
-                num_keys += 1
-            for field, spec in fields.items():
-                name = spec['name']
-                curr = current.get(field)
-                agg = spec['aggregate']
-                if agg != 'count':
-                    new = row.get(name)
-                else:
-                    new = ''
-                if new is not None:
-                    current[field] = AGGREGATORS[agg].func(curr, new)
-                elif field not in current:
-                    current[field] = None
+                asof_index.finish()
+            except TypeError:
+                raise asof_type_error()
+            profile['build_seconds'] += time.time() - start
+            progress.finish()
+            return
+
+        accumulating = [
+            spec['aggregate'] in ACCUMULATING_AGGREGATES for spec in fields.values()
+        ]
+
+        def index_record(key, inputs, key_values):
+            current = index.get(key)
+            added_size = None
+            if current is not None:
+                added_size = sum(
+                    sys.getsizeof(new) + 8
+                    for new, grows in zip(inputs, accumulating)
+                    if grows and new is not None
+                )
+            index.set(key, update_entry(current, inputs, funcs, key_values), added_size)
+
+        def index_batches(batches):
+            for batch in batches:
+                for record in batch:
+                    index_record(*record)
+
+        cache = None
+        if index_cache:
+            cache = cached_index = JoinIndexCache(
+                index_cache if isinstance(index_cache, str) else JOIN_INDEX_CACHE_DIR,
+                (
+                    source_name,
+                    source_key.key_spec,
+                    source_key.literals,
+                    [(k, spec['name'], spec['aggregate']) for k, spec in fields.items()],
+                    mode == 'full-outer',
+                ),
+                source_identity(resource.res.descriptor),
+                index.memory_budget,
+            )
+            # While the source matches the cached one, report the number of
+            # source rows read instead
+            progress.set_cached(cache.cached)
+        # A source told apart by the file it was loaded from is either
+        # unchanged, and its rows only pass through, or indexed as usual; any
+        # other is checked against the cached one by its records
+        reusing = cache is not None and cache.source_id is not None and cache.cached
+        checking = cache is not None and cache.source_id is None
+        batch = []
+        for row_number, row in enumerate(resource, start=1):
+            profile['source_rows'] = row_number
+            if reusing:
+                progress.update(row_number)
+                yield row
+                continue
+            key_values = None
             if mode == 'full-outer':
-                current['__key__'] = [row.get(field) for field in source_key.key_list]
-            db.set(key, current)
-            db_keys_usage.set(key, False)
-            progress.update(num_keys)
+                key_values = [row.get(field) for field in source_key.key_list]
+            record = (source_key(row, row_number), source_inputs(row), key_values)
+            if not checking:
+                index_record(*record)
+            else:
+                batch.append(record)
+                if len(batch) >= INDEX_CACHE_BATCH_SIZE:
+                    verifying = cache.verifying
+                    index_batches(cache.add(batch))
+                    batch = []
+                    if verifying and not cache.verifying:
+                        progress.set_cached(False)
+            progress.update(
+                row_number if cache is not None and cache.verifying else index.num_keys
+            )
             yield row
+        if cache is not None:
+            if batch:
+                index_batches(cache.add(batch))
+            hit, batches = cache.finish()
+            index_batches(batches)
+            if hit:
+                index.restore(cache.path)
+                log.info("Reusing the cached join index of %s", source_name)
+            else:
+                cache.save(index)
+        index.build_filter(bloom_false_positive_rate)
+        profile['build_seconds'] += time.time() - start
         progress.finish()
+        log.info(
+            "Join index of %s: %d keys held in %s",
+            source_name,
+            index.num_keys,
+            index.mode,
+        )
 
     # Generates the joined data
-    def process_target(resource):
-        if deduplication:
+    def process_target(resource, name=target_name):
+        counts = target_profiles[name]
+        if partitioned is not None:
+            yield from process_target_partitioned(resource, counts)
+        elif strategy == 'merge':
+            yield from process_target_merge(resource, counts)
+        elif asof_index is not None:
+            yield from process_target_asof(resource, name, counts)
+        elif deduplication:
             # just empty the iterable
             collections.deque(indexer(resource), maxlen=0)
-            for key, value in db.items():
-                row = dict(
-                    (f, None) for f in fields.keys()
-                )
-                row.update(dict(
-                    (k, AGGREGATORS[fields[k]['aggregate']].finaliser(v))
-                    for k, v in value.items()
-                ))
-                yield row
+            for value in index.values():
+                yield create_extra(value)
         else:
+            start = time.time()
+            key_calc = target_keys[name]
             for row_number, row in enumerate(resource, start=1):
-                key = target_key(row, row_number)
-                try:
-                    extra = create_extra_by_key(key)
-                    db_keys_usage.set(key, True)
-                except KeyError:
+                counts['target_rows'] += 1
+                key = key_calc(row, row_number)
+                value = index.get(key)
+                if value is not None:
+                    counts['matched_rows'] += 1
+                    extra = create_extra(value, name)
+                    if mode == 'full-outer':
+                        index.mark_used(key, name)
+                else:
                     if mode == 'inner':
                         continue
                     extra = dict(
@@ -299,42 +1829,190 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
                 row.update(extra)
                 yield row
             if mode == 'full-outer':
-                for key, value in db_keys_usage.items():
-                    if value is False:
-                        extra = create_extra_by_key(key)
-                        yield extra
-
-    # Creates extra by key
-    def create_extra_by_key(key):
-        extra = db.get(key)
-        key = extra.pop('__key__', None)
-        extra = dict(
-            (k, AGGREGATORS[fields[k]['aggregate']].finaliser(v))
-            for k, v in extra.items()
-            if k in fields
+                for value in index.unused_values(name):
+                    yield create_extra(value, name)
+            counts['probe_seconds'] += time.time() - start
+        report_profile(name)
+
+    # Logs the profile of the join of a target, and publishes it with the
+    # progress of the index build, the target's figures prefixed with its name
+    def report_profile(name):
+        if strategy == 'hash' and asof_index is None:
+            for figure, value in index.profile().items():
+                profile[figure] = value
+        elif asof_index is not None:
+            profile['distinct_keys'] = asof_index.num_keys
+        if 'build_seconds' in profile:
+            profile['build_seconds'] = round(profile['build_seconds'], 3)
+        counts = target_profiles[name]
+        if counts['target_rows']:
+            counts['match_rate'] = round(
+                counts['matched_rows'] / counts['target_rows'], 4
+            )
+        if 'probe_seconds' in counts:
+            counts['probe_seconds'] = round(counts['probe_seconds'], 3)
+        log.info(
+            "Join profile of %s onto %s: %s",
+            source_name,
+            name,
+            dict(profile, **counts),
+        )
+        if build_progress is not None:
+            stats = dict(profile)
+            stats.update(
+                ('%s:%s' % (name, figure), value) for figure, value in counts.items()
+            )
+            build_progress.report(stats)
+
+    # Generates the joined data of an as-of join
+    def process_target_asof(resource, name, counts):
+        start = time.time()
+        key_calc = target_keys[name]
+        for row_number, row in enumerate(resource, start=1):
+            counts['target_rows'] += 1
+            key = key_calc(row, row_number)
+            try:
+                position = asof_index.find(key, row.get(asof['target_field']))
+            except TypeError:
+                raise asof_type_error()
+            if position is not None:
+                counts['matched_rows'] += 1
+                extra = create_extra(asof_index.entry(key, position), name)
+                if mode == 'full-outer':
+                    asof_index.mark_used(key, position, name)
+            else:
+                if mode == 'inner':
+                    continue
+                extra = dict(
+                    (k, row.get(k))
+                    for k in fields.keys()
+                )
+            row.update(extra)
+            yield row
+        if mode == 'full-outer':
+            for value in asof_index.unused_values(name):
+                yield create_extra(value, name)
+        counts['probe_seconds'] += time.time() - start
+
+    # Generates the joined data of a partitioned join
+    def process_target_partitioned(resource, counts):
+        if deduplication:
+            # just empty the iterable
+            collections.deque(indexer(resource), maxlen=0)
+        else:
+            progress = KVFileBuildProgress(cache_id, target_name, "join")
+            for row_number, row in enumerate(resource, start=1):
+                counts['target_rows'] += 1
+                partitioned.add_target(row_number, target_key(row, row_number), row)
+                progress.update(row_number)
+            progress.finish()
+        # Partitions are only joined once the whole target is written out
+        start = time.time()
+        yield from partitioned.run(
+            list(fields.keys()),
+            [spec['aggregate'] for spec in fields.values()],
+            mode,
+            key_list,
+            source_key.literals,
+            deduplication,
+        )
+        counts['probe_seconds'] += time.time() - start
+
+    # Generates the joined data of a merge join
+    def process_target_merge(resource, counts):
+        groups = iter_merge_groups()
+        if deduplication:
+            for _, _, value, _ in groups:
+                yield create_extra(value)
+            return
+        leftovers = []
+        start = time.time()
+        group = next(groups, None)
+        previous = None
+        for row_number, row in enumerate(resource, start=1):
+            counts['target_rows'] += 1
+            key = target_key(row, row_number)
+            order = target_key.order(row, row_number)
+            if previous is not None:
+                check_merge_order(
+                    previous[0],
+                    order,
+                    target_key.string(previous[1]),
+                    target_key.string(key),
+                    'target',
+                )
+            previous = (order, key)
+            # Source keys before this one can't match any target row anymore
+            while group is not None and merge_key_before(
+                group[0],
+                order,
+                (source_key, group[1]),
+                (target_key, key),
+            ):
+                if mode == 'full-outer' and not group[3]:
+                    leftovers.append(
+                        (source_key.string(group[1]), create_extra(group[2]))
+                    )
+                group = next(groups, None)
+            if group is not None and group[1] == key:
+                counts['matched_rows'] += 1
+                extra = create_extra(group[2])
+                group[3] = True
+            else:
+                if mode == 'inner':
+                    continue
+                extra = dict(
+                    (k, row.get(k))
+                    for k in fields.keys()
+                )
+            row.update(extra)
+            yield row
+        # Reads the rest of the source, for its unmatched keys
+        while group is not None:
+            if mode == 'full-outer' and not group[3]:
+                leftovers.append(
+                    (source_key.string(group[1]), create_extra(group[2]))
+                )
+            group = next(groups, None)
+        # Unmatched keys come last, in the order the hash strategy lists them
+        leftovers.sort(key=itemgetter(0))
+        for _, extra in leftovers:
+            yield extra
+        counts['probe_seconds'] += time.time() - start
+
+    # Creates the joined values of a target out of an index entry
+    def create_extra(value, name=target_name):
+        return finalise_entry(
+            value,
+            list(fields.keys()),
+            [spec['aggregate'] for spec in fields.values()],
+            key_lists[name],
         )
-        if key:
-            for k, v in zip(target_key.key_list, key):
-                extra[k] = v
-        return extra
 
     # Yields the new resources
     def new_resource_iterator(resource_iterator):
+        nonlocal merge_source
         has_index = False
         for resource in resource_iterator:
             name = resource.res.name
             if name == source_name:
                 has_index = True
-                if source_delete:
+                if strategy == 'merge':
+                    if source_delete:
+                        # read side by side with the target
+                        merge_source = resource
+                    else:
+                        yield merge_indexer(resource)
+                elif source_delete:
                     # just empty the iterable
                     collections.deque(indexer(resource), maxlen=0)
                 else:
                     yield indexer(resource)
                 if deduplication:
                     yield process_target(resource)
-            elif name == target_name:
+            elif name in target_keys:
                 assert has_index
-                yield process_target(resource)
+                yield process_target(resource, name)
             else:
                 yield resource
 
@@ -377,14 +2055,16 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
 
         new_resources = []
         source_spec = None
+        asof_kind = None
 
         resource_names = [resource['name'] for resource in datapackage['resources']]
         assert source_name in resource_names, \
             'Source resource ({}) not found package (target={}, found: {})'\
             .format(source_name, target_name, resource_names)
-        assert target_name in resource_names, \
-            'Target resource ({}) not found package (source={}, found: {})'\
-            .format(target_name, source_name, resource_names)
+        for name in target_names:
+            assert name in resource_names, \
+                'Target resource ({}) not found package (source={}, found: {})'\
+                .format(name, source_name, resource_names)
 
         for resource in datapackage['resources']:
 
@@ -394,6 +2074,8 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
                 schema_fields = source_spec.get('schema', {}).get('fields', [])
                 expand_fields(fields, schema_fields)
                 fields = order_fields(fields, schema_fields)
+                if asof is not None:
+                    asof_kind = asof_field_kind(resource, asof['source_field'])
                 if not source_delete:
                     new_resources.append(resource)
                 if deduplication:
@@ -405,10 +2087,20 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
                         })
                     new_resources.append(resource)
 
-            elif resource['name'] == target_name:
+            elif resource['name'] in target_keys:
                 assert isinstance(source_spec, dict),\
                        'Source resource ({}) must appear before target resource ({}), found: {}'\
-                       .format(source_name, target_name, resource_names)
+                       .format(source_name, resource['name'], resource_names)
+                if asof is not None:
+                    target_kind = asof_field_kind(resource, asof['target_field'])
+                    if target_kind != asof_kind:
+                        raise Exception(
+                            'The as-of fields {} of resource {} and {} of resource '
+                            '{} must hold the same kind of values, found {} and {}'
+                            .format(asof['source_field'], source_name,
+                                    asof['target_field'], resource['name'],
+                                    asof_kind, target_kind)
+                        )
                 resource = process_target_resource(source_spec, resource)
                 new_resources.append(resource)
 
@@ -421,31 +2113,55 @@ def join_aux(source_name, source_key, source_delete,  # noqa: C901
         process_datapackage(package.pkg.descriptor)
         yield package.pkg
         yield from new_resource_iterator(package)
-        db.close()
-        db_keys_usage.close()
+        index.close()
+        if cached_index is not None:
+            cached_index.close()
+        if partitioned is not None:
+            partitioned.close()
+        if asof_index is not None:
+            asof_index.close()
 
     return func
 
 
-def join(source_name, source_key, target_name, target_key, fields={}, full=None, mode='half-outer', source_delete=True, cache_id=None):
-    return join_aux(source_name, source_key, source_delete, target_name, target_key, fields, full, mode, cache_id=cache_id)
+def join(source_name, source_key, target_name, target_key, fields={}, full=None, mode='half-outer', source_delete=True, cache_id=None,
+         index_memory_budget=None, strategy='hash', partitions=None, partition_workers=None, index_cache=None,
+         bloom_false_positive_rate=DEFAULT_BLOOM_FALSE_POSITIVE_RATE, asof=None):
+    return join_aux(source_name, source_key, source_delete, target_name, target_key, fields, full, mode, cache_id=cache_id,
+                    index_memory_budget=index_memory_budget, strategy=strategy, partitions=partitions,
+                    partition_workers=partition_workers, index_cache=index_cache,
+                    bloom_false_positive_rate=bloom_false_positive_rate, asof=asof)
 
 
 def flow(parameters):
     source = parameters["source"]
     target = parameters["target"]
+    # A list of targets shares one index build
+    targets = target if isinstance(target, list) else [target]
     return Flow(
         load_lazy_json(source["name"]),
         join(
             source["name"],
             source["key"],
-            target["name"],
-            target["key"],
+            [t["name"] for t in targets] if isinstance(target, list) else target["name"],
+            [t["key"] for t in targets] if isinstance(target, list) else target["key"],
             parameters.get("fields", {}),
             parameters.get("full", None),
             parameters.get("mode", "half-outer"),
             source.get("delete", False),
             cache_id=parameters.get("cache_id"),
+            index_memory_budget=parameters.get("index_memory_budget"),
+            strategy=parameters.get("strategy", "hash"),
+            partitions=parameters.get("partitions"),
+            partition_workers=parameters.get("partition_workers"),
+            index_cache=parameters.get("index_cache"),
+            bloom_false_positive_rate=parameters.get(
+                "bloom_false_positive_rate", DEFAULT_BLOOM_FALSE_POSITIVE_RATE
+            ),
+            asof=parameters.get("asof"),
         ),
-        update_resource(target["name"], **{PROP_STREAMING: True}),
+        *[
+            update_resource(t["name"], **{PROP_STREAMING: True})
+            for t in targets
+        ],
     )
@@ -1,4 +1,3 @@
-import xlrd
 import os
 import re
 import boto3
@@ -30,6 +29,10 @@ from bcodmo_frictionless.bcodmo_pipeline_processors.helper import (
 from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import (
     FixedWidthParser,
     RegexCSVParser,
+    ExcelWorkbookCache,
+    CachedXLSParser,
+    CachedXLSXParser,
+    XLSXStreamParser,
 )
 
 # Import custom loaders here
@@ -43,12 +46,21 @@ from bcodmo_frictionless.bcodmo_pipeline_processors.loaders import (
 custom_parsers = {
     "bcodmo-fixedwidth": FixedWidthParser,
     "bcodmo-regex-csv": RegexCSVParser,
+    "bcodmo-xlsx-stream": XLSXStreamParser,
 }
 
 custom_loaders = {
     "bcodmo-aws": BcodmoAWS,
 }
 
+# Parsers used in place of tabulator's excel parsers when a workbook is split
+# into multiple sheets (every sheet is served from one shared workbook) or when
+# the empty rows and columns past a sheet's used range are to be left out
+cached_excel_parsers = {
+    "xls": CachedXLSParser,
+    "xlsx": CachedXLSXParser,
+}
+
 
 def get_s3():
     if os.environ.get("TESTING") == "true":
@@ -80,6 +92,14 @@ def clean_resource_name(name):
     return re.sub("[^-a-z0-9._]", "", re.sub(r"\s+", "_", name.lower()))
 
 
+def get_workbook_format(url, _format):
+    if _format in ["xls", "xlsx"]:
+        return _format
+    if os.path.splitext(urlparse(url).path)[1].lower() == ".xls":
+        return "xls"
+    return "xlsx"
+
+
 def load(_from, parameters):
     _input_separator = parameters.pop("input_separator", ",")
     _remove_empty_rows = parameters.pop("remove_empty_rows", True)
@@ -279,10 +299,13 @@ def load(_from, parameters):
     sheet_regex = parameters.pop("sheet_regex", False)
     sheet = parameters.pop("sheet", "")
     sheet_separator = parameters.pop("sheet_separator", None)
+    trim_used_range = parameters.pop("trim_used_range", False)
 
     resource_names = []
     all_sheet_names = []
     load_sources = []
+    workbook_cache = ExcelWorkbookCache()
+    uses_workbook_cache = False
     for i, url in enumerate(from_list):
         # Default the name to res[1-n]
         resource_name = names[i]
@@ -302,26 +325,31 @@ def load(_from, parameters):
             sheets = []
             if sheet_regex:
                 # Handle sheet regular expression (ignore sheet range and separator)
+                # The workbook is downloaded and opened once here, and kept in
+                # the workbook cache so each matched sheet is served from it
+                if url.startswith("s3://"):
+                    s3 = get_s3()
+                    parts = urlparse(url, allow_fragments=False)
+                    obj = s3.Object(parts.netloc, parts.path[1:])
+
+                    def load_file():
+                        return obj.get()["Body"]
+
+                else:
+
+                    def load_file():
+                        return open(url, "rb")
+
                 try:
-                    if url.startswith("s3://"):
-                        s3 = get_s3()
-                        import time
-
-                        start = time.time()
-
-                        parts = urlparse(url, allow_fragments=False)
-                        obj = s3.Object(parts.netloc, parts.path[1:])
-                        data = obj.get()["Body"].read()
-                        xls = xlrd.open_workbook(file_contents=data, on_demand=True)
-                        # xls = xlrd.open_workbook(io.BytesIO(data), on_demand=True)
-                        elapsed = time.time() - start
-                    else:
-                        xls = xlrd.open_workbook(url, on_demand=True)
+                    sheet_names = workbook_cache.sheet_names(
+                        url,
+                        get_workbook_format(url, parameters.get("format")),
+                        load_file,
+                    )
                 except FileNotFoundError:
                     raise Exception(
                         f"The file {url} was not found. Remember that sheet regular expressions only work on local and s3 paths"
                     )
-                sheet_names = xls.sheet_names()
                 for sheet_name in sheet_names:
                     if re.match(sheet, sheet_name):
                         sheets.append(sheet_name)
@@ -348,6 +376,10 @@ def load(_from, parameters):
                     f"No sheets found for {url} with the inputted parameters"
                 )
 
+            # Every one of these sheets will be read out of the same cached workbook
+            workbook_cache.expect(url, len(sheets))
+            uses_workbook_cache = True
+
             # Create load processors for all of these sheets
             for sheet_name in sheets:
                 new_name = clean_resource_name(str(sheet_name))
@@ -386,13 +418,20 @@ def load(_from, parameters):
     # https://bco-dmo-group.slack.com/archives/CSQ582V4Y/p1712063770616059
     parameters["infer_strategy"] = "strings"
     parameters["cast_strategy"] = "strings"
+    load_custom_parsers = custom_parsers
+    if uses_workbook_cache or trim_used_range:
+        load_custom_parsers = {**custom_parsers, **cached_excel_parsers}
+    if uses_workbook_cache:
+        parameters["excel_workbook_cache"] = workbook_cache
+    if trim_used_range:
+        parameters["trim_used_range"] = True
     params.extend(
         [
             count_resources(),
             standard_load_multiple(
                 load_sources,
                 resource_names,
-                custom_parsers=custom_parsers,
+                custom_parsers=load_custom_parsers,
                 custom_loaders=custom_loaders,
                 loader_cache_id=_cache_id,
                 sheets=all_sheet_names,
@@ -60,6 +60,10 @@ class BcodmoAWS(Loader):
         self.preloaded_chars = preloaded_chars
         self.limit_rows = _limit_rows
 
+    @property
+    def s3_endpoint_url(self):
+        return self.__s3_endpoint_url
+
     def _stream_load(self, source, mode="t", encoding=None):
         ###
         # This is the same as the previous load but allows streaming
@@ -1,2 +1,4 @@
 from .fixedwidth import FixedWidthParser
 from .regex_csv import RegexCSVParser
+from .excel import ExcelWorkbookCache, CachedXLSParser, CachedXLSXParser
+from .xlsx_stream import XLSXStreamParser
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import codecs
+import boto3
+from six.moves.urllib.parse import urlparse
+from tabulator.loaders.local import LocalLoader
+from ..loaders import BcodmoAWS
+
+
+# Bytes of a file handed to each worker at a time. The rows of a range are
+# sent back to the parent in one piece, so ranges are kept small enough for
+# that to stay cheap.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Bytes read at a time while looking for the newline that ends a range's
+# last line
+NEWLINE_SEARCH_SIZE = 64 * 1024
+
+# S3 clients, by process id and endpoint. boto3 clients (and their pooled
+# connections) aren't safe to share with a forked worker, so each process
+# only ever uses clients it created itself.
+_s3_clients = {}
+
+
+# Module API
+
+
+class ByteRangeSource(object):
+    """A local or S3 file that can be read in independent byte ranges.
+
+    Only the location (and size, once known) is pickled, so worker processes
+    open the file (or their own S3 client) themselves and read just the range
+    they were given.
+    """
+
+    def __init__(self, path=None, bucket=None, key=None, s3_endpoint_url=None):
+        self.path = path
+        self.bucket = bucket
+        self.key = key
+        self.s3_endpoint_url = s3_endpoint_url
+        self.__size = None
+
+    @classmethod
+    def from_loader(cls, loader, source):
+        """Returns the ByteRangeSource behind a parser's source, or None when
+        it has to be read through the loader after all (already loaded into
+        memory, or limited to its first rows).
+
+        Ranges are read straight from the file, so only loaders whose reads
+        they can reproduce are accepted: tabulator's local loader, and the
+        bcodmo-aws loader (same endpoint and credentials).
+        """
+        if isinstance(loader, BcodmoAWS):
+            if loader.preloaded_chars is not None or loader.limit_rows is not None:
+                return None
+            parts = urlparse(source, allow_fragments=False)
+            return cls(
+                bucket=parts.netloc,
+                key=parts.path[1:],
+                s3_endpoint_url=loader.s3_endpoint_url,
+            )
+        if isinstance(loader, LocalLoader) and isinstance(source, str):
+            path = source[len("file://") :] if source.startswith("file://") else source
+            if os.path.isfile(path):
+                return cls(path=path)
+        raise Exception(
+            f"parallel_parse_workers can't be used to load {source} with the "
+            f"{type(loader).__name__} loader: it only works for local files and "
+            "for S3 files loaded with the bcodmo-aws scheme"
+        )
+
+    def size(self):
+        if self.__size is None:
+            if self.path is not None:
+                self.__size = os.path.getsize(self.path)
+            else:
+                response = self.__s3_client().head_object(
+                    Bucket=self.bucket, Key=self.key
+                )
+                self.__size = response["ContentLength"]
+        return self.__size
+
+    def read(self, start, end):
+        if end <= start:
+            return b""
+        if self.path is not None:
+            with io.open(self.path, "rb") as f:
+                f.seek(start)
+                return f.read(end - start)
+        response = self.__s3_client().get_object(
+            Bucket=self.bucket, Key=self.key, Range="bytes=%d-%d" % (start, end - 1)
+        )
+        return response["Body"].read()
+
+    def ranges(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Splits the file into (start, end) ranges of chunk_size bytes. Ranges
+        are cut anywhere: lines() finds the lines of its range itself, so
+        the file isn't read here.
+        """
+        size = self.size()
+        return [
+            (start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)
+        ]
+
+    def lines(self, start, end, encoding):
+        """Returns the lines starting in a range, split the way readline splits
+        a text stream opened with universal newlines. The line a range ends in
+        is read to its end, and the line it starts in is left to the range
+        before.
+        """
+        if start > 0 and codecs.lookup(encoding).name == "utf-8-sig":
+            # Only the start of the file can hold a byte order mark
+            encoding = "utf-8"
+        text = io.StringIO(self.__read_lines(start, end).decode(encoding), newline=None)
+        return list(iter(text.readline, ""))
+
+    # Private
+
+    def __read_lines(self, start, end):
+        if start > 0:
+            # A line starts in the range right after a newline, which may be
+            # the byte just before it
+            data = self.read(start - 1, end)
+            index = data.find(b"\n")
+            if index == -1:
+                return b""
+            data = data[index + 1 :]
+        else:
+            data = self.read(start, end)
+        if data and not data.endswith(b"\n"):
+            data += self.__rest_of_line(end)
+        return data
+
+    def __rest_of_line(self, position):
+        size = self.size()
+        rest = []
+        while position < size:
+            window = self.read(position, min(position + NEWLINE_SEARCH_SIZE, size))
+            index = window.find(b"\n")
+            if index != -1:
+                rest.append(window[: index + 1])
+                break
+            rest.append(window)
+            position += len(window)
+        return b"".join(rest)
+
+    def __s3_client(self):
+        client_key = (os.getpid(), self.s3_endpoint_url)
+        client = _s3_clients.get(client_key)
+        if client is None:
+            client = boto3.client("s3", endpoint_url=self.s3_endpoint_url)
+            _s3_clients[client_key] = client
+        return client
+
+
+def is_newline_aligned_encoding(encoding):
+    # Ranges are cut on b"\n", so every newline must be that single byte and
+    # the byte can't show up inside other characters (utf-16 and the like)
+    try:
+        return "\n".encode(encoding) == b"\n"
+    except (LookupError, TypeError):
+        return False
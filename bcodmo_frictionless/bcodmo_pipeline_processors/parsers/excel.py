@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import sys
+import six
+import atexit
+import shutil
+import xlrd
+import openpyxl
+from itertools import chain
+from tempfile import NamedTemporaryFile
+from tabulator.parser import Parser
+from tabulator import exceptions
+from tabulator.parsers.xlsx import extract_row_values
+
+
+# Module API
+
+
+class ExcelWorkbookCache(object):
+    """Shares one downloaded + opened workbook between every sheet a load step
+    pulls out of it.
+
+    A sheet regex/range/separator expands a single workbook into one resource
+    per sheet, and each of those resources gets its own tabulator Stream. Left
+    alone, every Stream downloads and parses the entire workbook again just to
+    read its one sheet (41 times for a 40-sheet submission: once to list the
+    sheet names, then once per sheet). The cache lives for a single load step:
+    the workbook is fetched once, opened once (xlrd with on_demand=True for
+    xls, openpyxl read-only for xlsx) and each sheet is served from that book.
+    Workbooks are shared as a local file rather than held in memory: a local
+    file is read where it is, anything else is copied to a temporary file.
+    Once a sheet has been fully consumed it is unloaded, and once every
+    expected sheet of a workbook has been consumed the book is closed and its
+    temporary file removed.
+    """
+
+    def __init__(self):
+        self.__paths = {}
+        self.__temp_paths = set()
+        self.__books = {}
+        self.__book_files = {}
+        self.__pending = {}
+
+    def __contains__(self, source):
+        return source in self.__paths or any(
+            key[0] == source for key in self.__books
+        )
+
+    def expect(self, source, count=1):
+        # Register how many sheets will be read out of this workbook, so we know
+        # when the last one is done and the book can be released
+        self.__pending[source] = self.__pending.get(source, 0) + count
+
+    def get_path(self, source, load_file):
+        """Returns the path of a local file holding the workbook.
+
+        `load_file` is only called the first time a workbook is asked for, and
+        returns its binary stream.
+        """
+        path = self.__paths.get(source)
+        if path is None:
+            source_bytes = load_file()
+            path = get_local_path(source_bytes)
+            if path is None:
+                path = copy_to_temp_file(source_bytes)
+                self.__temp_paths.add(path)
+            source_bytes.close()
+            self.__paths[source] = path
+        return path
+
+    def get_book(self, source, workbook_format, load_file, encoding=None, **options):
+        key = (source, workbook_format, tuple(sorted(options.items())))
+        book = self.__books.get(key)
+        if book is None:
+            path = self.get_path(source, load_file)
+            if workbook_format == "xls":
+                book = open_xls_workbook(path, encoding=encoding, **options)
+            else:
+                # openpyxl goes by a path's extension, which a temporary copy
+                # doesn't have, so it's given the open file instead
+                book_file = io.open(path, "rb")
+                self.__book_files[key] = book_file
+                book = openpyxl.load_workbook(
+                    book_file,
+                    read_only=options.get("read_only", True),
+                    data_only=True,
+                )
+            self.__books[key] = book
+        return book
+
+    def sheet_names(self, source, workbook_format, load_file):
+        if workbook_format == "xls":
+            return self.get_book(
+                source, workbook_format, load_file, formatting_info=True
+            ).sheet_names()
+        return self.get_book(
+            source, workbook_format, load_file, read_only=True
+        ).sheetnames
+
+    def release(self, source, sheet_name=None):
+        # Unload the consumed sheet from every open book of this workbook
+        for key, book in self.__books.items():
+            if key[0] == source and key[1] == "xls" and sheet_name is not None:
+                if book.sheet_loaded(sheet_name):
+                    book.unload_sheet(sheet_name)
+
+        pending = self.__pending.get(source, 0) - 1
+        if pending > 0:
+            self.__pending[source] = pending
+            return
+        self.__pending.pop(source, None)
+        for key in [key for key in self.__books if key[0] == source]:
+            book = self.__books.pop(key)
+            if key[1] == "xls":
+                book.release_resources()
+            else:
+                book.close()
+                self.__book_files.pop(key).close()
+        path = self.__paths.pop(source, None)
+        if path in self.__temp_paths:
+            self.__temp_paths.discard(path)
+            remove_file(path)
+
+
+def get_local_path(source_bytes):
+    # A stream opened straight from a file on disk (tabulator's local loader,
+    # a plain `open`) can be read from its path
+    path = getattr(source_bytes, "name", None)
+    if isinstance(path, six.string_types) and os.path.isfile(path):
+        return path
+    return None
+
+
+def copy_to_temp_file(source_bytes):
+    with NamedTemporaryFile(prefix="bcodmo-excel-", delete=False) as target:
+        shutil.copyfileobj(source_bytes, target)
+    # Don't leave the copy behind if its workbook is never released
+    atexit.register(remove_file, target.name)
+    return target.name
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_xls_workbook(path, encoding=None, formatting_info=True):
+    # Matches tabulator's XLSParser, which retries without formatting_info for
+    # the xls variants xlrd can't read formatting from
+    try:
+        return xlrd.open_workbook(
+            filename=path,
+            encoding_override=encoding,
+            formatting_info=formatting_info,
+            on_demand=True,
+            logfile=sys.stderr,
+        )
+    except NotImplementedError:
+        return xlrd.open_workbook(
+            filename=path,
+            encoding_override=encoding,
+            formatting_info=False,
+            on_demand=True,
+            logfile=sys.stderr,
+        )
+
+
+EMPTY_XLS_CELL_TYPES = (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK)
+
+
+def is_empty_row(row):
+    for value in row:
+        if value is not None and value != "":
+            return False
+    return True
+
+
+def iter_used_rows(rows):
+    """Yields (row_number, row) for every row up to the last one holding data.
+
+    Sheets often carry formatting far past their data (a whole column given a
+    number format, borders drawn down to row 65536, ...), which shows up as
+    thousands of empty rows after the real ones. Empty rows are held back
+    until a row with data follows them, so trailing ones are dropped without
+    ever reaching tabulator. `rows` may give an int instead of a list for a
+    row of that many `None` values, so callers don't have to build it.
+    """
+    # Held back rows as [row, count] runs: consecutive rows of Nones of the
+    # same width are a single run of their width, so thousands of trailing
+    # rows take a few entries
+    pending = []
+    pending_count = 0
+    for row_number, row in enumerate(rows, start=1):
+        if not isinstance(row, int) and all(value is None for value in row):
+            # A row of Nones is remembered by its width only
+            row = len(row)
+        if isinstance(row, int) and pending and pending[-1][0] == row:
+            pending[-1][1] += 1
+            pending_count += 1
+            continue
+        if isinstance(row, int) or is_empty_row(row):
+            pending.append([row, 1])
+            pending_count += 1
+            continue
+        empty_row_number = row_number - pending_count
+        for empty_row, count in pending:
+            for _ in range(count):
+                yield (
+                    empty_row_number,
+                    [None] * empty_row if isinstance(empty_row, int) else empty_row,
+                )
+                empty_row_number += 1
+        pending = []
+        pending_count = 0
+        yield (row_number, row)
+
+
+def xls_used_range(sheet, merged_cells=None):
+    """Returns (nrows, ncols) of the part of an xlrd sheet that holds data.
+
+    With formatting_info=True xlrd counts every formatted blank cell, so
+    `sheet.nrows`/`sheet.ncols` can reach far beyond the data.
+    """
+    nrows = ncols = 0
+    for x in range(sheet.nrows - 1, -1, -1):
+        types = sheet.row_types(x)
+        values = sheet.row_values(x)
+        # Only columns past the widest one found so far can widen the range
+        for y in range(len(types) - 1, ncols - 1, -1):
+            if types[y] not in EMPTY_XLS_CELL_TYPES and values[y] != "":
+                ncols = y + 1
+                nrows = nrows or x + 1
+                break
+    for xlo, xhi, ylo, yhi in merged_cells or []:
+        # A filled merged range spreads its value beyond its top-left cell
+        if xlo < nrows and ylo < ncols:
+            nrows = max(nrows, xhi)
+            ncols = max(ncols, yhi)
+    return nrows, ncols
+
+
+def xlsx_used_rows(sheet):
+    """Returns the number of rows of an openpyxl sheet to read for its data,
+    or None to read every row.
+
+    Formatted blank cells are stored like any other, so the sheet dimension
+    can reach far beyond the data. A fully loaded sheet has its cells at hand,
+    so it's bounded by the last row holding a value. A read-only sheet is
+    bounded by its dimension, and iter_used_rows drops the empty rows past the
+    data as they are read.
+    """
+    cells = getattr(sheet, "_cells", None)
+    if cells is None:
+        return sheet.max_row
+    nrows = 0
+    for (row, _), cell in cells.items():
+        if row > nrows and cell.value is not None and cell.value != "":
+            nrows = row
+    return nrows
+
+
+class CachedExcelParser(Parser):
+    """Parser to parse a single sheet out of an ExcelWorkbookCache.
+
+    Produces the same rows as tabulator's XLSParser/XLSXParser, but the
+    workbook itself comes from (and is shared through) the cache. With
+    trim_used_range, rows and columns past the sheet's used range are left
+    out without being built.
+    """
+
+    # Public
+
+    workbook_format = None
+
+    options = [
+        "sheet",
+        "workbook_cache",
+        "excel_workbook_cache",
+        "fill_merged_cells",
+        "preserve_formatting",
+        "adjust_floating_point_error",
+        "trim_used_range",
+    ]
+
+    def __init__(
+        self,
+        loader,
+        force_parse=False,
+        sheet=1,
+        workbook_cache=None,
+        excel_workbook_cache=None,
+        fill_merged_cells=False,
+        preserve_formatting=False,
+        adjust_floating_point_error=False,
+        trim_used_range=False,
+    ):
+        self.__loader = loader
+        self.__sheet_pointer = sheet
+        self.__workbook_cache = workbook_cache
+        self.__cache = (
+            excel_workbook_cache
+            if excel_workbook_cache is not None
+            else ExcelWorkbookCache()
+        )
+        self.__fill_merged_cells = fill_merged_cells
+        self.__preserve_formatting = preserve_formatting
+        self.__adjust_floating_point_error = adjust_floating_point_error
+        self.__trim_used_range = trim_used_range
+        self.__force_parse = force_parse
+        self.__extended_rows = None
+        self.__encoding = None
+        self.__fragment = None
+        self.__source = None
+        self.__book = None
+        self.__sheet = None
+        self.__closed = True
+        self.__released = False
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    def open(self, source, encoding=None):
+        self.close()
+        self.__source = source
+        self.__encoding = encoding
+        self.__closed = False
+        self.__load_sheet()
+
+        # Reset parser
+        self.reset()
+
+    def close(self):
+        self.__closed = True
+        self.__book = None
+        self.__sheet = None
+
+    def reset(self):
+        self.__extended_rows = self.__iter_extended_rows()
+
+    @property
+    def encoding(self):
+        return self.__encoding
+
+    @property
+    def fragment(self):
+        return self.__fragment
+
+    @property
+    def extended_rows(self):
+        return self.__extended_rows
+
+    # Private
+
+    def __load_file(self):
+        # Like tabulator's XLSXParser, a remote workbook is copied to a local
+        # file once and the copy kept in `workbook_cache` for other parsers
+        if self.__workbook_cache is not None:
+            path = self.__workbook_cache.get(self.__source)
+            if path is None and getattr(self.__loader, "remote", False):
+                source_bytes = self.__loader.load(
+                    self.__source, mode="b", encoding=self.__encoding
+                )
+                path = copy_to_temp_file(source_bytes)
+                source_bytes.close()
+                self.__workbook_cache[self.__source] = path
+            if path is not None:
+                return io.open(path, "rb")
+        return self.__loader.load(self.__source, mode="b", encoding=self.__encoding)
+
+    def __load_sheet(self):
+        self.__book = self.__get_book()
+        try:
+            if self.workbook_format == "xls":
+                if isinstance(self.__sheet_pointer, six.string_types):
+                    self.__sheet = self.__book.sheet_by_name(self.__sheet_pointer)
+                else:
+                    self.__sheet = self.__book.sheet_by_index(self.__sheet_pointer - 1)
+                self.__fragment = self.__sheet.name
+            else:
+                if isinstance(self.__sheet_pointer, six.string_types):
+                    self.__sheet = self.__book[self.__sheet_pointer]
+                else:
+                    self.__sheet = self.__book.worksheets[self.__sheet_pointer - 1]
+                self.__fragment = self.__sheet.title
+        except (xlrd.XLRDError, KeyError, IndexError):
+            message = 'Excel document "%s" doesn\'t have a sheet "%s"'
+            raise exceptions.SourceError(
+                message % (self.__source, self.__sheet_pointer)
+            )
+        self.__process_merged_cells()
+
+    def __get_book(self):
+        if self.workbook_format == "xls":
+            return self.__cache.get_book(
+                self.__source,
+                self.workbook_format,
+                self.__load_file,
+                encoding=self.__encoding,
+                formatting_info=True,
+            )
+        # To fill merged cells we can't use read-only because
+        # `sheet.merged_cell_ranges` is not available in this mode
+        return self.__cache.get_book(
+            self.__source,
+            self.workbook_format,
+            self.__load_file,
+            read_only=not self.__fill_merged_cells,
+        )
+
+    def __iter_extended_rows(self):
+        if self.__sheet is None:
+            # The sheet was released after a previous full pass; fetch it
+            # again, to be released again once this pass is done
+            self.__cache.expect(self.__source)
+            self.__released = False
+            self.__load_sheet()
+        if self.workbook_format == "xls":
+            rows = self.__iter_xls_rows()
+        else:
+            rows = self.__iter_xlsx_rows()
+        if self.__trim_used_range:
+            rows = iter_used_rows(rows)
+        else:
+            rows = enumerate(
+                ([None] * row if isinstance(row, int) else row for row in rows),
+                start=1,
+            )
+        for row_number, row in rows:
+            yield (row_number, None, row)
+
+        # The sheet has been fully consumed - let the cache unload it
+        if not self.__released:
+            self.__released = True
+            sheet_name = self.__fragment
+            self.__sheet = None
+            self.__book = None
+            self.__cache.release(self.__source, sheet_name)
+
+    def __iter_xls_rows(self):
+        book = self.__book
+        sheet = self.__sheet
+
+        def type_value(ctype, value):
+            """ Detects boolean value, int value, datetime """
+
+            # Boolean
+            if ctype == xlrd.XL_CELL_BOOLEAN:
+                return bool(value)
+
+            # Excel numbers are only float
+            # Float with no decimals can be cast into int
+            if ctype == xlrd.XL_CELL_NUMBER and value == value // 1:
+                return int(value)
+
+            # Datetime
+            if ctype == xlrd.XL_CELL_DATE:
+                return xlrd.xldate.xldate_as_datetime(value, book.datemode)
+
+            return value
+
+        nrows, ncols = sheet.nrows, sheet.ncols
+        if self.__trim_used_range:
+            nrows, ncols = xls_used_range(
+                sheet, sheet.merged_cells if self.__fill_merged_cells else None
+            )
+        for x in range(0, nrows):
+            row = []
+            for y, value in enumerate(sheet.row_values(x, 0, ncols)):
+                value = type_value(sheet.cell(x, y).ctype, value)
+                if self.__fill_merged_cells:
+                    for xlo, xhi, ylo, yhi in sheet.merged_cells:
+                        if x in range(xlo, xhi) and y in range(ylo, yhi):
+                            value = type_value(
+                                sheet.cell(xlo, ylo).ctype,
+                                sheet.cell_value(xlo, ylo),
+                            )
+                row.append(value)
+            yield row
+
+    def __iter_xlsx_rows(self):
+        nrows = None
+        if self.__trim_used_range:
+            nrows = xlsx_used_rows(self.__sheet)
+        if nrows == 0:
+            return
+        if not self.__preserve_formatting:
+            # Plain values are all extract_row_values would take from the cells
+            for values in self.__sheet.iter_rows(max_row=nrows, values_only=True):
+                if all(value is None for value in values):
+                    yield len(values)
+                else:
+                    yield list(values)
+            return
+        for row in self.__sheet.iter_rows(max_row=nrows):
+            if all(cell.value is None for cell in row):
+                # Rows past the data are mostly formatting only: keep them as
+                # their width until a row with data shows they're needed
+                yield len(row)
+                continue
+            yield extract_row_values(
+                row,
+                self.__preserve_formatting,
+                self.__adjust_floating_point_error,
+            )
+
+    def __process_merged_cells(self):
+        if self.__fill_merged_cells and self.workbook_format != "xls":
+            for merged_cell_range in list(self.__sheet.merged_cells.ranges):
+                merged_cell_range = str(merged_cell_range)
+                self.__sheet.unmerge_cells(merged_cell_range)
+                merged_rows = openpyxl.utils.rows_from_range(merged_cell_range)
+                coordinates = list(chain.from_iterable(merged_rows))
+                value = self.__sheet[coordinates[0]].value
+                for coordinate in coordinates:
+                    cell = self.__sheet[coordinate]
+                    cell.value = value
+
+
+class CachedXLSParser(CachedExcelParser):
+    """Parser to parse a sheet of a cached Excel `xls` workbook."""
+
+    workbook_format = "xls"
+
+
+class CachedXLSXParser(CachedExcelParser):
+    """Parser to parse a sheet of a cached Excel `xlsx` workbook."""
+
+    workbook_format = "xlsx"
@@ -8,14 +8,56 @@ import csv
 import math
 import six
 import re
-from itertools import chain
+from itertools import chain, islice
 from codecs import iterencode
 from tabulator.parser import Parser
 from tabulator import helpers, config, exceptions
-import pandas as pd
+import numpy as np
 import logging
 
 
+# Characters stripped from the ends of every field, as pandas.read_fwf does
+FIELD_STRIP_CHARS = "\n\r\t "
+FIELD_PATTERN = re.compile(r"[^\n\r\t ]+")
+
+# Fields pandas.read_fwf reads as missing by default (its documented default
+# `na_values`), which come out of the str() of its NaN as "nan"
+MISSING_VALUES = frozenset(
+    [
+        "",
+        "#N/A",
+        "#N/A N/A",
+        "#NA",
+        "-1.#IND",
+        "-1.#QNAN",
+        "-NaN",
+        "-nan",
+        "1.#IND",
+        "1.#QNAN",
+        "<NA>",
+        "N/A",
+        "NA",
+        "NULL",
+        "NaN",
+        "None",
+        "n/a",
+        "nan",
+        "null",
+    ]
+)
+MISSING_VALUE_STRING = str(float("nan"))
+MISSING_VALUES_ARRAY = np.array(sorted(MISSING_VALUES))
+
+BOM = "\ufeff"
+
+SEABIRD_NAME_PATTERN = re.compile(r"^# name \d* = (.*):.*$")
+SEABIRD_COUNT_PATTERN = re.compile(r"^# (nquan|nvalues) = (\d+)")
+
+# Data lines sliced per NumPy batch in seabird files
+SEABIRD_BATCH_SIZE = 10000
+UNICODE_ITEM_SIZE = np.dtype("U1").itemsize
+
+
 # Module API
 
 
@@ -112,29 +154,36 @@ class FixedWidthParser(Parser):
         file_pos = None
         header_values = []
         captured_rows_dict = {}
+        nquan = None
+        nvalues = None
+        capture_patterns = [
+            (c["column_name"], re.compile(c["regex"]))
+            for c in self.__seabird_capture_skipped_rows
+        ]
+        skip_header = tuple(self.__fixedwidth_skip_header)
         for item in iter(items.readline, ""):
             last_item = item
             if self.__parse_seabird_header:
-                match = re.match(r"^# name \d* = (.*):.*$", item)
+                match = SEABIRD_NAME_PATTERN.match(item)
                 if match:
                     header_values.append(match.groups()[0])
+                match = SEABIRD_COUNT_PATTERN.match(item)
+                if match:
+                    if match.group(1) == "nquan":
+                        nquan = int(match.group(2))
+                    else:
+                        nvalues = int(match.group(2))
 
-                for c in self.__seabird_capture_skipped_rows:
-                    match = re.match(c["regex"], item)
+                for column_name, pattern in capture_patterns:
+                    match = pattern.match(item)
                     if match:
                         if not len(match.groups()):
                             continue
-                        column_name = c["column_name"]
                         if column_name not in captured_rows_dict:
                             captured_rows_dict[column_name] = []
                         captured_rows_dict[column_name].append(match.groups()[0])
 
-            is_comment = False
-            for skip_str in self.__fixedwidth_skip_header:
-                if item.startswith(skip_str):
-                    is_comment = True
-
-            if not is_comment:
+            if not item.startswith(skip_header):
                 break
             file_pos = items.tell()
 
@@ -182,31 +231,157 @@ class FixedWidthParser(Parser):
         else:
             items.seek(0)
 
+        lines = iter(items.readline, "")
         if self.__infer:
-            reader = pd.read_fwf(
-                items,
-                colspecs="infer",
-                infer_nrows=self.__fixedwidth_sample_size,
-                chunksize=2,
-                dtype=str,
-                header=None,
-            )
+            sample = list(islice(lines, self.__fixedwidth_sample_size))
+            colspecs = infer_colspecs(sample)
+            lines = chain(sample, lines)
         else:
-            reader = pd.read_fwf(
-                items,
-                widths=width,
-                infer_nrows=self.__fixedwidth_sample_size,
-                chunksize=2,
-                dtype=str,
-                header=None,
-            )
-        index_offset = 0
+            colspecs = widths_to_colspecs(width)
+        if (
+            self.__parse_seabird_header
+            and nquan == len(colspecs)
+            and len(set(width)) == 1
+        ):
+            # A well-formed seabird file: nquan same-width columns
+            batch_size = SEABIRD_BATCH_SIZE
+            if nvalues:
+                batch_size = min(batch_size, nvalues)
+            rows = iter_seabird_values(lines, nquan, width[0], batch_size)
+        else:
+            rows = iter_fixedwidth_values(lines, colspecs)
+        captured_values = [captured_row["value"] for captured_row in captured_rows]
+        row_number = 0
         if self.__parse_seabird_header:
-            index_offset = 1
-        for chunk in reader:
-            for index, row in chunk.iterrows():
-                l = row.tolist()
-                l = [str(item) for item in l]
-                for captured_row in captured_rows:
-                    l.append(captured_row["value"])
-                yield (index + 1 + index_offset, None, l)
+            row_number = 1
+        for values in rows:
+            row_number += 1
+            values.extend(captured_values)
+            yield (row_number, None, values)
+
+
+def widths_to_colspecs(widths):
+    colspecs = []
+    start = 0
+    for column_width in widths:
+        colspecs.append((start, start + column_width))
+        start += column_width
+    return colspecs
+
+
+def infer_colspecs(lines):
+    """Infers (start, end) column bounds from a sample of lines.
+
+    Same as pandas.read_fwf(colspecs="infer"): a column is a run of character
+    positions that hold a non-whitespace character in any line of the sample.
+    """
+    if not lines:
+        raise exceptions.TabulatorException(
+            "No rows from which to infer column width"
+        )
+    mask = bytearray(max(map(len, lines)) + 1)
+    for line in lines:
+        for match in FIELD_PATTERN.finditer(line):
+            start, end = match.span()
+            mask[start:end] = b"\x01" * (end - start)
+    edges = []
+    previous = 0
+    for position, used in enumerate(mask):
+        if used != previous:
+            edges.append(position)
+            previous = used
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def fixedwidth_line_values(line, colspecs, strip_bom=False):
+    """Returns the list of string values of a data line, or None for a line
+    where every field is blank.
+
+    Gives the same values as a row of pandas.read_fwf(dtype=str) passed
+    through str(): fields are sliced straight out of the line and pandas'
+    default missing values become "nan".
+    """
+    values = [line[start:end].strip(FIELD_STRIP_CHARS) for start, end in colspecs]
+    if strip_bom and values and values[0].startswith(BOM):
+        # pandas drops a byte order mark from the start of the first line
+        values[0] = values[0][len(BOM) :]
+    if not any(value.strip() for value in values):
+        return None
+    return [
+        MISSING_VALUE_STRING if value in MISSING_VALUES else value
+        for value in values
+    ]
+
+
+def iter_fixedwidth_values(lines, colspecs):
+    """Yields the list of string values for every non-blank data line."""
+    found_row = False
+    for line_number, line in enumerate(lines):
+        values = fixedwidth_line_values(
+            line, colspecs, strip_bom=line_number == 0
+        )
+        if values is None:
+            continue
+        found_row = True
+        yield values
+
+    if not found_row:
+        raise exceptions.TabulatorException("No columns to parse from file")
+
+
+def iter_seabird_values(lines, nquan, width, batch_size):
+    """Yields the same values as iter_fixedwidth_values for a data section of
+    `nquan` columns that are each `width` characters wide.
+
+    Lines are read in batches and sliced into fields all at once with NumPy,
+    as a strided view over the batch's characters. A batch that doesn't fit
+    that layout - lines of uneven length, a blank line or a missing value -
+    goes through the generic line by line path instead.
+    """
+    colspecs = widths_to_colspecs([width] * nquan)
+    lines = iter(lines)
+    first_line = next(lines, None)
+    if first_line is not None and first_line.startswith(BOM):
+        yield from iter_fixedwidth_values(chain([first_line], lines), colspecs)
+        return
+    if first_line is not None:
+        lines = chain([first_line], lines)
+
+    found_row = False
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            break
+        rows = seabird_batch_values(batch, nquan, width)
+        if rows is None:
+            rows = [
+                values
+                for values in (
+                    fixedwidth_line_values(line, colspecs) for line in batch
+                )
+                if values is not None
+            ]
+        if rows:
+            found_row = True
+        yield from rows
+
+    if not found_row:
+        raise exceptions.TabulatorException("No columns to parse from file")
+
+
+def seabird_batch_values(batch, nquan, width):
+    lines = np.array(batch)
+    lengths = np.char.str_len(lines)
+    if lengths.min() != lengths.max() or lengths[0] < nquan * width:
+        return None
+    fields = np.ndarray(
+        (len(batch), nquan),
+        dtype="U%d" % width,
+        buffer=lines,
+        strides=(lines.strides[0], width * UNICODE_ITEM_SIZE),
+    )
+    fields = np.char.strip(fields, FIELD_STRIP_CHARS)
+    if np.isin(fields, MISSING_VALUES_ARRAY).any():
+        # Blank lines and missing values are left to the generic path
+        return None
+    return fields.tolist()
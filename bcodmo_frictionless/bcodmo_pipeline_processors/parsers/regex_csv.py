@@ -11,6 +11,19 @@ from codecs import iterencode
 from tabulator.parser import Parser
 from tabulator import helpers
 import re
+from ..helper import iter_parallel
+from .byte_range import (
+    ByteRangeSource,
+    DEFAULT_CHUNK_SIZE,
+    is_newline_aligned_encoding,
+)
+
+
+# Regex delimiters matching any run of whitespace, the same as str.split()
+WHITESPACE_DELIMITERS = {r"\s+", r"[\s]+"}
+
+# Characters that give a delimiter a meaning other than itself in a regex
+REGEX_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
 
 
 # Module API
@@ -25,6 +38,8 @@ class RegexCSVParser(Parser):
         "capture_skipped_rows",
         "capture_skipped_rows_join_string",
         "capture_skipped_rows_join",
+        "parallel_parse_workers",
+        "parallel_parse_chunk_size",
     ]
 
     def __init__(self, loader, force_parse=False, **options):
@@ -45,7 +60,12 @@ class RegexCSVParser(Parser):
         self.__capture_skipped_rows_join_string = options.get(
             "capture_skipped_rows_join_string", ";"
         )
+        self.__parallel_parse_workers = options.get("parallel_parse_workers", None)
+        self.__parallel_parse_chunk_size = options.get(
+            "parallel_parse_chunk_size", DEFAULT_CHUNK_SIZE
+        )
         self.__force_parse = force_parse
+        self.__source = None
         self.__chars = None
 
     @property
@@ -54,6 +74,7 @@ class RegexCSVParser(Parser):
 
     def open(self, source, encoding=None):
         self.close()
+        self.__source = source
         self.__chars = self.__loader.load(source, encoding=encoding)
         self.__encoding = getattr(self.__chars, "encoding", encoding)
         if self.__encoding:
@@ -93,29 +114,33 @@ class RegexCSVParser(Parser):
         return headers_row == row_number
 
     def __iter_extended_rows(self):
-        headers_row = (
-            (self.__stream._Stream__headers_row or 1)
-            if self.__stream is not None
-            else 1
-        )
-        items = self.__chars
+        split = get_delimiter_split(self.__delimiter)
+        lines = enumerate(iter(self.__chars.readline, ""), start=1)
+
+        # Rows up to the first data row are held so that the values captured
+        # from them can be added to the header row, without reading the file
+        # twice (which isn't possible for non-seekable streams anyway)
+        prelude = []
         captured_rows_dict = {}
         if self.__capture_skipped_rows:
-            for row_number, item in enumerate(iter(items.readline, "")):
+            capture_patterns = [
+                (c["column_name"], re.compile(c["regex"]))
+                for c in self.__capture_skipped_rows
+            ]
+            for row_number, item in lines:
+                prelude.append((row_number, item))
                 # If we're not in a comment anymore (as long as we are past the header row)
-                if self._is_data_row([item], row_number + 1):
+                if self._is_data_row([item], row_number):
                     break
-                for c in self.__capture_skipped_rows:
-                    match = re.match(c["regex"], item)
+                for column_name, pattern in capture_patterns:
+                    match = pattern.match(item)
                     if match:
                         if not len(match.groups()):
                             continue
-                        column_name = c["column_name"]
                         if column_name not in captured_rows_dict:
                             captured_rows_dict[column_name] = []
                         captured_rows_dict[column_name].append(match.groups()[0])
 
-        items.seek(0)
         captured_rows = []
         for header_name, v in captured_rows_dict.items():
             if self.__capture_skipped_rows_join:
@@ -134,14 +159,84 @@ class RegexCSVParser(Parser):
                         }
                     )
 
-        for i, item in enumerate(iter(items.readline, "")):
-            row_number = i + 1
-            l = [x for x in re.split(self.__delimiter, item)]
-            for captured_row in captured_rows:
-                # Append the name if it's not a data row (either header or to be skipped)
-                if not self._is_data_row(l, row_number):
-                    if self._is_first_header_row(l, row_number):
-                        l.append(captured_row["name"])
-                else:
-                    l.append(captured_row["value"])
+        byte_range_source = self.__get_byte_range_source()
+        if byte_range_source is not None:
+            # Every row is parsed again from the start of the file, so the
+            # prelude read above is only used for the captured values
+            rows = enumerate(self.__iter_parallel_rows(byte_range_source), start=1)
+        else:
+            rows = (
+                (row_number, split(item))
+                for row_number, item in chain(prelude, lines)
+            )
+
+        if not captured_rows:
+            for row_number, l in rows:
+                yield (row_number, None, l)
+            return
+
+        captured_names = [captured_row["name"] for captured_row in captured_rows]
+        captured_values = [captured_row["value"] for captured_row in captured_rows]
+        for row_number, l in rows:
+            # Append the values to data rows, and the names to the header
+            if self._is_data_row(l, row_number):
+                l.extend(captured_values)
+            elif self._is_first_header_row(l, row_number):
+                l.extend(captured_names)
             yield (row_number, None, l)
+
+    def __get_byte_range_source(self):
+        workers = self.__parallel_parse_workers
+        if not workers or workers < 2:
+            return None
+        if not self.__encoding or not is_newline_aligned_encoding(self.__encoding):
+            return None
+        return ByteRangeSource.from_loader(self.__loader, self.__source)
+
+    def __iter_parallel_rows(self, byte_range_source):
+        tasks = (
+            (byte_range_source, start, end, self.__encoding, self.__delimiter)
+            for start, end in byte_range_source.ranges(
+                self.__parallel_parse_chunk_size
+            )
+        )
+        for rows in iter_parallel(
+            split_byte_range, tasks, self.__parallel_parse_workers
+        ):
+            for row in rows:
+                yield row
+
+
+def split_byte_range(task):
+    # Runs in a worker process of the parallel parse
+    byte_range_source, start, end, encoding, delimiter = task
+    split = get_delimiter_split(delimiter)
+    return [split(line) for line in byte_range_source.lines(start, end, encoding)]
+
+
+def get_delimiter_split(delimiter):
+    """Returns a function splitting a line the way re.split(delimiter, line)
+    does, using str.split when the delimiter allows it.
+    """
+    if delimiter in WHITESPACE_DELIMITERS:
+
+        def split_whitespace(line):
+            values = line.split()
+            # re.split keeps the empty strings before leading and after
+            # trailing whitespace
+            if line[:1].isspace():
+                values.insert(0, "")
+            if line[-1:].isspace():
+                values.append("")
+            return values
+
+        return split_whitespace
+
+    if delimiter and not REGEX_SPECIAL_CHARS.intersection(delimiter):
+
+        def split_literal(line):
+            return line.split(delimiter)
+
+        return split_literal
+
+    return re.compile(delimiter).split
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import six
+import shutil
+import zipfile
+import warnings
+from xml.parsers import expat
+from tempfile import TemporaryFile
+from tabulator.parser import Parser
+from tabulator import exceptions
+from tabulator.parsers.xlsx import extract_row_values
+from .excel import iter_used_rows
+from openpyxl.packaging.manifest import Manifest
+from openpyxl.reader.excel import _find_workbook_part
+from openpyxl.reader.strings import read_string_table
+from openpyxl.reader.workbook import WorkbookParser
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.styles.stylesheet import Stylesheet
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import from_excel, from_ISO8601
+from openpyxl.worksheet._reader import WorkSheetParser, _cast_number
+from openpyxl.xml.constants import (
+    ARC_CONTENT_TYPES,
+    ARC_STYLE,
+    SHARED_STRINGS,
+    SHEET_MAIN_NS,
+)
+from openpyxl.xml.functions import fromstring
+
+
+# Element names as reported by expat with namespace processing turned on
+NS_SEPARATOR = " "
+ROW_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "row"
+CELL_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "c"
+VALUE_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "v"
+INLINE_STRING_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "is"
+RICH_TEXT_RUN_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "r"
+TEXT_TAG = SHEET_MAIN_NS + NS_SEPARATOR + "t"
+
+# Bytes of compressed-stream output handed to expat at a time
+READ_CHUNK_SIZE = 1 << 20
+
+
+# Module API
+
+
+class XLSXStreamParser(Parser):
+    """Parser to stream rows out of an Excel `xlsx` sheet with bounded memory.
+
+    tabulator's xlsx parser builds an openpyxl workbook and a cell object for
+    every value it reads. This reads the sheet XML directly, one row element at
+    a time, discarding each row once it has been yielded, so memory stays flat
+    no matter how large the sheet is (only the shared string table and styles
+    are held). Cell values are decoded with openpyxl's own cell parser and rows
+    are padded to the sheet dimension exactly as openpyxl's read-only
+    worksheet does, so the rows produced are the same as the `xlsx` format.
+    """
+
+    # Public
+
+    options = [
+        "sheet",
+        "excel_workbook_cache",
+        "preserve_formatting",
+        "adjust_floating_point_error",
+    ]
+
+    def __init__(
+        self,
+        loader,
+        force_parse=False,
+        sheet=1,
+        excel_workbook_cache=None,
+        preserve_formatting=False,
+        adjust_floating_point_error=False,
+    ):
+        self.__loader = loader
+        self.__sheet_pointer = sheet
+        self.__workbook_cache = excel_workbook_cache
+        self.__preserve_formatting = preserve_formatting
+        self.__adjust_floating_point_error = adjust_floating_point_error
+        self.__force_parse = force_parse
+        self.__extended_rows = None
+        self.__encoding = None
+        self.__fragment = None
+        self.__source = None
+        self.__bytes = None
+        self.__archive = None
+        self.__released = False
+
+    @property
+    def closed(self):
+        return self.__bytes is None or self.__bytes.closed
+
+    def open(self, source, encoding=None):
+        self.close()
+        self.__source = source
+        self.__encoding = encoding
+        self.__bytes = self.__load_bytes()
+        try:
+            self.__archive = zipfile.ZipFile(self.__bytes)
+        except zipfile.BadZipFile as error:
+            raise exceptions.SourceError(
+                'Excel document "%s" is not a valid xlsx file: %s' % (source, error)
+            )
+        self.__read_workbook()
+
+        # Reset parser
+        self.reset()
+
+    def close(self):
+        if not self.closed:
+            self.__archive.close()
+            self.__bytes.close()
+
+    def reset(self):
+        self.__extended_rows = self.__iter_extended_rows()
+
+    @property
+    def encoding(self):
+        return self.__encoding
+
+    @property
+    def fragment(self):
+        return self.__fragment
+
+    @property
+    def extended_rows(self):
+        return self.__extended_rows
+
+    # Private
+
+    def __load_bytes(self):
+        if self.__workbook_cache is not None:
+            # The workbook file is shared with the other sheets of a
+            # multi-sheet load
+            return io.open(
+                self.__workbook_cache.get_path(self.__source, self.__load_file),
+                "rb",
+            )
+        source_bytes = self.__load_file()
+        if source_bytes.seekable():
+            return source_bytes
+        # zipfile needs random access; spool remote streams to local scratch
+        target_bytes = TemporaryFile(prefix="bcodmo-xlsx-stream-")
+        shutil.copyfileobj(source_bytes, target_bytes)
+        source_bytes.close()
+        target_bytes.seek(0)
+        return target_bytes
+
+    def __load_file(self):
+        return self.__loader.load(self.__source, mode="b", encoding=self.__encoding)
+
+    def __read_workbook(self):
+        archive = self.__archive
+        valid_files = set(archive.namelist())
+        package = Manifest.from_tree(fromstring(archive.read(ARC_CONTENT_TYPES)))
+
+        workbook_parser = WorkbookParser(
+            archive, _find_workbook_part(package).PartName[1:]
+        )
+        workbook_parser.parse()
+        self.__epoch = workbook_parser.wb.epoch
+
+        # Only worksheets are addressable, matching openpyxl's `worksheets`
+        worksheets = []
+        for sheet, rel in workbook_parser.find_sheets():
+            if rel.target not in valid_files or "chartsheet" in rel.Type:
+                continue
+            worksheets.append((sheet.name, rel.target))
+        try:
+            if isinstance(self.__sheet_pointer, six.string_types):
+                self.__fragment, self.__sheet_path = next(
+                    ws for ws in worksheets if ws[0] == self.__sheet_pointer
+                )
+            else:
+                self.__fragment, self.__sheet_path = worksheets[
+                    self.__sheet_pointer - 1
+                ]
+        except (StopIteration, IndexError):
+            message = 'Excel document "%s" doesn\'t have a sheet "%s"'
+            raise exceptions.SourceError(
+                message % (self.__source, self.__sheet_pointer)
+            )
+
+        self.__shared_strings = []
+        strings = package.find(SHARED_STRINGS)
+        if strings is not None:
+            with archive.open(strings.PartName[1:]) as src:
+                self.__shared_strings = read_string_table(src)
+
+        self.__date_formats = set()
+        self.__timedelta_formats = set()
+        self.__number_format_ids = []
+        self.__custom_number_formats = []
+        if ARC_STYLE in valid_files:
+            stylesheet = Stylesheet.from_tree(fromstring(archive.read(ARC_STYLE)))
+            if stylesheet.cell_styles:
+                self.__date_formats = stylesheet.date_formats
+                self.__timedelta_formats = stylesheet.timedelta_formats
+                self.__number_format_ids = [
+                    style.numFmtId for style in stylesheet.cell_styles
+                ]
+                self.__custom_number_formats = stylesheet.number_formats
+
+        with archive.open(self.__sheet_path) as src:
+            dimensions = WorkSheetParser(src, []).parse_dimensions()
+        self.__max_column = self.__max_row = None
+        if dimensions is not None:
+            _, _, self.__max_column, self.__max_row = dimensions
+
+    def __number_format(self, style_id):
+        # Mirrors openpyxl's ReadOnlyCell.number_format
+        try:
+            format_id = self.__number_format_ids[style_id]
+        except IndexError:
+            format_id = 0
+        if format_id < BUILTIN_FORMATS_MAX_SIZE:
+            return BUILTIN_FORMATS.get(format_id, "General")
+        return self.__custom_number_formats[format_id - BUILTIN_FORMATS_MAX_SIZE]
+
+    def __iter_sheet_rows(self):
+        reader = SheetRowReader(
+            self.__shared_strings,
+            self.__epoch,
+            self.__date_formats,
+            self.__timedelta_formats,
+        )
+        with self.__archive.open(self.__sheet_path) as src:
+            yield from reader.iter_rows(src)
+
+    def __row_values(self, cells, max_col):
+        # Same shape as openpyxl's ReadOnlyWorksheet._get_row (min_col is 1)
+        if not cells and not max_col:
+            return []
+        max_col = max_col or cells[-1]["column"]
+        if not self.__preserve_formatting:
+            values = [None] * max_col
+            for cell in cells:
+                column = cell["column"]
+                if 1 <= column <= max_col:
+                    values[column - 1] = cell["value"]
+            return values
+        row = [EmptyCell] * max_col
+        for cell in cells:
+            column = cell["column"]
+            if 1 <= column <= max_col:
+                row[column - 1] = StreamedCell(
+                    cell["value"], self.__number_format(cell["style_id"])
+                )
+        return extract_row_values(
+            row, self.__preserve_formatting, self.__adjust_floating_point_error
+        )
+
+    def __iter_sheet_values(self):
+        # Same row sequence as openpyxl's ReadOnlyWorksheet._cells_by_row.
+        # Rows missing from the XML are given as their width, so that trailing
+        # ones (dropped by iter_used_rows) are never built
+        max_col = self.__max_column
+        max_row = self.__max_row
+        width = max_col if max_col is not None else 0
+        counter = 1
+        for idx, cells in self.__iter_sheet_rows():
+            if max_row is not None and idx > max_row:
+                break
+            # some rows are missing
+            for _ in range(counter, idx):
+                yield width
+                counter += 1
+            if counter <= idx:
+                if all(cell["value"] is None for cell in cells):
+                    # Only formatting, no values
+                    yield width
+                else:
+                    yield self.__row_values(cells, max_col)
+                counter += 1
+        # Rows up to max_row that never show up in the XML are empty, and
+        # trailing, so they are left out
+
+    def __iter_extended_rows(self):
+        for row_number, row in iter_used_rows(self.__iter_sheet_values()):
+            yield (row_number, None, row)
+
+        # The sheet has been fully consumed - let the cache drop the workbook
+        if self.__workbook_cache is not None and not self.__released:
+            self.__released = True
+            self.__workbook_cache.release(self.__source, self.__fragment)
+
+
+class SheetRowReader(object):
+    """Pulls (row_number, cells) out of a worksheet XML stream with expat.
+
+    Cells are decoded the way openpyxl's WorkSheetParser.parse_cell decodes
+    them with data_only=True, but without building an element tree: only the
+    rows completed by the current chunk of input are ever held in memory.
+    """
+
+    def __init__(self, shared_strings, epoch, date_formats, timedelta_formats):
+        self.shared_strings = shared_strings
+        self.epoch = epoch
+        self.date_formats = date_formats
+        self.timedelta_formats = timedelta_formats
+        # Column letters -> index, so "AB12"-style references are only decoded
+        # once per column rather than once per cell
+        self.column_indexes = {}
+
+    def iter_rows(self, src):
+        rows = []
+        state = {
+            "row": None,
+            "row_counter": 0,
+            "col_counter": 0,
+            "cell": None,
+            "text": None,
+            "path": [],
+        }
+
+        def start_element(name, attrs):
+            path = state["path"]
+            if state["cell"] is not None:
+                path.append(name)
+                if name == VALUE_TAG:
+                    state["text"] = []
+                elif name == INLINE_STRING_TAG:
+                    state["cell"]["inline"] = []
+                elif name == TEXT_TAG and len(path) >= 2 and path[-2] in (
+                    INLINE_STRING_TAG,
+                    RICH_TEXT_RUN_TAG,
+                ):
+                    state["text"] = []
+            elif name == CELL_TAG and state["row"] is not None:
+                path.append(name)
+                state["cell"] = {
+                    "r": attrs.get("r"),
+                    "t": attrs.get("t", "n"),
+                    "s": attrs.get("s", 0),
+                    "v": None,
+                    "inline": None,
+                }
+            elif name == ROW_TAG:
+                r = attrs.get("r")
+                if r is not None:
+                    try:
+                        state["row_counter"] = int(r)
+                    except ValueError:
+                        val = float(r)
+                        if not val.is_integer():
+                            raise ValueError(f"{r} is not a valid row number")
+                        state["row_counter"] = int(val)
+                else:
+                    state["row_counter"] += 1
+                state["col_counter"] = 0
+                state["row"] = []
+
+        def end_element(name):
+            cell = state["cell"]
+            if cell is not None:
+                path = state["path"]
+                path.pop()
+                if name == VALUE_TAG and state["text"] is not None:
+                    cell["v"] = "".join(state["text"])
+                    state["text"] = None
+                elif name == TEXT_TAG and state["text"] is not None:
+                    cell["inline"].append("".join(state["text"]))
+                    state["text"] = None
+                elif name == CELL_TAG:
+                    state["row"].append(self.__parse_cell(cell, state))
+                    state["cell"] = None
+            elif name == ROW_TAG and state["row"] is not None:
+                rows.append((state["row_counter"], state["row"]))
+                state["row"] = None
+
+        def character_data(data):
+            if state["text"] is not None:
+                state["text"].append(data)
+
+        parser = expat.ParserCreate(namespace_separator=NS_SEPARATOR)
+        parser.buffer_text = True
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = character_data
+
+        while True:
+            chunk = src.read(READ_CHUNK_SIZE)
+            parser.Parse(chunk, not chunk)
+            yield from rows
+            rows.clear()
+            if not chunk:
+                break
+
+    def __parse_cell(self, cell, state):
+        # Mirrors openpyxl's WorkSheetParser.parse_cell with data_only=True
+        data_type = cell["t"]
+        coordinate = cell["r"]
+        style_id = cell["s"]
+        if style_id:
+            style_id = int(style_id)
+
+        if coordinate:
+            letters = coordinate.rstrip("0123456789")
+            column = self.column_indexes.get(letters)
+            if column is None:
+                column = column_index_from_string(letters)
+                self.column_indexes[letters] = column
+            state["col_counter"] = column
+        else:
+            state["col_counter"] += 1
+            column = state["col_counter"]
+
+        value = None
+        if data_type != "inlineStr":
+            value = cell["v"] or None
+
+        if value is not None:
+            if data_type == "n":
+                value = _cast_number(value)
+                if style_id in self.date_formats:
+                    data_type = "d"
+                    try:
+                        value = from_excel(
+                            value,
+                            self.epoch,
+                            timedelta=style_id in self.timedelta_formats,
+                        )
+                    except (OverflowError, ValueError):
+                        warnings.warn(
+                            f"Cell {coordinate} is marked as a date but the serial value {value} is outside the limits for dates. The cell will be treated as an error."
+                        )
+                        data_type = "e"
+                        value = "#VALUE!"
+            elif data_type == "s":
+                value = self.shared_strings[int(value)]
+            elif data_type == "b":
+                value = bool(int(value))
+            elif data_type == "d":
+                value = from_ISO8601(value)
+        elif data_type == "inlineStr" and cell["inline"] is not None:
+            value = "".join(cell["inline"])
+
+        return {"column": column, "value": value, "style_id": style_id}
+
+
+class StreamedCell(object):
+    __slots__ = ["value", "number_format"]
+
+    def __init__(self, value, number_format):
+        self.value = value
+        self.number_format = number_format
+
+
+EmptyCell = StreamedCell(None, None)
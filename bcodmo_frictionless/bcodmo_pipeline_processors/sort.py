@@ -1,65 +1,139 @@
 import re
 import os
+import sys
+import zlib
+import heapq
+import pickle
+import shutil
+import struct
 import decimal
-
-from kvfile import KVFile
-from bitstring import BitArray
+import logging
+import tempfile
+import weakref
+from itertools import chain
 
 from dataflows import Flow
 from dataflows.helpers.resource_matcher import ResourceMatcher
 
 from bcodmo_frictionless.bcodmo_pipeline_processors.helper import (
     KVFileBuildProgress,
+    iter_parallel,
 )
 
 
-# Number of entries the sort's in-memory KVFile cache holds before it starts
-# spilling to (and re-reading from) the on-disk SQLite/LevelDB store. The kvfile
-# default is only 10,240, which is tiny: sort drains *every* row of the resource
-# into the KVFile, so any resource with more rows than this falls off a cliff
-# into per-row SQLite queries + pickle (de)serialization, pegging a core while
-# the pipeline appears stalled. Each cached entry is on the order of ~1KB, so the
-# default below trades ~1GB of RAM (only if actually reached) for keeping the
-# whole sort buffer in memory. Tune with the KVFILE_CACHE_SIZE env var.
-KVFILE_CACHE_SIZE = int(os.environ.get("KVFILE_CACHE_SIZE", 1_000_000))
+log = logging.getLogger(__name__)
+
+# Approximate number of bytes of rows a sort holds in memory. Rows are sorted
+# in memory up to this budget; past it each sorted run is written to a scratch
+# file and the runs are merged as the rows are yielded. Tune with the
+# SORT_MEMORY_BUDGET env var or the sort's `memory_budget`.
+SORT_MEMORY_BUDGET = int(os.environ.get("SORT_MEMORY_BUDGET", 1024 * 1024 * 1024))
+
+# Rows are measured one in this many to estimate the size of a run, as
+# measuring every row would cost about as much as sorting it
+SIZE_SAMPLE_INTERVAL = 100
+
+# Most runs merged at once. Past this, runs are first merged into longer ones
+# so the final merge doesn't hold too many files open.
+MAX_MERGE_RUNS = 256
+
+# zlib level of spilled runs: runs are read back once, so the fastest level
+RUN_COMPRESSION_LEVEL = 1
+
+# Size (bytes) of the read/write buffers of run files
+RUN_FILE_BUFFER_SIZE = 1 << 20
+
+# Rows held back by a `presorted` sort to put slightly out of order rows back
+# in order
+DEFAULT_LOOKBEHIND = 1000
+
+# Rows a `presorted` sort checks are in order before it starts yielding them,
+# as a multiple of its lookbehind
+PRESORTED_CHECK_LOOKBEHINDS = 4
 
 
 FIELDS_RE = re.compile(r'(\{[^\}]+\})')
 KEY_RE = re.compile(r'[^!:\}]+')
 
+# Ranks of the kinds of values a sort key can hold. Values of different kinds
+# compare by rank alone, so they never have to be compared to each other.
+NONE_RANK = 0
+NUMBER_RANK = 1
+NAN_RANK = 2
+STRING_RANK = 3
+OTHER_RANK = 4
+
+VALUE_RANKS = {
+    type(None): NONE_RANK,
+    bool: NUMBER_RANK,
+    int: NUMBER_RANK,
+    float: NUMBER_RANK,
+    decimal.Decimal: NUMBER_RANK,
+    str: STRING_RANK,
+}
+
+
+def sort_value(value):
+    """Returns the (rank, value) pair a field value is sorted by: None first,
+    then numbers by value (ints, floats and Decimals alike), NaN, strings, and
+    anything else (dates, times, ...) by type and then value.
+    """
+    rank = VALUE_RANKS.get(type(value))
+    if rank is None:
+        if isinstance(value, str):
+            return (STRING_RANK, value)
+        if isinstance(value, (int, float, decimal.Decimal)):
+            rank = NUMBER_RANK
+        else:
+            return (OTHER_RANK, (type(value).__name__, value))
+    if rank == NUMBER_RANK:
+        if value != value:
+            return (NAN_RANK, None)
+    elif rank == NONE_RANK:
+        return (NONE_RANK, None)
+    return (rank, value)
+
 
 class KeyCalc(object):
+    """Computes the sort key of a row.
+
+    The key is a flat tuple of a (rank, value) pair per field of the key spec
+    (flat, as nested tuples are much slower to sort). Plain `{field}` items
+    (and the fields of a list spec) compare by value, as sort_value() orders
+    them; items with a format spec or conversion compare as the string they
+    format to. A callable spec's result is the only item of the key.
+    """
+
     def __init__(self, key_spec):
+        self.key_spec = key_spec
         self.calculator = self.__calculator(key_spec)
 
     def __calculator(self, key_spec):
         if callable(key_spec):
-            return key_spec
+            return lambda row: (key_spec(row),)
         formatters = None
         if isinstance(key_spec, str):
             formatters = FIELDS_RE.findall(key_spec)
             key_spec = [KEY_RE.findall(fmt[1:])[0] for fmt in formatters]
         if isinstance(key_spec, (list, tuple)):
+            getters = []
+            for i, key in enumerate(key_spec):
+                raw = not formatters or formatters[i] == '{' + key + '}'
+                if raw:
+                    getters.append(lambda row, key=key: sort_value(row[key]))
+                else:
+                    getters.append(
+                        lambda row, key=key, fmt=formatters[i]: (
+                            STRING_RANK,
+                            fmt.format(**{key: row[key]}),
+                        )
+                    )
+
+            if len(getters) == 1:
+                return getters[0]
+
             def func(row):
-                ret = ''
-                for i, key in enumerate(key_spec):
-                    value = row[key]
-                    # numbers
-                    # https://www.h-schmidt.net/FloatConverter/IEEE754.html
-                    raw = not formatters or formatters[i] == '{' + key + '}'
-                    if raw and isinstance(value, (int, float, decimal.Decimal)):
-                        bits = BitArray(float=value, length=64)
-                        # invert the sign bit
-                        bits.invert(0)
-                        # invert negative numbers
-                        if value < 0:
-                            bits.invert(range(1, 64))
-                        value = bits.hex
-                    if formatters:
-                        ret += formatters[i].format(**{key: value})
-                    else:
-                        ret += str(value)
-                return ret
+                return tuple([item for getter in getters for item in getter(row)])
             return func
         assert False, 'key should be either a format string or a row->string callable'
 
@@ -67,29 +141,384 @@ class KeyCalc(object):
         return self.calculator(row)
 
 
-def _sorter(rows, key_calc, reverse, batch_size, cache_id=None, resource_name=None):
-    db = KVFile(size=KVFILE_CACHE_SIZE)
+def estimate_size(row):
+    # Rough in-memory size of a row
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
 
-    # Buffering every row into the KVFile is a blocking step; publish the number
-    # of rows buffered so far so the frontend can see it building up (and that
-    # it's alive vs stalled).
-    progress = KVFileBuildProgress(cache_id, resource_name, "sort")
 
-    def process(rows):
+def write_run(path, records, batch_size):
+    """Writes sorted records to a run file, pickled and compressed a batch at
+    a time, each batch behind its length. Returns the bounds of the run.
+    """
+    first = None
+    with open(path, "wb", buffering=RUN_FILE_BUFFER_SIZE) as f:
+        batch = []
+        for record in records:
+            if first is None:
+                first = record
+            batch.append(record)
+            if len(batch) >= batch_size:
+                write_batch(f, batch)
+                batch = []
+        if batch:
+            write_batch(f, batch)
+    return run_bounds(first, record)
+
+
+def run_bounds(first, last):
+    # The first and last records of a run, without their rows
+    return (first[:-1], last[:-1])
+
+
+def write_batch(f, batch):
+    data = zlib.compress(
+        pickle.dumps(batch, pickle.HIGHEST_PROTOCOL), RUN_COMPRESSION_LEVEL
+    )
+    f.write(struct.pack("<I", len(data)))
+    f.write(data)
+
+
+def iter_run(path):
+    with open(path, "rb", buffering=RUN_FILE_BUFFER_SIZE) as f:
+        while True:
+            header = f.read(4)
+            if not header:
+                return
+            (length,) = struct.unpack("<I", header)
+            yield from pickle.loads(zlib.decompress(f.read(length)))
+
+
+class SortRuns(object):
+    """The sorted runs of a sort that didn't fit in memory, each in a scratch
+    file of its own. merge() yields the records of every run in order.
+
+    The first and last record of each run are kept, so runs that don't
+    overlap - as when the rows were already sorted, or sorted a chunk at a
+    time - are read one after the other rather than merged.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.directory = tempfile.mkdtemp(prefix="bcodmo_sort_")
+        # (path, bounds) of each run
+        self.runs = []
+        self.count = 0
+        # Backstop: remove the scratch files of a sort that is abandoned
+        # (pipeline error, early GC) without a clean close()
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.directory, ignore_errors=True
+        )
+
+    def new_path(self):
+        path = os.path.join(self.directory, "run-%d" % self.count)
+        self.count += 1
+        return path
+
+    def add(self, path, bounds):
+        self.runs.append((path, bounds))
+
+    def spill(self, records):
+        path = self.new_path()
+        self.add(path, write_run(path, records, self.batch_size))
+
+    def merge(self, reverse, run):
+        """Yields the records of every run, and of the sorted in-memory `run`,
+        in order.
+        """
+        sources = [(bounds, path) for path, bounds in self.runs]
+        if run:
+            sources.append((run_bounds(run[0], run[-1]), run))
+        sources.sort(key=lambda source: source[0][0], reverse=reverse)
+        # Records are unique (they hold their row number), so a run ends
+        # either before the next one starts or after it
+        if all(
+            (bounds[1] < next_bounds[0]) != reverse
+            for (bounds, _), (next_bounds, _) in zip(sources, sources[1:])
+        ):
+            return chain.from_iterable(
+                iter_run(source) if isinstance(source, str) else source
+                for _, source in sources
+            )
+        while len(self.runs) > MAX_MERGE_RUNS:
+            runs = self.runs[:MAX_MERGE_RUNS]
+            del self.runs[:MAX_MERGE_RUNS]
+            self.spill(
+                heapq.merge(*[iter_run(path) for path, _ in runs], reverse=reverse)
+            )
+            for path, _ in runs:
+                os.unlink(path)
+        return heapq.merge(
+            *[iter_run(path) for path, _ in self.runs], run, reverse=reverse
+        )
+
+    def close(self):
+        self._finalizer()
+
+
+def sort_run(task):
+    """Sorts a batch of (row number, row) pairs into a run file, in a worker
+    process. Rows are numbered by their place in the whole resource.
+    """
+    key_spec, reverse, batch_size, path, rows = task
+    key_calc = KeyCalc(key_spec)
+    run = [key_calc(row) + (row_num, row) for row_num, row in rows]
+    run.sort(reverse=reverse)
+    return path, write_run(path, run, batch_size)
+
+
+class Descending(object):
+    """Orders the records of a reversed `presorted` sort in heapq, which pops
+    the smallest item, the way a reversed sort orders them.
+    """
+
+    __slots__ = ("order", "record")
+
+    def __init__(self, record):
+        self.order = record[:-1]
+        self.record = record
+
+    def __lt__(self, other):
+        return self.order > other.order
+
+
+def _stream_presorted(numbered, key_calc, reverse, lookbehind, check_rows,
+                      progress, resource_name):
+    """Yields the rows of a `presorted` sort as they come, through a window of
+    the last `lookbehind` of them that puts rows only slightly out of place
+    back in order.
+
+    The first `check_rows` rows are held back to check that the rows are in
+    order. A row further out of place among them returns the records read so
+    far, for them and the rest of `numbered` to be sorted instead. Past them,
+    rows are yielded as they leave the window, and such a row fails the sort,
+    as rows before it have already been yielded. Returns None once every row
+    is yielded.
+    """
+    window = []
+    # Records that left the window, in order, until rows are yielded
+    ready = []
+    previous = None
+    for row_num, row in numbered:
+        record = key_calc(row) + (row_num, row)
+        if previous is not None and (
+            record[:-1] > previous if reverse else record[:-1] < previous
+        ):
+            if ready is None:
+                raise Exception(
+                    "Rows of %s aren't sorted: row %d is more than %d rows out of "
+                    "place. Remove `presorted` or raise `lookbehind`."
+                    % (resource_name, row_num + 1, lookbehind)
+                )
+            if reverse:
+                window = [item.record for item in window]
+            progress.finish()
+            return ready + window + [record]
+        heapq.heappush(window, Descending(record) if reverse else record)
+        if len(window) > lookbehind:
+            record = heapq.heappop(window)
+            if reverse:
+                record = record.record
+            previous = record[:-1]
+            if ready is None:
+                yield record[-1]
+            else:
+                ready.append(record)
+        if ready is not None:
+            progress.update(row_num + 1)
+            if row_num + 1 >= check_rows:
+                progress.finish()
+                records, ready = ready, None
+                for record in records:
+                    yield record[-1]
+                del records
+    if ready is not None:
+        progress.finish()
+        for record in ready:
+            yield record[-1]
+    while window:
+        record = heapq.heappop(window)
+        yield record.record[-1] if reverse else record[-1]
+
+
+def _sort_limited(rows, key_calc, reverse, limit, progress):
+    """Yields the first `limit` rows of the sort, in order, keeping only that
+    many records in a heap as the rows go by.
+    """
+
+    def records():
         for row_num, row in enumerate(rows):
-            key = key_calc(row) + '{:08x}'.format(row_num)
+            yield key_calc(row) + (row_num, row)
             progress.update(row_num + 1)
-            yield (key, row)
 
-    db.insert(process(rows), batch_size=batch_size)
+    # Records are unique by row number, so the heap picks the same rows, ties
+    # included, as the first `limit` rows of a full sort
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    top = select(limit, records())
     progress.finish()
-    for _, value in db.items(reverse=reverse):
-        yield value
-    db.close()
+    for record in top:
+        yield record[-1]
+
+
+def can_pickle(value):
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def _sorter(rows, key_calc, reverse, batch_size, cache_id=None, resource_name=None,
+            memory_budget=None, workers=None, presorted=False, lookbehind=None,
+            presorted_check_rows=None, limit=None):
+    if memory_budget is None:
+        memory_budget = SORT_MEMORY_BUDGET
+    reverse = bool(reverse)
+    if limit is not None:
+        yield from _sort_limited(
+            rows,
+            key_calc,
+            reverse,
+            limit,
+            KVFileBuildProgress(cache_id, resource_name, "sort"),
+        )
+        return
+    if workers and workers > 1 and not can_pickle(key_calc.key_spec):
+        log.warning(
+            "Sorting %s in a single process: its key can't be sent to workers",
+            resource_name,
+        )
+        workers = None
+
+    # Buffering every row is a blocking step; publish the number of rows
+    # buffered so far so the frontend can see it building up (and that it's
+    # alive vs stalled).
+    progress = KVFileBuildProgress(cache_id, resource_name, "sort")
+
+    # Rows are sorted as records of their key items, row number and row: the
+    # row number keeps equal keys in their original order (reversed along with
+    # everything else when `reverse` is set) and makes sure rows are never
+    # compared. It also makes the order of the records the same however they
+    # were split into runs.
+    numbered = enumerate(rows)
+    # Records of rows already read by a `presorted` sort that weren't in order
+    buffered = []
+    if presorted:
+        if lookbehind is None:
+            lookbehind = DEFAULT_LOOKBEHIND
+        if presorted_check_rows is None:
+            presorted_check_rows = PRESORTED_CHECK_LOOKBEHINDS * lookbehind
+        buffered = yield from _stream_presorted(
+            numbered,
+            key_calc,
+            reverse,
+            lookbehind,
+            presorted_check_rows,
+            progress,
+            resource_name,
+        )
+        if buffered is None:
+            return
+        log.info("Sorting %s: its rows aren't in order", resource_name)
+        progress = KVFileBuildProgress(cache_id, resource_name, "sort")
+
+    runs = None
+    if workers and workers > 1:
+        runs, rest = _spill_parallel(
+            chain(((record[-2], record[-1]) for record in buffered), numbered),
+            key_calc,
+            reverse,
+            batch_size,
+            progress,
+            memory_budget,
+            workers,
+        )
+        run = [key_calc(row) + (row_num, row) for row_num, row in rest]
+    else:
+        run = []
+        run_size = 0
+        row_size = 0
+        records = chain(
+            buffered,
+            (key_calc(row) + (row_num, row) for row_num, row in numbered),
+        )
+        for record in records:
+            row_num = record[-2]
+            if row_num % SIZE_SAMPLE_INTERVAL == 0:
+                row_size = estimate_size(record[-1])
+            run.append(record)
+            run_size += row_size
+            if run_size > memory_budget:
+                if runs is None:
+                    runs = SortRuns(batch_size)
+                run.sort(reverse=reverse)
+                runs.spill(run)
+                run = []
+                run_size = 0
+            progress.update(row_num + 1)
+    progress.finish()
+
+    run.sort(reverse=reverse)
+    if runs is None:
+        for record in run:
+            yield record[-1]
+        return
+    log.info(
+        "Sorting %s: merging %d runs spilled to disk",
+        resource_name,
+        len(runs.runs) + 1,
+    )
+    try:
+        for record in runs.merge(reverse, run):
+            yield record[-1]
+    finally:
+        runs.close()
+
+
+def _spill_parallel(numbered, key_calc, reverse, batch_size, progress,
+                    memory_budget, workers):
+    """Hands the (row number, row) pairs to `workers` processes a run at a
+    time, each sorting its run and writing it to a scratch file. Returns the
+    SortRuns (or None, when every row fit in a single run) and the pairs of
+    the last run, which is left to the caller to sort in memory.
+    """
+    # Each worker holds a run being sorted, and about as many wait to be
+    # picked up, so runs are cut smaller to stay in the budget overall
+    run_budget = memory_budget // (workers * 2 + 1)
+    runs = None
+    rest = []
+
+    def tasks():
+        nonlocal runs, rest
+        run = []
+        run_size = 0
+        row_size = 0
+        for row_num, row in numbered:
+            if row_num % SIZE_SAMPLE_INTERVAL == 0:
+                row_size = estimate_size(row)
+            run.append((row_num, row))
+            run_size += row_size
+            if run_size > run_budget:
+                if runs is None:
+                    runs = SortRuns(batch_size)
+                yield (key_calc.key_spec, reverse, batch_size, runs.new_path(), run)
+                run = []
+                run_size = 0
+            progress.update(row_num + 1)
+        rest = run
+
+    for path, bounds in iter_parallel(sort_run, tasks(), workers):
+        runs.add(path, bounds)
+    return runs, rest
 
 
-def sort_rows(key, resources=None, reverse=False, batch_size=1000, cache_id=None):
+def sort_rows(key, resources=None, reverse=False, batch_size=1000, cache_id=None,
+              memory_budget=None, workers=None, presorted=False, lookbehind=None,
+              presorted_check_rows=None, limit=None):
     key_calc = KeyCalc(key)
+    if limit is not None and (
+        isinstance(limit, bool) or not isinstance(limit, int) or limit < 0
+    ):
+        raise Exception("`limit` must be a non-negative integer, got %r" % (limit,))
 
     def func(package):
         matcher = ResourceMatcher(resources, package.pkg)
@@ -103,6 +532,12 @@ def sort_rows(key, resources=None, reverse=False, batch_size=1000, cache_id=None
                     batch_size,
                     cache_id=cache_id,
                     resource_name=rows.res.name,
+                    memory_budget=memory_budget,
+                    workers=workers,
+                    presorted=presorted,
+                    lookbehind=lookbehind,
+                    presorted_check_rows=presorted_check_rows,
+                    limit=limit,
                 )
             else:
                 yield rows
@@ -136,5 +571,11 @@ def flow(parameters):
             resources=parameters.get("resources"),
             reverse=parameters.get("reverse"),
             cache_id=parameters.get("cache_id"),
+            memory_budget=parameters.get("memory_budget"),
+            workers=parameters.get("workers"),
+            presorted=parameters.get("presorted", False),
+            lookbehind=parameters.get("lookbehind"),
+            presorted_check_rows=parameters.get("presorted_check_rows"),
+            limit=parameters.get("limit"),
         ),
     )
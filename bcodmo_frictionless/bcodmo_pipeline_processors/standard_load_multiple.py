@@ -25,7 +25,7 @@ def _preload_data(load_source, mode, loader, loader_options):
 
 
 def get_mode(_format):
-    return "b" if _format in ["xlsx", "xls"] else "t"
+    return "b" if _format in ["xlsx", "xls", "bcodmo-xlsx-stream"] else "t"
 
 
 class standard_load_multiple(standard_load):
@@ -35,6 +35,7 @@ class standard_load_multiple(standard_load):
         names,
         sheets=None,
         limit_rows_loader=None,
+        skip_string_conversion=False,
         **options,
     ):
         super(standard_load_multiple, self).__init__("", **options)
@@ -42,6 +43,15 @@ class standard_load_multiple(standard_load):
         self.names = names
         self.sheets = sheets
         self.limit_rows_loader = limit_rows_loader
+        # The csv parser only ever produces string values, so there is nothing
+        # for the stream's force_strings or the cast to strings to convert
+        if skip_string_conversion and self.options.get("format") != "csv":
+            raise Exception(
+                "skip_string_conversion can only be used with the csv format"
+            )
+        self.string_only = skip_string_conversion
+        if self.string_only and options.get("cast_strategy") == self.CAST_TO_STRINGS:
+            self.caster = lambda res, it: it
 
     def _set_individual(self, i):
         load_source = self.load_sources[i]
@@ -71,9 +81,14 @@ class standard_load_multiple(standard_load):
         ):
             procs = {}
             pool = Pool(threads=True)
+            # Workbooks already downloaded while listing their sheets are served
+            # from the workbook cache, so don't fetch them a second time
+            workbook_cache = self.options.get("excel_workbook_cache")
 
             for i, load_source in enumerate(self.load_sources):
-                if load_source not in procs:
+                if load_source not in procs and not (
+                    workbook_cache is not None and load_source in workbook_cache
+                ):
                     self._set_individual(i)
                     self.options["loader_resource_name"] = self.names[i]
                     mode = get_mode(self.options.get("format"))
@@ -192,6 +207,8 @@ class standard_load_multiple(standard_load):
                 ):
                     # This doesn't actually limit in the stream, but rather later in the loader.
                     options["_limit_rows"] = self.limit_rows
+                if self.string_only:
+                    options = {**options, "force_strings": False}
                 stream: Stream = Stream(self.load_source, **options).open()
                 """ Finish change to add preloaded data """
 
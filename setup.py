@@ -13,6 +13,8 @@ required = [
     "python-dateutil==2.8.2",
     "redis==6.2.0",
     "xlrd==1.2.0",
+    # The xlsx stream parser builds on openpyxl's private reader modules
+    "openpyxl>=3.1,<3.2",
     "pytz==2025.2",
     "billiard==4.2.1",
 ]
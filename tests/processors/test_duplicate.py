@@ -119,7 +119,7 @@ def test_row_file_buffer_reserves_and_truncates(monkeypatch):
 
     monkeypatch.setattr(os, "posix_fallocate", spy)
 
-    buf = RowFileBuffer()
+    buf = RowFileBuffer(memory_budget=0)
     try:
         expected = [{"i": i, "s": "x" * 100} for i in range(200)]
         for row in expected:
@@ -143,7 +143,7 @@ def test_row_file_buffer_reserves_and_truncates(monkeypatch):
 def test_row_file_buffer_row_larger_than_chunk(monkeypatch):
     # A single row bigger than the reservation chunk must still be accommodated.
     monkeypatch.setattr(duplicate_module, "RESERVE_CHUNK_SIZE", 1024)
-    buf = RowFileBuffer()
+    buf = RowFileBuffer(memory_budget=0)
     try:
         big = {"blob": "y" * 50_000}
         buf.write(big)
@@ -157,9 +157,9 @@ def test_row_file_buffer_row_larger_than_chunk(monkeypatch):
 @pytest.mark.skipif(TEST_DEV, reason="test development")
 def test_row_file_buffer_finalizer_backstop():
     # An abandoned buffer (no close()) still has its temp file removed on GC.
-    buf = RowFileBuffer()
-    path = buf.path
+    buf = RowFileBuffer(memory_budget=0)
     buf.write({"a": 1})
+    path = buf.path
     assert os.path.exists(path)
     del buf
     gc.collect()
@@ -180,7 +180,7 @@ def test_duplicate_out_of_space(monkeypatch):
     with pytest.raises(Exception) as exc_info:
         Flow(
             sample_data(),
-            duplicate({"source": "res_1", "target-name": "copy"}),
+            duplicate({"source": "res_1", "target-name": "copy", "memory_budget": 0}),
         ).results()
     assert "Not enough disk space" in str(exc_info.value)
     # the partial scratch file was cleaned up
@@ -203,7 +203,74 @@ def test_duplicate_fallocate_unsupported_fallback(monkeypatch):
     with pytest.raises(Exception) as exc_info:
         Flow(
             sample_data(),
-            duplicate({"source": "res_1", "target-name": "copy"}),
+            duplicate({"source": "res_1", "target-name": "copy", "memory_budget": 0}),
         ).results()
     assert "Not enough disk space" in str(exc_info.value)
     assert dup_temp_files() == before
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_row_file_buffer_blocks(compression):
+    # Rows with other fields (or the same fields in another order) start a new
+    # block, and all of them come back unchanged and in order.
+    expected = (
+        [{"i": i, "s": f"v{i}"} for i in range(10)]
+        + [{"s": "swapped", "i": 10}, {}, {}, {"other": None}]
+        + [{"i": i, "s": f"v{i}"} for i in range(11, 20)]
+    )
+    buf = RowFileBuffer(batch_size=4, compression=compression, memory_budget=0)
+    try:
+        for row in expected:
+            buf.write(row)
+        buf.done_writing()
+        read = list(buf.read())
+        assert read == expected
+        assert [list(row) for row in read] == [list(row) for row in expected]
+    finally:
+        buf.close()
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_duplicate_unknown_compression():
+    with pytest.raises(Exception) as exc_info:
+        Flow(
+            sample_data(),
+            duplicate({"source": "res_1", "compression": "rar"}),
+        ).results()
+    assert "Unknown duplicate `compression`" in str(exc_info.value)
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_duplicate_in_memory(monkeypatch):
+    def no_disk(*args, **kwargs):
+        raise AssertionError("a small duplicate shouldn't touch the disk")
+
+    monkeypatch.setattr(os, "posix_fallocate", no_disk)
+    monkeypatch.setattr(tempfile, "mkstemp", no_disk)
+    rows, _, _ = Flow(
+        sample_data(),
+        duplicate({"source": "res_1", "multi": True, "target_names": ["a", "b"]}),
+    ).results()
+    for resource_rows in rows:
+        assert resource_rows == sample_data()
+    # every copy gets rows of its own
+    assert rows[1][0] is not rows[2][0]
+    assert rows[0][0] is not rows[1][0]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_row_file_buffer_spills_past_memory_budget():
+    expected = [{"i": i, "s": "x" * 100} for i in range(500)]
+    buf = RowFileBuffer(batch_size=7, memory_budget=10_000)
+    try:
+        for row in expected:
+            buf.write(row)
+        buf.done_writing()
+        assert not buf.in_memory
+        assert os.path.exists(buf.path)
+        assert list(buf.read()) == expected
+        assert list(buf.read()) == expected
+    finally:
+        buf.close()
+    assert not os.path.exists(buf.path)
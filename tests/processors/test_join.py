@@ -1,9 +1,17 @@
 import pytest
 import os
+import sys
+import datetime
 from dataflows import Flow, join
 from decimal import Decimal
 
 from bcodmo_frictionless.bcodmo_pipeline_processors import *
+from bcodmo_frictionless.bcodmo_pipeline_processors.join import (
+    BloomFilter,
+    JoinIndex,
+    JoinIndexCache,
+    KeyCalc,
+)
 
 
 TEST_DEV = os.environ.get("TEST_DEV", False) == "true"
@@ -56,3 +64,533 @@ def test_join():
             "mode": "half-outer",
         }),
 """
+
+
+source_data = [
+    {"key": "a", "value": 1},
+    {"key": "b", "value": 2},
+    {"key": "a", "value": 3},
+    {"key": "d", "value": 4},
+]
+target_data = [
+    {"key": "a", "other": 1},
+    {"key": "b", "other": 2},
+    {"key": "c", "other": 3},
+]
+
+
+expected_rows = {
+    "inner": [
+        {"key": "a", "other": 1, "total": 4, "values": [1, 3]},
+        {"key": "b", "other": 2, "total": 2, "values": [2]},
+    ],
+    "half-outer": [
+        {"key": "a", "other": 1, "total": 4, "values": [1, 3]},
+        {"key": "b", "other": 2, "total": 2, "values": [2]},
+        {"key": "c", "other": 3, "total": None, "values": None},
+    ],
+    "full-outer": [
+        {"key": "a", "other": 1, "total": 4, "values": [1, 3]},
+        {"key": "b", "other": 2, "total": 2, "values": [2]},
+        {"key": "c", "other": 3, "total": None, "values": None},
+        {"key": "d", "other": None, "total": 4, "values": [4]},
+    ],
+}
+
+
+def run_join(mode, source=source_data, target=target_data, **parameters):
+    flows = [
+        source,
+        target,
+        join(
+            {
+                "source": {"name": "res_1", "key": ["key"], "delete": True},
+                "target": {"name": "res_2", "key": ["key"]},
+                "fields": {
+                    "total": {"name": "value", "aggregate": "sum"},
+                    "values": {"name": "value", "aggregate": "array"},
+                },
+                "mode": mode,
+                **parameters,
+            }
+        ),
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    return rows
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("mode", ["inner", "half-outer", "full-outer"])
+def test_join_index_memory_budget(mode):
+    assert run_join(mode) == [expected_rows[mode]]
+    # A budget of 1 byte moves the index to disk with its first key
+    assert run_join(mode, index_memory_budget=1) == [expected_rows[mode]]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("index_memory_budget", [None, 1])
+def test_join_array_not_shared(index_memory_budget):
+    # Target rows with the same key each get their own list
+    target = [{"key": "a", "other": 1}, {"key": "a", "other": 2}]
+    (rows,) = run_join(
+        "inner", target=target, index_memory_budget=index_memory_budget
+    )
+    rows[0]["values"].append(5)
+    assert rows[1]["values"] == [1, 3]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_bloom_filter():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(str(i))
+    assert all(str(i) in bloom_filter for i in range(1000))
+    false_positives = sum(str(i) in bloom_filter for i in range(1000, 11000))
+    assert false_positives < 300
+
+    # Only a few target keys are in the spilled source index
+    target = [{"key": "x%d" % i} for i in range(50)] + [{"key": "a"}]
+    for bloom_false_positive_rate in [0.01, 0]:
+        rows = run_join(
+            "inner",
+            target=target,
+            index_memory_budget=1,
+            bloom_false_positive_rate=bloom_false_positive_rate,
+        )
+        assert rows == run_join("inner", target=target)
+        assert [row["key"] for row in rows[0]] == ["a"]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("index_memory_budget", [None, 1])
+def test_join_profile(caplog, index_memory_budget):
+    with caplog.at_level("INFO"):
+        run_join("half-outer", index_memory_budget=index_memory_budget)
+    (profile,) = [
+        record.args[2]
+        for record in caplog.records
+        if record.getMessage().startswith("Join profile of res_1 onto res_2")
+    ]
+    assert profile["source_rows"] == 4
+    assert profile["distinct_keys"] == 3
+    assert profile["target_rows"] == 3
+    assert profile["matched_rows"] == 2
+    assert profile["match_rate"] == 0.6667
+    assert profile["fanout_max"] == 2
+    assert profile["fanout_p50"] == 1
+    spilled = index_memory_budget is not None
+    assert profile["index_mode"] == ("disk" if spilled else "memory")
+    assert (profile["index_bytes_spilled"] > 0) == spilled
+    assert (profile["index_bytes_in_memory"] > 0) != spilled
+    assert ("kvfile_cache_hit_ratio" in profile) == spilled
+
+    # Each target gets figures of its own
+    caplog.clear()
+    other_target = [{"key": "d", "other": 4}, {"key": "c", "other": 5}]
+    with caplog.at_level("INFO"):
+        Flow(
+            source_data,
+            target_data,
+            other_target,
+            join(
+                {
+                    "source": {"name": "res_1", "key": ["key"], "delete": True},
+                    "target": [
+                        {"name": "res_2", "key": ["key"]},
+                        {"name": "res_3", "key": ["key"]},
+                    ],
+                    "fields": {"total": {"name": "value", "aggregate": "sum"}},
+                    "index_memory_budget": index_memory_budget,
+                }
+            ),
+        ).results()
+    profiles = dict(
+        (record.args[1], record.args[2])
+        for record in caplog.records
+        if record.getMessage().startswith("Join profile")
+    )
+    assert profiles["res_2"]["source_rows"] == profiles["res_3"]["source_rows"] == 4
+    assert profiles["res_2"]["target_rows"] == 3
+    assert profiles["res_2"]["match_rate"] == 0.6667
+    assert profiles["res_3"]["target_rows"] == 2
+    assert profiles["res_3"]["matched_rows"] == 1
+    assert profiles["res_3"]["match_rate"] == 0.5
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("mode", ["inner", "half-outer", "full-outer"])
+@pytest.mark.parametrize("partition_workers", [1, 2])
+def test_join_partitioned(mode, partition_workers):
+    rows = run_join(
+        mode,
+        strategy="partitioned",
+        partitions=3,
+        partition_workers=partition_workers,
+    )
+    assert rows == [expected_rows[mode]]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("mode", ["inner", "half-outer", "full-outer"])
+def test_join_merge(mode):
+    source = sorted(source_data, key=lambda row: row["key"])
+    rows = run_join(mode, source=source, strategy="merge")
+    assert rows == [expected_rows[mode]]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_merge_orders_by_value():
+    # 9 comes before 10 even though "10" < "9"
+    source = [{"key": 9, "value": 1}, {"key": 10, "value": 2}]
+    target = [{"key": 9, "other": 1}, {"key": 10, "other": 2}]
+    rows = run_join("inner", source=source, target=target, strategy="merge")
+    assert rows == [
+        [
+            {"key": 9, "other": 1, "total": 1, "values": [1]},
+            {"key": 10, "other": 2, "total": 2, "values": [2]},
+        ]
+    ]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_merge_out_of_order():
+    with pytest.raises(Exception, match="ordered by key"):
+        run_join("inner", strategy="merge")
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_merge_key_types_differ():
+    source = [{"key": 10, "value": 1}]
+    target = [{"key": "10", "other": 1}]
+    with pytest.raises(Exception, match="keys of the same type"):
+        run_join("inner", source=source, target=target, strategy="merge")
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_index_live_entries(monkeypatch):
+    # On disk, entries being updated stay live and are only written back to
+    # the KVFile when they're evicted or the index is read as a whole
+    index = JoinIndex(memory_budget=0, live_entries=2)
+    index.set("first", [0])
+    assert index.mode == "disk"
+    writes = []
+    db = index._JoinIndex__db
+    real_set = db.set
+    monkeypatch.setattr(db, "set", lambda *args: writes.append(args[0]) or real_set(*args))
+    for key in ["a", "b"]:
+        index.set(key, [])
+        for i in range(1000):
+            value = index.get(key)
+            value.append(i)
+            index.set(key, value, 8)
+    assert writes == []
+    # Adding a third key evicts the least recently used one
+    index.set("c", [])
+    assert writes == ["a"]
+    # which is read back from the KVFile
+    assert index.get("a") == list(range(1000))
+    assert writes == ["a", "b"]
+    assert list(index.values()) == [
+        list(range(1000)),
+        list(range(1000)),
+        [],
+        [0],
+    ]
+    assert writes == ["a", "b", "c"]
+    assert index.fanout() == {1: 2, 1001: 2}
+    index.close()
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("index_memory_budget", [None, 1])
+def test_join_accumulating_aggregates(index_memory_budget):
+    source = [
+        {"key": "a", "value": v, "label": label}
+        for v, label in [(3, "x"), (1, "y"), (2, "x"), (1, "x"), (5, "x")]
+    ]
+    target = [{"key": "a"}]
+    flows = [
+        source,
+        target,
+        join(
+            {
+                "source": {"name": "res_1", "key": ["key"], "delete": True},
+                "target": {"name": "res_2", "key": ["key"]},
+                "fields": {
+                    "values": {"name": "value", "aggregate": "array"},
+                    "median": {"name": "value", "aggregate": "median"},
+                    "distinct": {"name": "value", "aggregate": "set"},
+                    "counts": {"name": "label", "aggregate": "counters"},
+                },
+                "index_memory_budget": index_memory_budget,
+            }
+        ),
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    row = rows[0][0]
+    assert row["values"] == [3, 1, 2, 1, 5]
+    assert row["median"] == 2
+    assert sorted(row["distinct"]) == [1, 2, 3, 5]
+    assert row["counts"] == [("x", 4), ("y", 1)]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize(
+    "key_spec",
+    [["a"], ["a", "b"], "{#}", "{a}-{b}", "{a:>5}/{#:04}", "{b!r}", "x{a}y"],
+)
+def test_join_key_calc(key_spec):
+    row = {"a": "abc", "b": 1.5}
+    key_calc = KeyCalc(key_spec)
+    key = key_calc(row, 7)
+    assert isinstance(key, tuple)
+    spec = key_spec if isinstance(key_spec, str) else ":".join(
+        "{%s}" % k for k in key_spec
+    )
+    assert key_calc.string(key) == spec.format(**{**row, "#": 7})
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("index_memory_budget", [None, 1])
+def test_join_index_cache(tmp_path, index_memory_budget):
+    parameters = {
+        "index_cache": str(tmp_path),
+        "index_memory_budget": index_memory_budget,
+    }
+    # Built, then reused
+    assert run_join("full-outer", **parameters) == [expected_rows["full-outer"]]
+    (fingerprint,) = os.listdir(tmp_path)
+    assert "digests.pickle" in os.listdir(tmp_path / fingerprint)
+    assert run_join("full-outer", **parameters) == [expected_rows["full-outer"]]
+
+    # A changed source is noticed and indexed again, replacing the old index
+    source = source_data[:2]
+    rows = run_join("full-outer", source=source, **parameters)
+    assert rows == run_join("full-outer", source=source)
+    assert os.listdir(tmp_path) == [fingerprint]
+    assert run_join("full-outer", source=source, **parameters) == rows
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_index_cache_source_file(tmp_path, monkeypatch):
+    path = tmp_path / "source.csv"
+    cache_dir = tmp_path / "cache"
+
+    def run():
+        flows = [
+            load({"from": str(path), "name": "res_1", "format": "csv"}),
+            [{"key": "a"}, {"key": "b"}],
+            join(
+                {
+                    "source": {"name": "res_1", "key": ["key"], "delete": True},
+                    "target": {"name": "res_2", "key": ["key"]},
+                    "fields": {"value": {"name": "value"}},
+                    "index_cache": str(cache_dir),
+                }
+            ),
+        ]
+        rows, _, _ = Flow(*flows).results()
+        return [row["value"] for row in rows[0]]
+
+    path.write_text("key,value\na,1\nb,2\n")
+    assert run() == ["1", "2"]
+    (fingerprint,) = os.listdir(cache_dir)
+    # Told apart by the file it was loaded from, so its rows aren't checked
+    assert "digests.pickle" not in os.listdir(cache_dir / fingerprint)
+
+    def add(self, batch):
+        raise AssertionError("source rows checked")
+
+    monkeypatch.setattr(JoinIndexCache, "add", add)
+    assert run() == ["1", "2"]
+
+    # A changed file gets an index of its own
+    path.write_text("key,value\na,3\nb,4\nc,5\n")
+    assert run() == ["3", "4"]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_index_cache_eviction(tmp_path, monkeypatch):
+    def build(spec, batch):
+        cache = JoinIndexCache(str(tmp_path), spec)
+        cache.add(batch)
+        hit, _ = cache.finish()
+        if not hit:
+            index = JoinIndex()
+            index.set("a", [1])
+            cache.save(index)
+            index.close()
+        return hit, cache
+
+    def lock_inode(cache):
+        return os.stat(tmp_path / cache.fingerprint / "lock").st_ino
+
+    _, one = build("one", [1])
+    one.close()
+    assert os.listdir(tmp_path) == [one.fingerprint]
+    first = lock_inode(one)
+
+    # An index being read by another run isn't replaced when its source changes
+    hit, reader = build("one", [1])
+    assert hit
+    _, cache = build("one", [2])
+    cache.close()
+    assert lock_inode(one) == first
+    reader.close()
+    # but is by the next run once it's no longer read
+    _, cache = build("one", [2])
+    cache.close()
+    assert lock_inode(one) != first
+    hit, cache = build("one", [2])
+    assert hit
+    cache.close()
+
+    # Indexes past the size limit or unused for too long are deleted
+    _, two = build("two", [1])
+    two.close()
+    join_module = sys.modules[JoinIndexCache.__module__]
+    monkeypatch.setattr(join_module, "JOIN_INDEX_CACHE_MAX_BYTES", 1)
+    hit, reader = build("two", [1])
+    assert hit
+    _, cache = build("three", [1])
+    cache.close()
+    assert os.listdir(tmp_path) == [two.fingerprint]
+    reader.close()
+    monkeypatch.setattr(join_module, "JOIN_INDEX_CACHE_MAX_BYTES", 1 << 30)
+    monkeypatch.setattr(join_module, "JOIN_INDEX_CACHE_MAX_AGE", -1)
+    _, cache = build("three", [1])
+    cache.close()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("index_memory_budget", [None, 1])
+def test_join_multiple_targets(index_memory_budget):
+    other_target = [{"id": "d", "other": 4}, {"id": "a", "other": 5}]
+    flows = [
+        source_data,
+        target_data,
+        other_target,
+        join(
+            {
+                "source": {"name": "res_1", "key": ["key"], "delete": True},
+                "target": [
+                    {"name": "res_2", "key": ["key"]},
+                    {"name": "res_3", "key": ["id"]},
+                ],
+                "fields": {"total": {"name": "value", "aggregate": "sum"}},
+                "mode": "full-outer",
+                "index_memory_budget": index_memory_budget,
+            }
+        ),
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    # Each target gets the source keys it didn't use
+    assert rows == [
+        [
+            {"key": "a", "other": 1, "total": 4},
+            {"key": "b", "other": 2, "total": 2},
+            {"key": "c", "other": 3, "total": None},
+            {"key": "d", "other": None, "total": 4},
+        ],
+        [
+            {"id": "d", "other": 4, "total": 4},
+            {"id": "a", "other": 5, "total": 4},
+            {"id": "b", "other": None, "total": 2},
+        ],
+    ]
+
+
+gps_data = [
+    {"cruise": "c1", "time": 10, "lat": 1.0},
+    {"cruise": "c1", "time": 20, "lat": 2.0},
+    {"cruise": "c1", "time": 30, "lat": 3.0},
+    {"cruise": "c2", "time": 15, "lat": 9.0},
+]
+bottle_data = [
+    {"cruise": "c1", "time": 5},
+    {"cruise": "c1", "time": 14},
+    {"cruise": "c1", "time": 16},
+    {"cruise": "c1", "time": 25},
+    {"cruise": "c1", "time": 40},
+    {"cruise": "c2", "time": 20},
+]
+
+
+def run_asof_join(
+    mode="half-outer", key=["cruise"], source=gps_data, target=bottle_data, **asof
+):
+    flows = [
+        source,
+        target,
+        join(
+            {
+                "source": {"name": "res_1", "key": key, "delete": True},
+                "target": {"name": "res_2", "key": key},
+                "fields": {"lat": {"name": "lat"}},
+                "mode": mode,
+                "asof": {"source_field": "time", "target_field": "time", **asof},
+            }
+        ),
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    return [(row["cruise"], row["time"], row["lat"]) for row in rows[0]]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize(
+    "asof, lats",
+    [
+        ({}, [None, 1.0, 1.0, 2.0, 3.0, 9.0]),
+        ({"direction": "forward"}, [1.0, 2.0, 2.0, 3.0, None, None]),
+        ({"direction": "nearest"}, [1.0, 1.0, 2.0, 2.0, 3.0, 9.0]),
+        ({"direction": "nearest", "tolerance": 4}, [None, 1.0, 2.0, None, None, None]),
+    ],
+)
+def test_join_asof(asof, lats):
+    rows = run_asof_join(**asof)
+    assert rows == [
+        (row["cruise"], row["time"], lat) for row, lat in zip(bottle_data, lats)
+    ]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_asof_modes():
+    # Without a by key every cruise's positions are candidates
+    rows = run_asof_join("inner", key=[], direction="forward")
+    assert [lat for _, _, lat in rows] == [1.0, 9.0, 2.0, 3.0, 2.0]
+
+    rows = run_asof_join("full-outer", direction="forward", tolerance=1)
+    assert rows == [
+        ("c1", 5, None),
+        ("c1", 14, None),
+        ("c1", 16, None),
+        ("c1", 25, None),
+        ("c1", 40, None),
+        ("c2", 20, None),
+        ("c1", 10, 1.0),
+        ("c1", 20, 2.0),
+        ("c1", 30, 3.0),
+        ("c2", 15, 9.0),
+    ]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_join_asof_field_types():
+    # Untyped as-of fields are rejected before any row is read
+    source = [dict(row, time=str(row["time"])) for row in gps_data]
+    with pytest.raises(Exception, match="as-of field time of resource res_1 .* set_types"):
+        run_asof_join(source=source)
+    target = [dict(row, time=datetime.date(2020, 1, 1)) for row in bottle_data]
+    with pytest.raises(Exception, match="same kind of values, found number and date"):
+        run_asof_join(target=target)
+
+    # Rows without an as-of value are skipped, and floats match Decimals
+    source = [dict(row, time=float(row["time"])) for row in gps_data]
+    source.append({"cruise": "c1", "time": None, "lat": 0.0})
+    target = [dict(row, time=row["time"] + Decimal("0.5")) for row in bottle_data]
+    target.append({"cruise": "c1", "time": None})
+    rows = run_asof_join(source=source, target=target, direction="nearest", tolerance=5)
+    assert [lat for _, _, lat in rows] == [1.0, 1.0, 2.0, 3.0, None, None, None]
+
@@ -765,3 +765,433 @@ def test_floating_point_error_2():
 
     assert len(rows) == 1
     assert str(rows[0][33]["ChlaYSI"]) == "1.23"
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_sheet_regex_opens_workbook_once(monkeypatch):
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import excel
+
+    calls = []
+    load_workbook = excel.openpyxl.load_workbook
+
+    def counting_load_workbook(*args, **kwargs):
+        calls.append(kwargs)
+        return load_workbook(*args, **kwargs)
+
+    monkeypatch.setattr(excel.openpyxl, "load_workbook", counting_load_workbook)
+    flows = [
+        load(
+            {
+                "from": "data/test.xlsx",
+                "name": "res",
+                "format": "xlsx",
+                "sheet": r"test\d",
+                "sheet_regex": True,
+            }
+        )
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    assert len(datapackage.resources) == 4
+    # Listing the sheets and reading all four of them shares a single workbook
+    assert len(calls) == 1
+    assert rows[0][0]["col5"] == "abc"
+    assert rows[1][0]["col2"] == "1"
+    assert rows[2][2]["col7"] == "53.1"
+    assert rows[3][1]["col6"] == "2"
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize(
+    "path,sheet,options",
+    [
+        ("data/test.xlsx", 2, {}),
+        ("data/test_scientific_notation.xlsx", 1, {"preserve_formatting": True}),
+        ("data/test_utc_time_conversion.xlsx", 1, {}),
+        (
+            "data/test_floating_point_error.xlsx",
+            1,
+            {"adjust_floating_point_error": True, "preserve_formatting": True},
+        ),
+        (
+            "data/test_floating_point_error2.xlsx",
+            1,
+            {"adjust_floating_point_error": True, "preserve_formatting": True},
+        ),
+    ],
+)
+def test_load_xlsx_stream(path, sheet, options):
+    results = []
+    for _format in ["xlsx", "bcodmo-xlsx-stream"]:
+        flows = [
+            load(
+                {
+                    "from": path,
+                    "name": "res",
+                    "format": _format,
+                    "sheet": sheet,
+                    **options,
+                }
+            )
+        ]
+        rows, datapackage, _ = Flow(*flows).results()
+        results.append((rows, datapackage.resources[0].schema.field_names))
+    assert results[0] == results[1]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_stream_sheet_regex():
+    flows = [
+        load(
+            {
+                "from": "data/test.xlsx",
+                "name": "res",
+                "format": "bcodmo-xlsx-stream",
+                "sheet": r"test\d",
+                "sheet_regex": True,
+            }
+        )
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    assert len(datapackage.resources) == 4
+    assert datapackage.resources[0].name == "test2"
+    assert rows[0][0]["col5"] == "abc"
+    assert rows[1][0]["col2"] == "1"
+    assert rows[2][2]["col7"] == "53.1"
+    assert rows[3][1]["col6"] == "2"
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("_format", ["xlsx", "bcodmo-xlsx-stream"])
+def test_load_xlsx_phantom_rows(_format):
+    # Formatting reaches row 5000 but the data stops at row 4
+    flows = [
+        load(
+            {
+                "from": "data/test_phantom_rows.xlsx",
+                "name": "res",
+                "format": _format,
+                "remove_empty_rows": False,
+                "trim_used_range": True,
+            }
+        )
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    assert datapackage.resources[0].schema.field_names == ["col1", "col2", "col3"]
+    # The empty row between data rows is kept, the trailing ones are not
+    assert len(rows[0]) == 3
+    assert rows[0][1] == {"col1": None, "col2": None, "col3": None}
+    assert rows[0][2]["col1"] == "3"
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_phantom_rows_bounded():
+    import openpyxl
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers.excel import (
+        iter_used_rows,
+        xlsx_used_rows,
+    )
+
+    # A loaded sheet is bounded by its last row with data
+    book = openpyxl.load_workbook("data/test_phantom_rows.xlsx")
+    assert xlsx_used_rows(book.worksheets[0]) == 4
+    book.close()
+    # A read-only one by its dimension, its trailing empty rows being dropped
+    # as they are read
+    book = openpyxl.load_workbook("data/test_phantom_rows.xlsx", read_only=True)
+    sheet = book.worksheets[0]
+    assert xlsx_used_rows(sheet) == 5000
+    rows = sheet.iter_rows(max_row=xlsx_used_rows(sheet), values_only=True)
+    assert len(list(iter_used_rows(rows))) == 4
+    book.close()
+    # Empty rows are held as runs and only built when data follows them
+    rows = [["a"], 2, 2, [None, None], [""], 3, ["b"], 2, 2]
+    assert list(iter_used_rows(rows)) == [
+        (1, ["a"]),
+        (2, [None, None]),
+        (3, [None, None]),
+        (4, [None, None]),
+        (5, [""]),
+        (6, [None, None, None]),
+        (7, ["b"]),
+    ]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_reread_releases_workbook():
+    from tabulator.loaders.local import LocalLoader
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import (
+        ExcelWorkbookCache,
+        CachedXLSXParser,
+    )
+
+    cache = ExcelWorkbookCache()
+    cache.expect("data/test.xlsx")
+    parser = CachedXLSXParser(LocalLoader(), excel_workbook_cache=cache)
+    parser.open("data/test.xlsx")
+    first = list(parser.extended_rows)
+    assert "data/test.xlsx" not in cache
+    # A second read loads the workbook again, and releases it once done
+    parser.reset()
+    assert list(parser.extended_rows) == first
+    assert "data/test.xlsx" not in cache
+    parser.close()
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_workbook_cache_temp_file():
+    import io
+    import os
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import (
+        ExcelWorkbookCache,
+    )
+
+    with open("data/test.xlsx", "rb") as f:
+        data = f.read()
+
+    cache = ExcelWorkbookCache()
+    cache.expect("s3://bucket/test.xlsx", 2)
+    # A stream that isn't backed by a local file is copied to a temp file once
+    loads = []
+
+    def load_file():
+        loads.append(1)
+        return io.BytesIO(data)
+
+    path = cache.get_path("s3://bucket/test.xlsx", load_file)
+    assert cache.get_path("s3://bucket/test.xlsx", load_file) == path
+    assert len(loads) == 1
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert cache.sheet_names("s3://bucket/test.xlsx", "xlsx", load_file)
+    cache.release("s3://bucket/test.xlsx")
+    assert os.path.exists(path)
+    # Removed with the last expected sheet
+    cache.release("s3://bucket/test.xlsx")
+    assert not os.path.exists(path)
+    assert "s3://bucket/test.xlsx" not in cache
+
+    # A local file is read where it is
+    cache.expect("data/test.xlsx")
+    assert cache.get_path(
+        "data/test.xlsx", lambda: open("data/test.xlsx", "rb")
+    ) == "data/test.xlsx"
+    cache.release("data/test.xlsx")
+    assert os.path.exists("data/test.xlsx")
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_xlsx_tabulator_workbook_cache():
+    import io
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import (
+        CachedXLSXParser,
+    )
+
+    class RemoteLoader(object):
+        remote = True
+
+        def __init__(self):
+            self.loads = 0
+
+        def load(self, source, mode="t", encoding=None):
+            self.loads += 1
+            return open("data/test.xlsx", "rb")
+
+    # A remote workbook is copied once, and the copy recorded for later parsers
+    loader = RemoteLoader()
+    workbook_cache = {}
+    for _ in range(2):
+        parser = CachedXLSXParser(loader, sheet=2, workbook_cache=workbook_cache)
+        parser.open("https://example.com/test.xlsx")
+        assert list(parser.extended_rows)[0][2] == ["col1", "col2", "col3", "col4"]
+        parser.close()
+    assert loader.loads == 1
+    with open(workbook_cache["https://example.com/test.xlsx"], "rb") as f:
+        with open("data/test.xlsx", "rb") as source:
+            assert f.read() == source.read()
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_fixedwidth_width():
+    flows = [
+        load(
+            {
+                "from": "data/test_fixedwidth.txt",
+                "name": "res",
+                "format": "bcodmo-fixedwidth",
+                "width": [5, 4],
+            }
+        )
+    ]
+    rows, datapackage, _ = Flow(*flows).results()
+    assert datapackage.resources[0].schema.field_names == ["a", "b"]
+    # Blank lines are skipped and pandas' missing values read as "nan"
+    assert rows[0] == [
+        {"a": "1", "b": "x"},
+        {"a": "22", "b": "nan"},
+        {"a": "333", "b": "yy"},
+    ]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_regex_csv_parallel_parse():
+    results = []
+    for options in [{}, {"parallel_parse_workers": 2, "parallel_parse_chunk_size": 20}]:
+        flows = [
+            load(
+                {
+                    "from": "data/test_regex.csv",
+                    "name": "res",
+                    "format": "bcodmo-regex-csv",
+                    "delimiter": r"\s+",
+                    "skip_rows": ["#", "*"],
+                    **options,
+                }
+            )
+        ]
+        rows, datapackage, _ = Flow(*flows).results()
+        results.append((rows, datapackage.resources[0].schema.field_names))
+    assert results[0] == results[1]
+    assert len(results[1][0][0]) == 4
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_byte_range_source(tmp_path, monkeypatch):
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers import byte_range
+
+    # Ranges cut anywhere still give every line exactly once
+    path = tmp_path / "lines.txt"
+    path.write_bytes(b"a b\r\nccc d\n\neeeeeeeeee f\ng")
+    source = byte_range.ByteRangeSource(path=str(path))
+    for chunk_size in [1, 2, 5, 100]:
+        lines = [
+            line
+            for start, end in source.ranges(chunk_size)
+            for line in source.lines(start, end, "utf-8")
+        ]
+        assert lines == ["a b\n", "ccc d\n", "\n", "eeeeeeeeee f\n", "g"]
+
+    # A process never uses an S3 client created by another one (a forked
+    # worker inherits its parent's cache)
+    class FakeClient:
+        def head_object(self, **kwargs):
+            return {"ContentLength": 10}
+
+    created = []
+    monkeypatch.setattr(byte_range, "_s3_clients", {})
+    monkeypatch.setattr(
+        byte_range.boto3, "client", lambda *args, **kwargs: created.append(1) or FakeClient()
+    )
+    byte_range.ByteRangeSource(bucket="b", key="k").size()
+    byte_range.ByteRangeSource(bucket="b", key="k").size()
+    assert len(created) == 1
+    monkeypatch.setattr(byte_range.os, "getpid", lambda: -1)
+    byte_range.ByteRangeSource(bucket="b", key="k").size()
+    assert len(created) == 2
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_byte_range_source_from_loader():
+    from tabulator.loaders.local import LocalLoader
+    from tabulator.loaders.remote import RemoteLoader
+    from bcodmo_frictionless.bcodmo_pipeline_processors.loaders import BcodmoAWS
+    from bcodmo_frictionless.bcodmo_pipeline_processors.parsers.byte_range import (
+        ByteRangeSource,
+    )
+
+    source = ByteRangeSource.from_loader(LocalLoader(), "data/test_regex.csv")
+    assert source.path == "data/test_regex.csv"
+    source = ByteRangeSource.from_loader(
+        BcodmoAWS(s3_endpoint_url="http://localhost:9000"), "s3://bucket/a/b.csv"
+    )
+    assert (source.bucket, source.key) == ("bucket", "a/b.csv")
+    assert source.s3_endpoint_url == "http://localhost:9000"
+    # A row limit is only applied when reading through the loader
+    assert ByteRangeSource.from_loader(BcodmoAWS(_limit_rows=10), "s3://b/k") is None
+    # Loaders ranges can't stand in for are rejected
+    with pytest.raises(Exception, match="parallel_parse_workers"):
+        ByteRangeSource.from_loader(RemoteLoader(), "https://example.com/a.csv")
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"skip_rows": ["#"]},
+        {"headers": 2},
+        {"missing_values": ["", "abc"]},
+    ],
+)
+def test_load_csv_skip_string_conversion(options):
+    results = []
+    for skip_string_conversion in [False, True]:
+        flows = [
+            load(
+                {
+                    "from": "data/test.csv",
+                    "name": "res",
+                    "format": "csv",
+                    "skip_string_conversion": skip_string_conversion,
+                    **options,
+                }
+            )
+        ]
+        rows, datapackage, _ = Flow(*flows).results()
+        results.append((rows, datapackage.resources[0].schema.descriptor))
+    assert results[0] == results[1]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_load_csv_skips_string_conversions(monkeypatch):
+    from bcodmo_frictionless.bcodmo_pipeline_processors import (
+        standard_load_multiple as load_module,
+    )
+
+    stream_options = []
+    real_stream = load_module.Stream
+
+    def stream(source, **options):
+        stream_options.append(options)
+        return real_stream(source, **options)
+
+    monkeypatch.setattr(load_module, "Stream", stream)
+    rows, _, _ = Flow(
+        load(
+            {
+                "from": "data/test.csv",
+                "name": "res",
+                "format": "csv",
+                "skip_string_conversion": True,
+                "cast_strategy": "strings",
+                "infer_strategy": "strings",
+            }
+        )
+    ).results()
+    assert stream_options
+    assert all(options["force_strings"] is False for options in stream_options)
+    assert all(
+        isinstance(value, str) or value is None
+        for row in rows[0]
+        for value in row.values()
+    )
+
+    # Rows go through the cast to strings untouched
+    loader = load_module.standard_load_multiple(
+        ["data/test.csv"],
+        ["res"],
+        format="csv",
+        cast_strategy="strings",
+        skip_string_conversion=True,
+    )
+    rows = iter([{"a": "1"}])
+    assert loader.caster(None, rows) is rows
+    loader = load_module.standard_load_multiple(
+        ["data/test.csv"], ["res"], format="csv", cast_strategy="strings"
+    )
+    assert loader.caster(None, rows) is not rows
+
+    # Other parsers produce values that still need converting
+    with pytest.raises(Exception, match="skip_string_conversion"):
+        load_module.standard_load_multiple(
+            ["data/test.xlsx"], ["res"], format="xlsx", skip_string_conversion=True
+        )
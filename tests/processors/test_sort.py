@@ -0,0 +1,206 @@
+import glob
+import importlib
+import os
+import tempfile
+from decimal import Decimal
+
+import pytest
+from dataflows import Flow
+
+from bcodmo_frictionless.bcodmo_pipeline_processors import *
+
+
+TEST_DEV = os.environ.get("TEST_DEV", False) == "true"
+
+# The package re-exports `sort` as the processor's flow() function, which
+# shadows the submodule attribute - reach the module explicitly.
+sort_module = importlib.import_module(
+    "bcodmo_frictionless.bcodmo_pipeline_processors.sort"
+)
+
+
+def sample_data():
+    return [
+        {"n": 0, "depth": 10, "station": "b"},
+        {"n": 1, "depth": Decimal("-2.5"), "station": "a"},
+        {"n": 2, "depth": None, "station": "b"},
+        {"n": 3, "depth": 2.5, "station": "a"},
+        {"n": 4, "depth": 10, "station": "a"},
+        {"n": 5, "depth": -100, "station": "b"},
+        {"n": 6, "depth": float("nan"), "station": "a"},
+        {"n": 7, "depth": 10.0, "station": "b"},
+    ]
+
+
+def sort_temp_dirs():
+    # The scratch directories of spilled sorts; used to assert nothing leaks.
+    return set(glob.glob(os.path.join(tempfile.gettempdir(), "bcodmo_sort_*")))
+
+
+def run_sort(**parameters):
+    rows, _, _ = Flow(sample_data(), sort(parameters)).results()
+    return [row["n"] for row in rows[0]]
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("memory_budget", [None, 1, 1000])
+def test_sort(memory_budget):
+    before = sort_temp_dirs()
+    parameters = {"resources": ["res_1"], "memory_budget": memory_budget}
+    # None first, numbers by value across types, NaN last, ties in order
+    assert run_sort(**{"sort-by": "{depth}", **parameters}) == [2, 5, 1, 3, 0, 4, 7, 6]
+    # Ties in reverse order when reversed
+    assert run_sort(**{"sort-by": "{depth}", "reverse": True, **parameters}) == [
+        6, 7, 4, 0, 3, 1, 5, 2
+    ]
+    assert run_sort(**{"sort-by": ["station", "depth"], **parameters}) == [
+        1, 3, 4, 6, 2, 5, 0, 7
+    ]
+    assert sort_temp_dirs() == before  # nothing left behind
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_sort_key_calc():
+    # Formatted fields compare as strings
+    key_calc = sort_module.KeyCalc("{station}{depth!s}")
+    assert key_calc({"station": "a", "depth": 10}) < key_calc(
+        {"station": "a", "depth": 9}
+    )
+    key_calc = sort_module.KeyCalc("{station}{depth:>5}")
+    assert key_calc({"station": "a", "depth": 9}) < key_calc(
+        {"station": "a", "depth": 10}
+    )
+    # Strings come after numbers
+    key_calc = sort_module.KeyCalc("{value}")
+    assert key_calc({"value": 1000}) < key_calc({"value": "1"})
+    key_calc = sort_module.KeyCalc(lambda row: row["value"])
+    assert key_calc({"value": "x"}) == ("x",)
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_sort_merges_many_runs(monkeypatch):
+    monkeypatch.setattr(sort_module, "MAX_MERGE_RUNS", 3)
+    rows = [{"value": (i * 7919) % 1000} for i in range(1000)]
+    sorted_rows = list(
+        sort_module._sorter(
+            iter(rows),
+            sort_module.KeyCalc("{value}"),
+            False,
+            10,
+            memory_budget=5000,
+        )
+    )
+    assert sorted_rows == sorted(rows, key=lambda row: row["value"])
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("memory_budget", [None, 3000])
+@pytest.mark.parametrize("reverse", [False, True])
+def test_sort_parallel(memory_budget, reverse):
+    rows = [{"value": (i * 7919) % 100, "n": i} for i in range(500)]
+
+    def run(key, workers):
+        return list(
+            sort_module._sorter(
+                iter(rows),
+                sort_module.KeyCalc(key),
+                reverse,
+                10,
+                memory_budget=memory_budget,
+                workers=workers,
+            )
+        )
+
+    # Workers give the same order as a single process
+    assert run("{value}", 2) == run("{value}", None)
+    # A key that can't be sent to workers is sorted in this process instead
+    assert run(lambda row: row["value"], 2) == run("{value}", None)
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("reverse", [False, True])
+def test_sort_concatenates_ordered_runs(monkeypatch, reverse):
+    def fail(*args, **kwargs):
+        raise AssertionError("ordered runs shouldn't be merged")
+
+    monkeypatch.setattr(sort_module.heapq, "merge", fail)
+    rows = [{"value": i} for i in range(1000)]
+    if reverse:
+        rows.reverse()
+    sorted_rows = list(
+        sort_module._sorter(
+            iter(rows),
+            sort_module.KeyCalc("{value}"),
+            reverse,
+            10,
+            memory_budget=5000,
+        )
+    )
+    assert sorted_rows == sorted(
+        rows, key=lambda row: row["value"], reverse=reverse
+    )
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("workers", [None, 2])
+def test_sort_presorted(reverse, workers):
+    rows = [{"value": i // 3, "n": i} for i in range(300)]
+    if reverse:
+        rows.reverse()
+    # Swap neighbours so every row is at most a few rows out of place
+    for i in range(0, len(rows) - 3, 4):
+        rows[i], rows[i + 2] = rows[i + 2], rows[i]
+    read = []
+
+    def source():
+        for row in rows:
+            read.append(row["n"])
+            yield row
+
+    def run(presorted=True, lookbehind=None, presorted_check_rows=None):
+        read.clear()
+        return sort_module._sorter(
+            source(),
+            sort_module.KeyCalc("{value}"),
+            reverse,
+            10,
+            workers=workers,
+            presorted=presorted,
+            lookbehind=lookbehind,
+            presorted_check_rows=presorted_check_rows,
+        )
+
+    expected = list(run(presorted=False))
+    assert list(run(lookbehind=5)) == expected
+    # A row further out of place than the lookbehind among the rows checked
+    # falls back to sorting the rows, each read once
+    assert list(run(lookbehind=1, presorted_check_rows=len(rows))) == expected
+    assert sorted(read) == list(range(len(rows)))
+    # Rows flow once the first 4 lookbehinds of them are shown in order
+    sorted_rows = run(lookbehind=5)
+    assert next(sorted_rows) == expected[0]
+    assert len(read) == 20
+    assert list(sorted_rows) == expected[1:]
+    sorted_rows = run(lookbehind=5, presorted_check_rows=100)
+    next(sorted_rows)
+    assert len(read) == 100
+    # after which a row out of place fails the sort
+    rows = expected[:250] + expected[251:261] + expected[250:251] + expected[261:]
+    with pytest.raises(Exception, match="aren't sorted"):
+        list(run(lookbehind=5))
+
+
+@pytest.mark.skipif(TEST_DEV, reason="test development")
+def test_sort_limit():
+    before = sort_temp_dirs()
+    # The first rows of the full sort, ties included
+    assert run_sort(**{"sort-by": "{depth}", "limit": 4, "memory_budget": 1}) == [
+        2, 5, 1, 3
+    ]
+    assert run_sort(**{"sort-by": "{depth}", "limit": 3, "reverse": True}) == [6, 7, 4]
+    assert run_sort(**{"sort-by": "{depth}", "limit": 100}) == [2, 5, 1, 3, 0, 4, 7, 6]
+    assert run_sort(**{"sort-by": "{depth}", "limit": 0}) == []
+    assert sort_temp_dirs() == before  # nothing written to disk
+    with pytest.raises(Exception):
+        run_sort(**{"sort-by": "{depth}", "limit": -1})